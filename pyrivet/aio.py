@@ -0,0 +1,191 @@
+import asyncio
+import os
+import subprocess
+import tempfile
+import weakref
+
+from . import rivet, hera, transport
+
+"""asyncio counterparts of the functions in `rivet` and `hera` that run
+rivet_console or Hera, built on asyncio.create_subprocess_exec so that one
+event loop can keep many RIVET and Hera processes busy without threads.
+The remaining blocking work done in Python, such as writing inputs, reading
+outputs, decoding modules and using the caches, runs in the loop's default
+executor, so the event loop itself is never blocked.
+
+The number of child processes running at once is limited by a semaphore.
+Each function accepts a `semaphore` argument; by default a semaphore shared
+by all calls on the running event loop is used, allowing `concurrency`
+simultaneous processes."""
+
+"""The default number of RIVET/Hera processes to run at once per event loop"""
+concurrency = os.cpu_count() or 1
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def default_semaphore():
+    """The semaphore shared by calls on the running event loop that don't
+    pass their own"""
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(concurrency)
+    return semaphore
+
+
+async def _check_output(cmd, semaphore=None, pass_fds=()):
+    """Like subprocess.check_output, without blocking the event loop"""
+    async with semaphore or default_semaphore():
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds)
+        output, errors = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output, errors)
+    return output
+
+
+async def _run(function, *args):
+    """Calls function(*args) in the running loop's default executor"""
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+async def compute_file(input_name, output_name=None, homology=0, x=0, y=0, threads=1,
+                       semaphore=None):
+    """See `rivet.compute_file`"""
+    if not output_name:
+        output_name = rivet._rivet_name(input_name, homology, x, y)
+    return await _compute_file(input_name, output_name, homology, x, y, threads, semaphore)
+
+
+async def _compute_file(input_name, output_name, homology, x, y, threads, semaphore,
+                        pass_fds=()):
+    cache = rivet.cache
+    if cache is not None:
+        key = await _run(rivet._cache_key, input_name, homology, x, y)
+        if await _run(cache.get, key, output_name):
+            return output_name
+    await _check_output(rivet._compute_command(input_name, output_name, homology, x, y, threads),
+                        semaphore, pass_fds)
+    if cache is not None:
+        await _run(cache.put, key, output_name)
+    return output_name
+
+
+async def _compute_bytes(saveable, homology, x, y, verify, semaphore):
+    with transport.staging() as staging:
+        saveable_name = await _run(rivet._save_input, saveable, staging)
+        output_name = staging.output('rivet_output.rivet')
+        await _compute_file(saveable_name, output_name, homology, x, y, 1, semaphore,
+                            staging.pass_fds)
+        output = await _run(staging.read, output_name)
+        if verify:
+            assert await bounds(output, semaphore=semaphore)
+        return output
+
+
+async def compute_point_cloud(cloud, homology=0, x=0, y=0, verify=False, semaphore=None):
+    """See `rivet.compute_point_cloud`"""
+    return await _compute_bytes(cloud, homology, x, y, verify, semaphore)
+
+
+async def compute_bifiltration(bifiltration, homology=0, verify=False, semaphore=None):
+    """See `rivet.compute_bifiltration`"""
+    return await _compute_bytes(bifiltration, homology, 0, 0, verify, semaphore)
+
+
+async def compute_metric_space(metric_space, homology=0, x=0, y=0, verify=False,
+                               semaphore=None):
+    """See `rivet.compute_metric_space`"""
+    return await _compute_bytes(metric_space, homology, x, y, verify, semaphore)
+
+
+async def barcodes(module, slices, semaphore=None):
+    """See `rivet.barcodes`"""
+    with transport.staging() as staging:
+        precomp_name = await _run(rivet._module_path, module, staging)
+        slice_name = await _run(rivet._write_slices, slices, staging)
+        output = await _check_output(rivet._barcodes_command(precomp_name, slice_name),
+                                     semaphore, staging.pass_fds)
+        return rivet._parse_barcode_arrays(output).pairs()
+
+
+async def bounds(module, semaphore=None):
+    """See `rivet.bounds`. Modules that can be decoded in-process don't start
+    a process at all."""
+    if isinstance(module, rivet.PrecomputedModule):
+        if module.known_bounds() is None:
+            data = await _run(module.module_data)
+            if data:
+                module.memoize_bounds(data.bounds())
+            else:
+                output = await _check_output(rivet._bounds_command(module.path), semaphore)
+                module.memoize_bounds(rivet.parse_bounds(output.split(b'\n')))
+        return module.known_bounds()
+    assert len(module) > 0
+    data = await _run(rivet._read_module, module)
+    if data is not None:
+        return data.bounds()
+    with transport.staging() as staging:
+        precomp_name = await _run(rivet._module_path, module, staging)
+        output = await _check_output(rivet._bounds_command(precomp_name), semaphore,
+                                     staging.pass_fds)
+        return rivet.parse_bounds(output.split(b'\n'))
+
+
+async def betti(saveable, homology=0, x=0, y=0, semaphore=None):
+    """See `rivet.betti`"""
+    with transport.staging() as staging:
+        name = await _run(rivet._save_input, saveable, staging, 'rivet-input.txt')
+        output = await _check_output(rivet._betti_command(name, homology, x, y), semaphore,
+                                     staging.pass_fds)
+        return rivet._parse_betti(output.split(b'\n'))
+
+
+async def multi_bottleneck_distance(lefts, rights, inf=1e10, cap=10, relative_error=1e-10,
+                                    processes=None, backend=None, semaphore=None):
+    """See `hera.multi_bottleneck_distance`. The shards run at once, as far
+    as the semaphore allows. The python backend runs in the default
+    executor."""
+    if not len(lefts) == len(rights):
+        raise ValueError("Lengths of `lefts` and `rights` must match")
+    backend = hera._backend(backend)
+    cache = hera.distance_cache
+    left_diagrams, right_diagrams, keys, distances, missing = await _run(
+        hera._multi_plan, cache, hera._cache_name("bottleneck_dist", backend), lefts, rights,
+        inf, relative_error)
+    computed = []
+    if missing and backend == 'python':
+        computed = await _run(hera._python_distances, "bottleneck_dist",
+                              [left_diagrams[i] for i in missing],
+                              [right_diagrams[i] for i in missing], inf, relative_error)
+    elif missing:
+        lefts = [left_diagrams[i] for i in missing]
+        rights = [right_diagrams[i] for i in missing]
+        shards = hera._shards(lefts, rights,
+                              hera.max_processes if processes is None else processes)
+        results = await asyncio.gather(*(
+            _multi_distances("bottleneck_dist", lefts[shard], rights[shard], inf,
+                             relative_error, semaphore=semaphore)
+            for shard in shards))
+        computed = [distance for result in results for distance in result]
+    return await _run(hera._multi_results, cache, keys, distances, missing, computed, cap)
+
+
+async def _multi_distances(executable, lefts, rights, inf, relative_error, *args,
+                           semaphore=None):
+    """See `hera._multi_distances`"""
+    with tempfile.TemporaryDirectory() as temp:
+        t1_name = os.path.join(temp, 'self.txt')
+        t2_name = os.path.join(temp, 'other.txt')
+        await _run(hera._write_multi_diagrams, t1_name, lefts, inf)
+        await _run(hera._write_multi_diagrams, t2_name, rights, inf)
+        try:
+            dists = await _check_output(
+                hera._hera_command(executable, t1_name, t2_name, relative_error, *args),
+                semaphore)
+        except Exception as e:
+            hera._preserve_inputs(t1_name, t2_name, e)
+            raise
+        return [float(d) for d in dists.splitlines()]
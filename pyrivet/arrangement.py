@@ -0,0 +1,345 @@
+import numpy as np
+
+from . import arrays, barcode, module_reader
+
+"""An in-process query engine for fibered barcodes, built on the augmented
+arrangement stored in a RIVET msgpack module.
+
+RIVET works in the dual plane, where the line y = m*x + c is the point
+(m, -c), and the template point (a, b) is the line y = a*x - b. The
+arrangement of those anchor lines divides the half-plane m >= 0 into faces,
+each labelled with a barcode template: all lines whose dual point falls in a
+face have the same barcode up to rescaling along the line.
+
+Point location uses a slab decomposition: the vertices of the arrangement
+cut the m axis into slabs, and inside a slab the edges are totally ordered
+from bottom to top, so a batch of queries is answered with one binary search
+over slabs and a vectorized binary search over the edges of each query's
+slab."""
+
+_ARRANGEMENT_FIELDS = ('x_exact', 'y_exact', 'x_grades', 'y_grades',
+                       'half_edges', 'vertices', 'anchors', 'faces',
+                       'topleft', 'topright', 'bottomleft', 'bottomright',
+                       'vertical_line_query_list')
+
+# Fields of each half edge in the arrangement message
+_ORIGIN, _TWIN, _NEXT, _PREV, _FACE, _ANCHOR = range(6)
+
+# The end of an infinite bar in a barcode template: the largest unsigned int
+_INFINITE_END = 2 ** 32 - 1
+
+
+class Arrangement:
+    """The augmented arrangement of a module, ready for fibered barcode
+    queries"""
+
+    def __init__(self, x_grades, y_grades, template_points, anchors,
+                 origins, twins, faces, edge_anchors, vertices, templates):
+        """
+        :param x_grades: float array, the x grades of the module
+        :param y_grades: float array, the y grades of the module
+        :param template_points: int array of shape (# of points, 2 or more),
+            whose first two columns are the x and y grade indexes
+        :param anchors: int array of shape (# of anchors, 2), the x and y
+            grade indexes of each anchor
+        :param origins: int array, the origin vertex of each half edge
+        :param twins: int array, the twin of each half edge
+        :param faces: int array, the face to the left of each half edge, or -1
+        :param edge_anchors: int array, the anchor whose line contains each
+            half edge, or -1
+        :param vertices: float array of shape (# of vertices, 2)
+        :param templates: list with a (# of bars, 3) int array of
+            (begin, end, multiplicity) for each face, where begin and end
+            index template points, and end is -1 for infinite bars
+        """
+        self.x_grades = np.asarray(x_grades, dtype=np.float64)
+        self.y_grades = np.asarray(y_grades, dtype=np.float64)
+        self.template_points = np.asarray(template_points)
+        self.anchors = np.asarray(anchors, dtype=np.int64).reshape(-1, 2)
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        self._build_templates(templates)
+        self._build_slabs(np.asarray(origins), np.asarray(twins),
+                          np.asarray(faces), np.asarray(edge_anchors))
+
+    @staticmethod
+    def from_module(module):
+        """Decodes the arrangement from a msgpack module: a file name,
+        byte array, or rivet.PrecomputedModule"""
+        data = module_reader.read(module, arrangement=True)
+        return Arrangement.from_message(data.arrangement_message, data)
+
+    @staticmethod
+    def from_message(message, data):
+        """Builds an Arrangement from a decoded arrangement message and the
+        module_reader.ModuleData of the same module.
+
+        RIVET packs the ArrangementMessage as the array of its fields, in the
+        order of `_ARRANGEMENT_FIELDS`, and each of its structs (half edges,
+        vertices, anchors, faces, barcode templates and their bars, and ids)
+        as the array of its own fields. Anything else raises
+        module_reader.FormatError."""
+        if not isinstance(message, list) or len(message) != len(_ARRANGEMENT_FIELDS):
+            raise module_reader.FormatError("Unexpected arrangement message layout")
+        fields = dict(zip(_ARRANGEMENT_FIELDS, message))
+        if [module_reader.to_fraction(v) for v in _list(fields['x_exact'])] != data.x_exact or \
+                [module_reader.to_fraction(v) for v in _list(fields['y_exact'])] != data.y_exact:
+            raise module_reader.FormatError("Arrangement grades don't match the module's")
+        x_grades = [_coordinate(v) for v in _list(fields['x_grades'])]
+        y_grades = [_coordinate(v) for v in _list(fields['y_grades'])]
+        if len(x_grades) != len(data.x_exact) or len(y_grades) != len(data.y_exact):
+            raise module_reader.FormatError("Arrangement grades don't match the module's")
+        edges = [[_id(v) for v in _struct(edge, 6, 'half edge')]
+                 for edge in _list(fields['half_edges'])]
+        edges = np.array(edges, dtype=np.int64).reshape(-1, 6)
+        vertices = [_struct(v, 3, 'vertex') for v in _list(fields['vertices'])]
+        for v in vertices:
+            _id(v[0])
+        vertices = [(_coordinate(v[1]), _coordinate(v[2])) for v in vertices]
+        anchors = [_decode_anchor(a) for a in _list(fields['anchors'])]
+        if any(x >= len(x_grades) or y >= len(y_grades) for x, y in anchors):
+            raise module_reader.FormatError("Anchor grade index out of range")
+        templates = [_decode_template(f) for f in _list(fields['faces'])]
+        for name in ('topleft', 'topright', 'bottomleft', 'bottomright'):
+            _id(fields[name])
+        for entry in _list(fields['vertical_line_query_list']):
+            _unsigned(_struct(entry, 2, 'vertical line query')[0])
+            _id(entry[1])
+        _validate(edges, len(vertices), len(anchors), len(templates),
+                  templates, len(data.template_points))
+        return Arrangement(x_grades, y_grades, data.template_points, anchors,
+                           edges[:, _ORIGIN], edges[:, _TWIN], edges[:, _FACE],
+                           edges[:, _ANCHOR], vertices, templates)
+
+    def _build_templates(self, templates):
+        lengths = np.array([len(t) for t in templates], dtype=np.int64)
+        self._template_ptr = np.concatenate([[0], np.cumsum(lengths)])
+        bars = [np.asarray(t, dtype=np.int64).reshape(-1, 3) for t in templates]
+        self._template_bars = np.concatenate(bars) if bars else np.zeros((0, 3), dtype=np.int64)
+
+    def _build_slabs(self, origins, twins, faces, edge_anchors):
+        x = self.vertices[:, 0]
+        start = x[origins]
+        end = x[origins[twins]]
+        rightward = start < end
+        self.slab_bounds = np.unique(x[np.isfinite(x)])
+        if len(self.slab_bounds) == 0:
+            self.slab_bounds = np.zeros(1)
+
+        # Each edge is the line slope * m + intercept in the dual plane.
+        # Edges without an anchor are the top and bottom of the arrangement.
+        anchored = edge_anchors >= 0
+        ax = np.zeros(len(origins))
+        ay = np.zeros(len(origins))
+        ax[anchored] = self.x_grades[self.anchors[edge_anchors[anchored], 0]]
+        ay[anchored] = self.y_grades[self.anchors[edge_anchors[anchored], 1]]
+        slope = np.where(anchored, ax, 0.)
+        intercept = np.where(anchored, -ay, self.vertices[origins, 1])
+        # The order of edges at m = infinity, used for vertical lines
+        asymptote = np.where(anchored, ax, np.sign(intercept) * np.inf)
+
+        edges = np.flatnonzero(rightward & (anchored | ~np.isfinite(intercept)))
+        first = np.searchsorted(self.slab_bounds, start[edges], side='left')
+        last = np.searchsorted(self.slab_bounds, end[edges], side='left')
+        counts = np.maximum(last - first, 0)
+        slab_of = np.repeat(first, counts) + arrays.ranges(counts)
+        edge_of = np.repeat(edges, counts)
+
+        # Order the edges within each slab by height at the middle of the slab
+        upper = np.append(self.slab_bounds[1:], self.slab_bounds[-1] + 2)
+        middle = (self.slab_bounds + upper) / 2
+        height = slope[edge_of] * middle[slab_of] + intercept[edge_of]
+        order = np.lexsort((height, slab_of))
+        slab_of = slab_of[order]
+        edge_of = edge_of[order]
+
+        self._slab_ptr = np.searchsorted(slab_of, np.arange(len(self.slab_bounds) + 1))
+        self._slope = slope[edge_of]
+        self._intercept = intercept[edge_of]
+        self._asymptote = asymptote[edge_of]
+        self._face_above = faces[edge_of]
+        self._face_below = faces[twins[edge_of]]
+
+    def locate(self, angles, offsets):
+        """Returns the face of the arrangement containing each line
+        (angle in degrees, offset), as an int array"""
+        angles = np.asarray(angles, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.float64)
+        vertical = angles == 90
+        radians = np.radians(np.where(vertical, 0, angles))
+        m = np.tan(radians)
+        point = -offsets / np.cos(radians)
+
+        slab = np.searchsorted(self.slab_bounds, m, side='right') - 1
+        slab = np.clip(slab, 0, len(self.slab_bounds) - 1)
+        slab[vertical] = len(self.slab_bounds) - 1
+        lo = self._slab_ptr[slab]
+        hi = self._slab_ptr[slab + 1]
+        first = lo.copy()
+        if len(self._slope) == 0:
+            return np.full(len(angles), 0 if self._template_ptr.size > 1 else -1)
+        while True:
+            active = lo < hi
+            if not np.any(active):
+                break
+            mid = (lo + hi) // 2
+            mid_c = np.minimum(mid, len(self._slope) - 1)
+            # For the vertical line x = v, an anchor line is below the query
+            # exactly when its anchor is to the left of the line.
+            below = np.where(vertical,
+                             self._asymptote[mid_c] < -offsets,
+                             self._slope[mid_c] * m + self._intercept[mid_c] < point)
+            lo = np.where(active & below, mid + 1, lo)
+            hi = np.where(active & ~below, mid, hi)
+        empty = first == self._slab_ptr[slab + 1]
+        above = np.maximum(lo - 1, 0)
+        below_first = np.minimum(first, len(self._face_below) - 1)
+        face = np.where(lo > first, self._face_above[above], self._face_below[below_first])
+        face[empty] = -1
+        return face
+
+    def barcode_arrays(self, slices):
+        """Computes the fibered barcodes of the lines in `slices`.
+
+        :param slices: sequence of (angle in degrees, offset) pairs
+        :return: (indptr, births, deaths, multiplicities), where the bars of
+            the i-th line are at indices indptr[i]:indptr[i + 1]
+        """
+        slices = np.asarray(slices, dtype=np.float64).reshape(-1, 2)
+        angles, offsets = slices[:, 0], slices[:, 1]
+        faces = self.locate(angles, offsets)
+        valid = faces >= 0
+        starts = np.where(valid, self._template_ptr[np.maximum(faces, 0)], 0)
+        counts = np.where(valid, np.diff(self._template_ptr)[np.maximum(faces, 0)], 0)
+        line = np.repeat(np.arange(len(slices)), counts)
+        bars = self._template_bars[np.repeat(starts, counts) + arrays.ranges(counts)]
+
+        births = self._project(bars[:, 0], angles[line], offsets[line])
+        deaths = np.full(len(bars), np.inf)
+        finite = bars[:, 1] >= 0
+        deaths[finite] = self._project(bars[finite, 1], angles[line[finite]],
+                                       offsets[line[finite]])
+        keep = births < deaths
+        line = line[keep]
+        indptr = np.searchsorted(line, np.arange(len(slices) + 1))
+        return indptr, births[keep], deaths[keep], bars[keep, 2].astype(np.float64)
+
+    def barcodes(self, slices):
+        """Like `rivet.barcodes`, but computed in-process.
+
+        :return: a list of ((angle, offset), Barcode) pairs"""
+        indptr, births, deaths, mults = self.barcode_arrays(slices)
+        result = []
+        for i, (angle, offset) in enumerate(slices):
+            lines = slice(indptr[i], indptr[i + 1])
+            code = barcode.Barcode.from_arrays(births[lines], deaths[lines], mults[lines])
+            result.append(((float(angle), float(offset)), code))
+        return result
+
+    def _project(self, points, angles, offsets):
+        """The position along each line of the least point on the line that
+        is at or above the given template points, in RIVET's parameterization
+        (distance from the line's y-intercept for non-negative offsets,
+        otherwise from its x-intercept)"""
+        px = self.x_grades[self.template_points[points, 0]]
+        py = self.y_grades[self.template_points[points, 1]]
+        result = np.full(len(points), np.inf)
+
+        horizontal = angles == 0
+        ok = horizontal & (py <= offsets)
+        result[ok] = px[ok]
+        vertical = angles == 90
+        ok = vertical & (px <= -offsets)
+        result[ok] = py[ok]
+
+        general = ~horizontal & ~vertical
+        radians = np.radians(angles[general])
+        m = np.tan(radians)
+        c = offsets[general] / np.cos(radians)
+        x, y = px[general], py[general]
+        # Push the point up to the line if it is below, otherwise right
+        up = y <= m * x + c
+        qx = np.where(up, x, (y - c) / m)
+        qy = np.where(up, m * x + c, y)
+        result[general] = np.where(offsets[general] >= 0,
+                                   qx / np.cos(radians),
+                                   qy / np.sin(radians))
+        return result
+
+
+def _list(value):
+    if not isinstance(value, list):
+        raise module_reader.FormatError("Expected an array, not %r" % (value,))
+    return value
+
+
+def _struct(value, size, what):
+    """A struct RIVET packed as the array of its `size` fields"""
+    if not isinstance(value, list) or len(value) != size:
+        raise module_reader.FormatError("Unexpected %s %r" % (what, value))
+    return value
+
+
+def _unsigned(value):
+    if type(value) is not int or value < 0:
+        raise module_reader.FormatError("Expected an unsigned integer, not %r" % (value,))
+    return value
+
+
+def _id(value):
+    """Decodes an id of a half edge, vertex, anchor or face, which RIVET
+    packs as a struct of one signed integer, -1 if there is none"""
+    value = _struct(value, 1, 'id')[0]
+    if type(value) is not int or value < -1:
+        raise module_reader.FormatError("Unexpected id %r" % (value,))
+    return value
+
+
+def _coordinate(value):
+    """Decodes a double, which may be infinite"""
+    if type(value) is not float:
+        raise module_reader.FormatError("Expected a double, not %r" % (value,))
+    return value
+
+
+def _decode_anchor(anchor):
+    """The x and y grade indexes of an anchor, packed as [x, y, dual line,
+    position, above line, weight]"""
+    x, y, dual_line, position, above_line, weight = _struct(anchor, 6, 'anchor')
+    _id(dual_line)
+    _unsigned(position)
+    _unsigned(weight)
+    if type(above_line) is not bool:
+        raise module_reader.FormatError("Unexpected anchor %r" % (anchor,))
+    return _unsigned(x), _unsigned(y)
+
+
+def _decode_template(face):
+    """The barcode template of a face, packed as [boundary, template,
+    visited], where the template is [bars] and each bar is [begin, end,
+    multiplicity]. Ends of infinite bars are `_INFINITE_END`, and become
+    -1."""
+    boundary, template, visited = _struct(face, 3, 'face')
+    _id(boundary)
+    if type(visited) is not bool:
+        raise module_reader.FormatError("Unexpected face %r" % (face,))
+    bars = [[_unsigned(v) for v in _struct(bar, 3, 'bar template')]
+            for bar in _list(_struct(template, 1, 'barcode template')[0])]
+    return [[begin, -1 if end == _INFINITE_END else end, multiplicity]
+            for begin, end, multiplicity in bars]
+
+
+def _validate(edges, n_vertices, n_anchors, n_faces, templates, n_points):
+    n = len(edges)
+    if n == 0:
+        return
+    twins = edges[:, _TWIN]
+    if np.any((twins < 0) | (twins >= n)) or np.any(twins[twins] != np.arange(n)):
+        raise module_reader.FormatError("Half edge twins are inconsistent")
+    if np.any((edges[:, _ORIGIN] < 0) | (edges[:, _ORIGIN] >= n_vertices)):
+        raise module_reader.FormatError("Half edge origin out of range")
+    if np.any(edges[:, _ANCHOR] >= n_anchors) or np.any(edges[:, _FACE] >= n_faces):
+        raise module_reader.FormatError("Half edge anchor or face out of range")
+    for t in templates:
+        for begin, end, _ in t:
+            if begin >= n_points or end >= n_points:
+                raise module_reader.FormatError("Barcode template refers to a missing template point")
@@ -0,0 +1,13 @@
+import numpy as np
+
+"""Vectorized helpers for the flat, offset-indexed arrays used throughout
+the package in place of per-item Python lists."""
+
+
+def ranges(counts):
+    """concatenate([arange(c) for c in counts]), vectorized"""
+    total = int(np.sum(counts))
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    return np.arange(total) - np.repeat(starts, counts)
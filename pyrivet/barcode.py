@@ -9,6 +9,8 @@ the wrappers for multiple tools
 class Bar(object):
     """A single bar, which should be contained in a Barcode"""
 
+    __slots__ = ('start', 'end', 'multiplicity')
+
     def __init__(self, start, end, multiplicity):
         """Constructor. Takes start/birth, end/death, and multiplicity."""
         self.start = start
@@ -28,19 +30,140 @@ class Bar(object):
 
 
 class Barcode(object):
-    """A collection of bars"""
+    """A collection of bars.
+
+    The bars are stored as three contiguous, read-only columns of starts,
+    ends and multiplicities, so a Barcode doesn't change once built, and
+    can be hashed. Bar objects are only created when the barcode is
+    iterated over, or `bars` is read."""
+
+    __slots__ = ('_columns',)
 
     def __init__(self, bars=None):
         if bars is None:
             bars = []
-        self.bars = bars
+        columns = np.array([(b.start, b.end, b.multiplicity) for b in bars],
+                           dtype=np.float64).reshape(-1, 3).T
+        self._set_columns(np.ascontiguousarray(columns))
+
+    @staticmethod
+    def from_arrays(starts, ends, multiplicities):
+        """Builds a Barcode from arrays of starts, ends and multiplicities,
+        without creating any Bar objects"""
+        columns = np.empty((3, len(starts)), dtype=np.float64)
+        columns[0] = starts
+        columns[1] = ends
+        columns[2] = np.round(multiplicities)
+        code = Barcode.__new__(Barcode)
+        code._set_columns(columns)
+        return code
+
+    def _set_columns(self, columns):
+        # Views of the columns are handed out, so they must not change
+        columns.flags.writeable = False
+        self._columns = columns
+
+    @property
+    def starts(self):
+        return self._columns[0]
+
+    @property
+    def ends(self):
+        return self._columns[1]
+
+    @property
+    def multiplicities(self):
+        return self._columns[2]
+
+    @property
+    def bars(self):
+        """A tuple of the bars in this barcode, built on each access.
+        Changing its bars doesn't change the barcode; build a new one
+        instead, e.g. with `from_arrays`."""
+        return tuple(self)
+
+    def __len__(self):
+        return self._columns.shape[1]
+
+    def __iter__(self):
+        for start, end, multiplicity in zip(*self._columns.tolist()):
+            yield Bar(start, end, multiplicity)
+
+    def __eq__(self, other):
+        if not isinstance(other, Barcode):
+            return NotImplemented
+        return np.array_equal(self._columns, other._columns)
+
+    def __hash__(self):
+        # Adding 0.0 turns -0.0 into 0.0, which compare equal
+        return hash((len(self), (self._columns + 0.0).tobytes()))
 
     def __repr__(self):
-        return "Barcode(%s)" % self.bars
+        return "Barcode(%s)" % list(self)
 
     def expand(self):
-        return Barcode([be for b in self.bars for be in b.expand()])
+        counts = np.maximum(self.multiplicities, 0).astype(np.int64)
+        return Barcode.from_arrays(np.repeat(self.starts, counts),
+                                   np.repeat(self.ends, counts),
+                                   np.ones(int(np.sum(counts))))
+
+    def collapse(self):
+        """Returns an equivalent Barcode in which each distinct bar appears
+        once, with the multiplicities of its copies summed. Bars with
+        multiplicity zero or less are dropped."""
+        keep = self.multiplicities > 0
+        if not keep.any():
+            return Barcode()
+        bars, inverse = np.unique(self._columns[:2, keep].T, axis=0, return_inverse=True)
+        multiplicities = np.bincount(inverse.ravel(), weights=self.multiplicities[keep],
+                                     minlength=len(bars))
+        return Barcode.from_arrays(bars[:, 0], bars[:, 1], multiplicities)
 
     def to_array(self):
-        """Returns a numpy array [[start1, end1, multiplicity1], [start2, end2, multiplicity2]...]."""
-        return np.array([(b.start, b.end, b.multiplicity) for b in self.bars])
+        """Returns a numpy array [[start1, end1, multiplicity1], [start2, end2, multiplicity2]...].
+        The array is a read-only view of this barcode's columns."""
+        return self._columns.T
+
+
+class BarcodeArrays(object):
+    """Many barcodes in one ragged structure: barcode i consists of the
+    bars indptr[i]:indptr[i + 1] of the `births`, `deaths` and
+    `multiplicities` columns. `slices` is an array of shape (# of barcodes, 2)
+    of the (angle, offset) of the line each barcode was taken along, or None.
+
+    Barcode objects are created only when requested."""
+
+    __slots__ = ('indptr', 'births', 'deaths', 'multiplicities', 'slices')
+
+    def __init__(self, indptr, births, deaths, multiplicities, slices=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.births = np.asarray(births, dtype=np.float64)
+        self.deaths = np.asarray(deaths, dtype=np.float64)
+        self.multiplicities = np.asarray(multiplicities, dtype=np.float64)
+        self.slices = None if slices is None else np.asarray(slices, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        """The Barcode at index i"""
+        if not -len(self) <= i < len(self):
+            raise IndexError("barcode index out of range")
+        i %= len(self)
+        bars = slice(self.indptr[i], self.indptr[i + 1])
+        return Barcode.from_arrays(self.births[bars], self.deaths[bars],
+                                   self.multiplicities[bars])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def sizes(self):
+        """The number of distinct bars in each barcode"""
+        return np.diff(self.indptr)
+
+    def pairs(self):
+        """A list of ((angle, offset), Barcode) pairs, as `rivet.barcodes`
+        returns"""
+        return [((angle, offset), code)
+                for (angle, offset), code in zip(self.slices.tolist(), self)]
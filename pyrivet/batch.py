@@ -0,0 +1,166 @@
+import concurrent.futures
+import os
+
+from . import rivet, transport
+
+"""Computes many datasets with RIVET at once, using a bounded pool of worker
+processes. Results are yielded as they complete, failures are reported per
+item without stopping the batch, and a memory budget keeps large jobs from
+running side by side and exhausting RAM."""
+
+# The module settings passed to each worker, which spawned workers would
+# otherwise reset to their defaults
+_settings = [(rivet, 'rivet_executable'), (rivet, 'rivet_client'), (rivet, 'server_url'),
+             (rivet, 'cache'), (transport, 'temp_dir'), (transport, 'use_memfd')]
+
+
+class BatchItem:
+    """One dataset to compute, with its own parameters"""
+
+    def __init__(self, saveable, homology=0, x=0, y=0, key=None, memory=None):
+        """
+        :param saveable: PointCloud, MetricSpace, or Bifiltration
+        :param homology: int
+        :param x: int
+        :param y: int
+        :param key: anything, passed through to the BatchResult to identify
+            the item. Defaults to its index in the batch.
+        :param memory: int
+            the number of bytes this computation is expected to need. If not
+            given, the batch's memory_estimate is used.
+        """
+        self.saveable = saveable
+        self.homology = homology
+        self.x = x
+        self.y = y
+        self.key = key
+        self.memory = memory
+
+    def __repr__(self):
+        return "BatchItem(%r, homology=%d, x=%d, y=%d, key=%r)" % \
+               (self.saveable, self.homology, self.x, self.y, self.key)
+
+
+class BatchResult:
+    """The outcome of one BatchItem: either `output`, the module bytes, or
+    `error`, the exception raised while computing it"""
+
+    def __init__(self, index, key, output=None, error=None):
+        self.index = index
+        self.key = key
+        self.output = output
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "BatchResult(index=%d, key=%r, %d bytes)" % \
+                   (self.index, self.key, len(self.output))
+        return "BatchResult(index=%d, key=%r, error=%r)" % (self.index, self.key, self.error)
+
+
+def estimate_memory(saveable):
+    """A rough estimate of the memory RIVET needs for a dataset, in bytes.
+
+    Point clouds and metric spaces are dominated by pairwise distances, so
+    grow quadratically in the number of points; bifiltrations grow linearly
+    in the number of simplices."""
+    if isinstance(saveable, rivet.PointCloud):
+        return 8 * len(saveable.points) ** 2
+    if isinstance(saveable, rivet.MetricSpace):
+        return 8 * saveable.size ** 2
+    if isinstance(saveable, rivet.Bifiltration):
+        return 256 * len(saveable)
+    return 0
+
+
+def available_memory():
+    """The physical memory currently available, in bytes, or None if it
+    can't be determined"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def compute_batch(items, homology=0, x=0, y=0, workers=None, memory_limit=None,
+                  memory_estimate=estimate_memory, verify=False, mp_context=None):
+    """
+    Precomputes many datasets with RIVET in parallel.
+
+    :param items: iterable of PointCloud, MetricSpace, Bifiltration, or
+        BatchItem. Plain datasets use the batch's homology, x and y.
+    :param workers: int
+        the number of worker processes. Defaults to the number of CPUs.
+    :param memory_limit: int
+        the most memory, in bytes, that the items running at once may be
+        expected to use. Defaults to half of the available memory. An item
+        that needs more than the limit on its own is run alone.
+    :param memory_estimate: callable
+        returns the expected memory use of a dataset, for items that don't
+        specify one
+    :param verify: bool
+        as for `rivet.compute_point_cloud`
+    :param mp_context: a multiprocessing context, as for
+        concurrent.futures.ProcessPoolExecutor. Whatever the start method,
+        the workers use the current `rivet.rivet_executable`,
+        `rivet.rivet_client`, `rivet.server_url` and `rivet.cache`, and
+        `transport.temp_dir` and `transport.use_memfd`. The cache statistics
+        of the workers are not collected.
+    :return: a generator of BatchResult, in order of completion
+    """
+    workers = workers or os.cpu_count() or 1
+    if memory_limit is None:
+        available = available_memory()
+        memory_limit = available // 2 if available else None
+    settings = [getattr(module, name) for module, name in _settings]
+    items = iter(enumerate(items))
+    running = {}
+    in_use = 0
+    waiting = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=mp_context) as executor:
+        while True:
+            # Admit as many items as the worker count and memory budget allow
+            while len(running) < workers:
+                if waiting is None:
+                    waiting = next(items, None)
+                    if waiting is None:
+                        break
+                index, item = waiting
+                item = _as_item(item, homology, x, y)
+                memory = item.memory if item.memory is not None else memory_estimate(item.saveable)
+                if running and memory_limit is not None and in_use + memory > memory_limit:
+                    break
+                future = executor.submit(_compute, item.saveable, item.homology,
+                                         item.x, item.y, verify, settings)
+                running[future] = (index, item, memory)
+                in_use += memory
+                waiting = None
+            if not running:
+                return
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, item, memory = running.pop(future)
+                in_use -= memory
+                key = index if item.key is None else item.key
+                error = future.exception()
+                if error is None:
+                    yield BatchResult(index, key, output=future.result())
+                else:
+                    yield BatchResult(index, key, error=error)
+
+
+def _as_item(item, homology, x, y):
+    if isinstance(item, BatchItem):
+        return item
+    return BatchItem(item, homology, x, y)
+
+
+def _compute(saveable, homology, x, y, verify, settings):
+    for (module, name), value in zip(_settings, settings):
+        setattr(module, name, value)
+    return rivet._compute_bytes(saveable, homology, x, y, verify)
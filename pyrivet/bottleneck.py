@@ -0,0 +1,173 @@
+import math
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
+
+"""Bottleneck distances between barcodes, computed in-process with NumPy and
+SciPy rather than by running Hera's bottleneck_dist.
+
+The distance is found by searching over candidate values r, checking at each
+whether the bars can be matched within r. Bars can always be matched to the
+diagonal, so a matching exists exactly when the long bars of each barcode
+(those further than r from the diagonal) can be matched into the other
+barcode. By the Mendelsohn-Dulmage theorem, the two sides can be checked
+separately, each with one Hopcroft-Karp maximum matching on the graph of
+pairs of bars within r of each other, which is found with a k-d tree.
+
+Unlike Hera, empty barcodes and infinite bars need no special handling."""
+
+
+def bottleneck_distance(left, right, relative_error=0):
+    """
+    Computes the bottleneck distance between two barcodes.
+
+    :param left: Barcode
+    :param right: Barcode
+    :param relative_error: float
+        if 0, the exact distance d is computed; otherwise a value between d
+        and (1 + relative_error) * d, which takes fewer matchings to find
+    :return: float
+        inf if the barcodes have different numbers of infinite bars
+    """
+    left_finite, left_essential = _split(left)
+    right_finite, right_essential = _split(right)
+    if len(left_essential) != len(right_essential):
+        return math.inf
+    # Infinite bars can only be matched with each other, best in sorted order
+    essential = float(np.max(np.abs(np.sort(left_essential) - np.sort(right_essential)),
+                             initial=0))
+    return max(essential, _finite_distance(left_finite, right_finite, relative_error))
+
+
+def _split(code):
+    """The finite bars of a Barcode as an array of (start, end) points, and
+    the starts of its infinite bars, with each bar repeated according to its
+    multiplicity. Bars of length zero are dropped."""
+    counts = np.maximum(np.round(code.multiplicities), 0).astype(np.int64)
+    starts = np.repeat(code.starts, counts)
+    ends = np.repeat(code.ends, counts)
+    essential = np.isposinf(ends)
+    finite = ~essential & (starts != ends)
+    return np.column_stack([starts[finite], ends[finite]]), starts[essential]
+
+
+def persistence_lower_bound(left_persistence, right_persistence):
+    """A lower bound on the bottleneck distance between two sets of finite
+    bars, given their persistences (lengths): half the largest difference
+    between the k-th longest bars of each, for any k.
+
+    Bars matched within d differ in length by at most 2d, and bars matched to
+    the diagonal are at most 2d long."""
+    size = max(len(left_persistence), len(right_persistence))
+    return float(sorted_lower_bound(longest_persistence(left_persistence, size),
+                                    longest_persistence(right_persistence, size)))
+
+
+def longest_persistence(persistence, depth):
+    """The `depth` largest of some persistences, largest first, padded with
+    zeros if there are fewer"""
+    result = np.zeros(depth)
+    longest = np.sort(persistence)[::-1][:depth]
+    result[:len(longest)] = longest
+    return result
+
+
+def sorted_lower_bound(left, right):
+    """`persistence_lower_bound`, given the output of `longest_persistence`
+    for each side, with the same depth. Either may be a 2D array with one
+    such row per barcode, to get a bound for each row at once; the bound
+    holds for any depth."""
+    return np.max(np.abs(left - right), axis=-1, initial=0) / 2
+
+
+def _finite_distance(left, right, relative_error):
+    # The distance from each bar to the diagonal
+    left_diagonal = (left[:, 1] - left[:, 0]) / 2
+    right_diagonal = (right[:, 1] - right[:, 0]) / 2
+    # Matching everything to the diagonal gives an upper bound
+    upper = float(max(np.max(left_diagonal, initial=0), np.max(right_diagonal, initial=0)))
+    if len(left) == 0 or len(right) == 0:
+        return upper
+    left_tree = scipy.spatial.cKDTree(left)
+    right_tree = scipy.spatial.cKDTree(right)
+    if not relative_error:
+        return _exact_distance(left_tree, right_tree, left_diagonal, right_diagonal, upper)
+
+    def matchable(r):
+        pairs = left_tree.sparse_distance_matrix(right_tree, r, p=np.inf,
+                                                 output_type='ndarray')
+        return _matchable(pairs['i'], pairs['j'], left_diagonal, right_diagonal, r)
+
+    lower = persistence_lower_bound(2 * left_diagonal, 2 * right_diagonal)
+    if lower == 0:
+        if matchable(0):
+            return 0.0
+        # Every candidate is a difference of coordinates or a distance to the
+        # diagonal, so a positive distance is at least the smallest of these
+        lower = _smallest_candidate(left, right, left_diagonal, right_diagonal)
+    return _approximate_distance(matchable, lower, upper, relative_error)
+
+
+def _exact_distance(left_tree, right_tree, left_diagonal, right_diagonal, upper):
+    """The distance, found by binary search over every candidate value up
+    to `upper`"""
+    pairs = left_tree.sparse_distance_matrix(right_tree, upper, p=np.inf,
+                                             output_type='ndarray')
+    # The distance is the distance between two bars, or from a bar to the
+    # diagonal
+    candidates = np.unique(np.concatenate([pairs['v'], left_diagonal, right_diagonal]))
+    candidates = candidates[candidates <= upper]
+    low, high = 0, len(candidates) - 1
+    while low < high:
+        middle = (low + high) // 2
+        within = pairs['v'] <= candidates[middle]
+        if _matchable(pairs['i'][within], pairs['j'][within], left_diagonal,
+                      right_diagonal, candidates[middle]):
+            high = middle
+        else:
+            low = middle + 1
+    return float(candidates[low])
+
+
+def _approximate_distance(matchable, lower, upper, relative_error):
+    """A value within `relative_error` above the distance, which is in
+    [lower, upper], found by bisecting geometrically with `matchable`"""
+    if matchable(lower):
+        return lower
+    while upper > (1 + relative_error) * lower:
+        middle = math.sqrt(lower * upper)
+        if matchable(middle):
+            upper = middle
+        else:
+            lower = middle
+    return upper
+
+
+def _smallest_candidate(left, right, left_diagonal, right_diagonal):
+    gaps = [left_diagonal[left_diagonal > 0], right_diagonal[right_diagonal > 0]]
+    for axis in range(2):
+        values = np.unique(np.concatenate([left[:, axis], right[:, axis]]))
+        gaps.append(np.diff(values))
+    return float(np.min(np.concatenate(gaps)))
+
+
+def _matchable(rows, columns, left_diagonal, right_diagonal, r):
+    """Whether the bars can be matched within r, given the pairs (rows[k],
+    columns[k]) of left and right bars that are within r of each other"""
+    graph = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)),
+                                    shape=(len(left_diagonal), len(right_diagonal)))
+    return (_covers(graph, np.flatnonzero(left_diagonal > r)) and
+            _covers(graph.T.tocsr(), np.flatnonzero(right_diagonal > r)))
+
+
+def _covers(graph, rows):
+    """Whether some matching in the bipartite graph covers all of `rows`"""
+    if len(rows) == 0:
+        return True
+    graph = graph[rows]
+    if np.any(np.diff(graph.indptr) == 0):
+        return False
+    matching = scipy.sparse.csgraph.maximum_bipartite_matching(graph, perm_type='column')
+    return bool(np.all(matching >= 0))
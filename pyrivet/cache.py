@@ -0,0 +1,301 @@
+import collections
+import dbm
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+"""A content-addressed, on-disk cache for RIVET computation results.
+
+Entries are keyed by a hash of the serialized input data together with the
+parameters (homology, x, y) of the computation, so identical datasets are only
+ever computed once. The cache is bounded in size, evicting the least recently
+used entries first, and can be shared by several processes at once: entries
+are written to a private temporary file and atomically renamed into place."""
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+_ENTRY_SUFFIX = '.rivet'
+_TEMP_PREFIX = '.tmp-'
+# Temporary files older than this were left behind by a writer that died
+_STALE_TEMP_SECONDS = 60 * 60
+_HASH_CHUNK = 1024 * 1024
+
+
+class CacheStats:
+    """Hit, miss and eviction counts for a ModuleCache or DistanceCache, for
+    this process"""
+
+    def __init__(self, hits=0, misses=0, evictions=0):
+        self.hits = hits
+        self.misses = misses
+        self.evictions = evictions
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __repr__(self):
+        return "CacheStats(hits=%d, misses=%d, evictions=%d)" % \
+               (self.hits, self.misses, self.evictions)
+
+
+class ModuleCache:
+    """A directory of precomputed RIVET modules, keyed by input content"""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param directory: str
+            where to keep cached modules. Created if it does not exist.
+        :param max_bytes: int
+            the size cap for the cache. When exceeded, least recently used
+            entries are removed.
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def from_environment():
+        """Returns a ModuleCache configured by the RIVET_CACHE_DIR and
+        RIVET_CACHE_MAX_BYTES environment variables, or None if
+        RIVET_CACHE_DIR is not set"""
+        directory = os.getenv("RIVET_CACHE_DIR")
+        if not directory:
+            return None
+        max_bytes = int(os.getenv("RIVET_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        return ModuleCache(directory, max_bytes)
+
+    def key(self, input_name, *params):
+        """Computes the cache key for the contents of the file `input_name`
+        combined with the computation parameters `params`"""
+        digest = hashlib.sha256()
+        with open(input_name, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(_HASH_CHUNK), b''):
+                digest.update(chunk)
+        digest.update(repr(params).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _ENTRY_SUFFIX)
+
+    def get(self, key, output_name):
+        """Copies the entry for `key` to `output_name`.
+
+        :return: True if the entry was found, False otherwise"""
+        path = self._path(key)
+        try:
+            # Touch the entry first, so it is the last candidate for eviction
+            os.utime(path)
+            shutil.copyfile(path, output_name)
+        except FileNotFoundError:
+            self.stats.misses += 1
+            return False
+        self.stats.hits += 1
+        return True
+
+    def get_bytes(self, key):
+        """Returns the contents of the entry for `key`, or None"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+            with open(path, 'rb') as entry:
+                data = entry.read()
+        except FileNotFoundError:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return data
+
+    def put(self, key, output_name):
+        """Stores a copy of the file `output_name` as the entry for `key`"""
+        with self._writer(key) as entry:
+            with open(output_name, 'rb') as output_file:
+                shutil.copyfileobj(output_file, entry)
+
+    def put_bytes(self, key, data):
+        """Stores `data` as the entry for `key`"""
+        with self._writer(key) as entry:
+            entry.write(data)
+
+    def _writer(self, key):
+        return _AtomicWriter(self, self._path(key))
+
+    def size(self):
+        """The total size in bytes of all entries in the cache"""
+        return sum(size for _, _, size in self._entries())
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        for path, _, _ in self._entries():
+            _remove(path)
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(_ENTRY_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process while we were looking
+                    continue
+                entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        # Oldest access time first
+        entries.sort(key=lambda e: e[1])
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            if _remove(path):
+                self.stats.evictions += 1
+            total -= size
+        self._remove_stale_temps()
+
+    def _remove_stale_temps(self):
+        cutoff = time.time() - _STALE_TEMP_SECONDS
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith(_TEMP_PREFIX):
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            _remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def __repr__(self):
+        return "ModuleCache(%r, max_bytes=%d)" % (self.directory, self.max_bytes)
+
+
+class DistanceCache:
+    """A memo of distances between barcodes, keyed by a hash of the contents
+    of both barcodes and the parameters of the distance. Keys don't depend on
+    the order of the two barcodes, since the distances are symmetric.
+
+    Recently used distances are kept in memory, up to `max_entries`. If
+    `path` is given, every distance is also stored in a dbm database there,
+    which outlives the process and can be reopened later."""
+
+    def __init__(self, max_entries=1 << 20, path=None):
+        """
+        :param max_entries: int
+            the number of distances to keep in memory
+        :param path: str
+            the name of a dbm database to store distances in. Created if it
+            does not exist.
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.stats = CacheStats()
+        self._entries = collections.OrderedDict()
+        self._store = dbm.open(path, 'c') if path else None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(kind, left_digest, right_digest, *params):
+        """Computes the key for the distance `kind` with parameters `params`
+        between barcodes with the given content digests"""
+        digest = hashlib.sha256(repr((kind, params)).encode('utf-8'))
+        for part in sorted((left_digest, right_digest)):
+            digest.update(part)
+        return digest.digest()
+
+    def get(self, key):
+        """Returns the distance for `key`, or None"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            elif self._store is not None:
+                stored = self._store.get(key)
+                if stored is not None:
+                    value = struct.unpack('<d', stored)[0]
+                    self._remember(key, value)
+            if value is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Stores the distance `value` for `key`"""
+        value = float(value)
+        with self._lock:
+            self._remember(key, value)
+            if self._store is not None:
+                self._store[key] = struct.pack('<d', value)
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forgets every distance, in memory and in the database"""
+        with self._lock:
+            self._entries.clear()
+            if self._store is not None:
+                for key in list(self._store.keys()):
+                    del self._store[key]
+
+    def close(self):
+        """Closes the database, if there is one"""
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, eval, etb):
+        self.close()
+
+    def __repr__(self):
+        return "DistanceCache(max_entries=%d, path=%r)" % (self.max_entries, self.path)
+
+
+class _AtomicWriter:
+    """Writes a cache entry to a temporary file in the cache directory, then
+    renames it into place so readers never observe a partial entry"""
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+
+    def __enter__(self):
+        fd, self.temp_name = tempfile.mkstemp(prefix=_TEMP_PREFIX,
+                                              dir=self.cache.directory)
+        self.file = os.fdopen(fd, 'wb')
+        return self.file
+
+    def __exit__(self, etype, eval, etb):
+        self.file.close()
+        if etype is None:
+            os.replace(self.temp_name, self.path)
+            self.cache._evict()
+        else:
+            _remove(self.temp_name)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
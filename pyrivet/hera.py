@@ -1,12 +1,42 @@
+import concurrent.futures
+import functools
+import hashlib
+import io
 import subprocess
 import tempfile
+import operator
 import os
 
 import logging
 import numpy as np
 import socket
+
+from . import barcode, bottleneck, wasserstein
 # note we use a constant instead of inf because of a bug in bottleneck_dist.
-import time
+
+
+# Number of distinct bars formatted at a time when writing Hera input files
+write_chunk_bars = 65536
+
+"""The most Hera processes multi_bottleneck_distance runs at once by default,
+each on a shard of the pairs of barcodes with a similar number of bars.
+Callers that make several calls at once should pass processes=1 instead."""
+max_processes = os.cpu_count() or 1
+
+# The least number of bars in a shard, so small calls use one process
+shard_min_bars = 16384
+
+"""If set, a cache.DistanceCache used to avoid recomputing distances between
+barcodes that have been compared before, by any of the functions here that
+compare single barcodes or lists of them"""
+distance_cache = None
+
+"""How the functions here compute distances when a call doesn't choose:
+'hera' runs Hera's bottleneck_dist and wasserstein_dist, and 'python' uses
+the in-process `bottleneck` and `wasserstein` modules, which need no
+executables. Either way, infinite ends are replaced by `inf`, results are
+capped at `cap`, and empty barcodes are handled alike."""
+default_backend = 'hera'
 
 
 def bottleneck_distance(left,
@@ -15,36 +45,23 @@ def bottleneck_distance(left,
                         cap=10,
                         # Needed to keep hera from crashing, which it does on
                         # some inputs with
-                        relative_error=1e-10
+                        relative_error=1e-10,
                         # default relative_error. This default value is high
                         # enough to prevent it.
+                        backend=None
                         ):
+    """
+    :param backend: str
+        'hera' or 'python', `default_backend` if None
+    """
     # Hera crashes when one or both barcodes are empty
-    if len(left.bars) == 0 or len(right.bars) == 0:
-        if len(left.bars) == 0 and len(right.bars) == 0:
+    if len(left) == 0 or len(right) == 0:
+        if len(left) == 0 and len(right) == 0:
             return 0
         return cap
     else:
-        with tempfile.TemporaryDirectory() as temp:
-            t1_name = os.path.join(temp, 'self.txt')
-            t2_name = os.path.join(temp, 'other.txt')
-            with open(t1_name, 'wt') as t1:
-                for bar in left.bars:
-                    t1.writelines(["%s %s\n" %
-                                   (bar.start, min(inf, bar.end))
-                                   for _ in range(bar.multiplicity)])
-            with open(t2_name, 'wt') as t2:
-                for bar in right.bars:
-                    t2.writelines(["%s %s\n" %
-                                   (bar.start, min(inf, bar.end))
-                                   for _ in range(bar.multiplicity)])
-            if relative_error is None:
-                dist = subprocess.check_output(
-                    ["bottleneck_dist", t1_name, t2_name])
-            else:
-                dist = subprocess.check_output(
-                    ["bottleneck_dist", t1_name, t2_name, str(relative_error)])
-            return min(cap, float(dist))
+        return min(cap, _cached_distance("bottleneck_dist", left, right, inf, relative_error,
+                                         backend=backend))
 
 # note we use a constant instead of inf because of a bug in bottleneck_dist.
 
@@ -55,46 +72,289 @@ def multi_bottleneck_distance(lefts,
                               cap=10,
                               # Needed to keep hera from crashing, which it
                               # does on some inputs with
-                              relative_error=1e-10
+                              relative_error=1e-10,
                               # default relative_error. This default value is
                               # high enough to prevent it.
+                              processes=None,
+                              backend=None
                               ):
+    """
+    The bottleneck distance between each pair of barcodes in two lists.
+
+    :param processes: int
+        the most Hera processes to run at once, `max_processes` if None.
+        Callers that already make several calls at once should pass 1.
+    :param backend: str
+        'hera' or 'python', `default_backend` if None. The python backend
+        runs in this process, one pair at a time.
+    """
     if not len(lefts) == len(rights):
         raise ValueError("Lengths of `lefts` and `rights` must match")
+    backend = _backend(backend)
+    cache = distance_cache
+    left_diagrams, right_diagrams, keys, distances, missing = _multi_plan(
+        cache, _cache_name("bottleneck_dist", backend), lefts, rights, inf, relative_error)
+    computed = []
+    if missing:
+        lefts = [left_diagrams[i] for i in missing]
+        rights = [right_diagrams[i] for i in missing]
+        if backend == 'python':
+            computed = _python_distances("bottleneck_dist", lefts, rights, inf, relative_error)
+        else:
+            computed = _sharded_distances("bottleneck_dist", lefts, rights, inf,
+                                          relative_error, processes=processes)
+    return _multi_results(cache, keys, distances, missing, computed, cap)
+
+
+def _backend(backend):
+    backend = default_backend if backend is None else backend
+    if backend not in ('hera', 'python'):
+        raise ValueError("backend must be 'hera' or 'python', not %r" % (backend,))
+    return backend
+
+
+def _cache_name(executable, backend):
+    """The name under which distances computed for `executable` by `backend`
+    are cached, as the backends may differ in the last digits"""
+    return executable if backend == 'hera' else 'python-' + executable
+
+
+def _python_distances(executable, lefts, rights, inf, relative_error, *args):
+    """Like `_multi_distances`, but computed in-process by the `bottleneck`
+    or `wasserstein` module, on the same diagrams Hera would read: with ends
+    replaced by `inf`, so that infinite bars match as they do in Hera"""
+    distances = []
+    for left, right in zip(lefts, rights):
+        left, right = [barcode.Barcode.from_arrays(starts, np.minimum(inf, ends), multiplicities)
+                       for starts, ends, multiplicities in (left, right)]
+        if executable == "bottleneck_dist":
+            distances.append(bottleneck.bottleneck_distance(left, right, relative_error or 0))
+        else:
+            distances.append(wasserstein.wasserstein_distance(left, right, *args))
+    return distances
+
+
+def _multi_plan(cache, executable, lefts, rights, inf, relative_error, *args):
+    """Prepares to compare each pair of barcodes in two lists, collapsing
+    each barcode once, into the diagram Hera sees.
+
+    With a cache, the diagrams are hashed, and identical pairs (in either
+    order) and pairs in the cache are only computed once. Without one, every
+    pair is computed.
+
+    :return: (left_diagrams, right_diagrams, keys, distances, missing)
+        pair i has key keys[i]; `distances` holds those already known, by
+        key, and `missing` lists the indices of the pairs to compute
+    """
+    left_diagrams = [_hera_bars(code) for code in lefts]
+    right_diagrams = [_hera_bars(code) for code in rights]
+    keys = [None] * len(lefts)
+    if cache is not None:
+        keys = [cache.key(executable, _diagram_digest(left), _diagram_digest(right),
+                          inf, relative_error, *args)
+                for left, right in zip(left_diagrams, right_diagrams)]
+    return (left_diagrams, right_diagrams) + _cache_plan(cache, keys)
+
+
+def _cache_plan(cache, keys):
+    """The keys, distances and missing pairs of `_multi_plan`, given the
+    cache key of each pair, which are only used with a cache"""
+    if cache is None:
+        return range(len(keys)), {}, list(range(len(keys)))
+    distances = {}
+    for key in set(keys):
+        distance = cache.get(key)
+        if distance is not None:
+            distances[key] = distance
+    missing = {}
+    for i, key in enumerate(keys):
+        if key not in distances and key not in missing:
+            missing[key] = i
+    return keys, distances, list(missing.values())
+
+
+def _multi_results(cache, keys, distances, missing, computed, cap):
+    """The capped distances for a `_multi_plan`, given the uncapped
+    distances computed for its missing pairs, which are cached"""
+    for i, distance in zip(missing, computed):
+        distances[keys[i]] = distance
+        if cache is not None:
+            cache.put(keys[i], distance)
+    return [min(cap, distances[key]) for key in keys]
+
+
+def _multi_distances(executable, lefts, rights, inf, relative_error, *args):
+    """Runs Hera once in multi-diagram mode on two lists of diagrams from
+    `_hera_bars`, returning the uncapped distance between each pair"""
     with tempfile.TemporaryDirectory() as temp:
         t1_name = os.path.join(temp, 'self.txt')
         t2_name = os.path.join(temp, 'other.txt')
-        with open(t1_name, 'wt') as t1:
-            for bars in lefts:
-                for bar in bars.bars:
-                    t1.writelines(["%s %s\n" %
-                                   (bar.start, min(inf, bar.end))
-                                   for _ in range(bar.multiplicity)])
-                t1.write("--\n")
-        with open(t2_name, 'wt') as t2:
-            for bars in rights:
-                for bar in bars.bars:
-                    t2.writelines(["%s %s\n" %
-                                   (bar.start, min(inf, bar.end))
-                                   for _ in range(bar.multiplicity)])
-                t2.write("--\n")
+        _write_multi_diagrams(t1_name, lefts, inf)
+        _write_multi_diagrams(t2_name, rights, inf)
         try:
-            if relative_error is None:
-                dists = subprocess.check_output(["bottleneck_dist", t1_name, t2_name])
-            else:
-                dists = subprocess.check_output(
-                    ["bottleneck_dist", t1_name, t2_name, str(relative_error)])
+            dists = subprocess.check_output(
+                _hera_command(executable, t1_name, t2_name, relative_error, *args))
         except Exception as e:
-            error_dir = "error-hera-%s-%d-%s" % (socket.gethostname(), os.getpid(), time.time())
-            os.mkdir(error_dir)
-            with open(os.path.join(error_dir, 'self.txt'), 'wt') as f:
-                f.write(open(t1_name, 'rt').read())
-            with open(os.path.join(error_dir, 'other.txt'), 'wt') as f:
-                f.write(open(t2_name, 'rt').read())
-            logging.error("Failure in invocation of Hera, input files copied to %s for reference",
-                          error_dir, exc_info=e)
+            _preserve_inputs(t1_name, t2_name, e)
             raise
-        return [min(cap, float(d)) for d in dists.splitlines()]
+        return [float(d) for d in dists.splitlines()]
+
+
+def _sharded_distances(executable, lefts, rights, inf, relative_error, *args, processes=None):
+    """Like `_multi_distances`, but splits the pairs into `_shards`, and runs
+    up to `processes` Hera processes at once (`max_processes` if None). If a
+    shard fails, only its inputs are preserved."""
+    shards = _shards(lefts, rights, max_processes if processes is None else processes)
+    if len(shards) == 1:
+        return _multi_distances(executable, lefts, rights, inf, relative_error, *args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        results = executor.map(
+            lambda shard: _multi_distances(executable, lefts[shard], rights[shard], inf,
+                                           relative_error, *args),
+            shards)
+        return [distance for result in results for distance in result]
+
+
+def _shards(lefts, rights, processes):
+    """Splits pairs of diagrams into at most `processes` consecutive slices,
+    with similar numbers of bars and at least `shard_min_bars` in each"""
+    sizes = np.array([len(left[0]) + len(right[0]) for left, right in zip(lefts, rights)],
+                     dtype=np.int64)
+    total = int(np.sum(sizes))
+    shards = max(1, min(processes, len(lefts), total // max(1, shard_min_bars)))
+    if shards == 1:
+        return [slice(0, len(lefts))]
+    # Each shard ends with the pair at which the running total of bars
+    # reaches the next multiple of total / shards
+    ends = np.searchsorted(np.cumsum(sizes), total * np.arange(1, shards) / shards) + 1
+    ends = np.unique(np.clip(ends, 1, len(lefts) - 1)).tolist()
+    return [slice(start, end) for start, end in zip([0] + ends, ends + [len(lefts)])]
+
+
+def _cached_distance(executable, left, right, inf, relative_error, *args, backend=None):
+    """The uncapped distance between two non-empty barcodes, from
+    `distance_cache` if possible"""
+    backend = _backend(backend)
+    if backend == 'python':
+        def compute():
+            return _python_distances(executable, [_hera_bars(left)], [_hera_bars(right)],
+                                     inf, relative_error, *args)[0]
+    else:
+        def compute():
+            return _single_distance(executable, left, right, inf, relative_error, *args)
+    cache = distance_cache
+    if cache is None:
+        return compute()
+    key = cache.key(_cache_name(executable, backend), barcode_digest(left),
+                    barcode_digest(right), inf, relative_error, *args)
+    distance = cache.get(key)
+    if distance is None:
+        distance = compute()
+        cache.put(key, distance)
+    return distance
+
+
+def _single_distance(executable, left, right, inf, relative_error, *args):
+    with tempfile.TemporaryDirectory() as temp:
+        t1_name = os.path.join(temp, 'self.txt')
+        t2_name = os.path.join(temp, 'other.txt')
+        with open(t1_name, 'wt') as t1:
+            _write_bars(t1, *_hera_bars(left, keep_one=True), inf)
+        with open(t2_name, 'wt') as t2:
+            _write_bars(t2, *_hera_bars(right, keep_one=True), inf)
+        return float(subprocess.check_output(
+            _hera_command(executable, t1_name, t2_name, relative_error, *args)))
+
+
+def barcode_digest(code):
+    """A hash of the contents of a Barcode, as Hera sees them: the order of
+    bars, duplicates and bars of length zero make no difference"""
+    return _diagram_digest(_hera_bars(code))
+
+
+def _diagram_digest(diagram):
+    """`barcode_digest` of a diagram from `_hera_bars`"""
+    digest = hashlib.sha256()
+    for column in diagram:
+        digest.update(np.ascontiguousarray(column, dtype=np.float64).tobytes())
+    return digest.digest()
+
+
+def _write_multi_barcodes(name, barcodes, inf):
+    """Writes several barcodes to one file, separated by `--` lines, in the
+    format Hera's multi-diagram mode expects"""
+    _write_multi_diagrams(name, map(_hera_bars, barcodes), inf)
+
+
+def _write_multi_diagrams(name, diagrams, inf):
+    """Like `_write_multi_barcodes`, for diagrams from `_hera_bars`"""
+    with open(name, 'wt') as out:
+        for diagram in diagrams:
+            _write_bars(out, *diagram, inf)
+            out.write("--\n")
+
+
+def _write_multi_arrays(name, codes, inf):
+    """Like `_write_multi_barcodes`, for an array of shape (# of barcodes,
+    # of bars in each code, 3) padded with NaN multiplicities"""
+    with open(name, 'wt') as out:
+        for code in codes:
+            keep = ~np.isnan(code[:, 2]) & (code[:, 0] != code[:, 1])
+            _write_bars(out, code[keep, 0], code[keep, 1], code[keep, 2], inf)
+            out.write("--\n")
+
+
+def _hera_bars(code, keep_one=False):
+    """The starts, ends and multiplicities of the bars of a Barcode that
+    Hera needs to see: duplicates are merged, and bars of length zero, which
+    lie on the diagonal and so don't change any distance, are left out.
+
+    Hera crashes on empty diagrams, so if `keep_one` is true and every bar
+    is of length zero, one of them is kept."""
+    code = code.collapse()
+    keep = code.starts != code.ends
+    if keep_one and len(code) and not keep.any():
+        keep[0] = True
+    return code.starts[keep], code.ends[keep], code.multiplicities[keep]
+
+
+def _write_bars(out, starts, ends, multiplicities, inf):
+    """Writes bars to an open Hera input file, capping ends at `inf`.
+
+    Hera's format has no multiplicity column, so each bar takes one line per
+    unit of multiplicity. The distinct bars are formatted in blocks, and each
+    one's line is repeated as a string, so Python does work per distinct bar
+    rather than per line."""
+    counts = np.maximum(np.round(multiplicities), 0).astype(np.int64)
+    for first in range(0, len(starts), write_chunk_bars):
+        block = slice(first, first + write_chunk_bars)
+        n = len(counts[block])
+        values = np.empty(2 * n)
+        values[0::2] = starts[block]
+        values[1::2] = np.minimum(inf, ends[block])
+        lines = (("%s %s\n" * n) % tuple(values.tolist())).splitlines(True)
+        out.write(''.join(map(operator.mul, lines, counts[block].tolist())))
+
+
+def _hera_command(executable, t1_name, t2_name, relative_error, *args):
+    cmd = [executable, t1_name, t2_name] + [str(a) for a in args]
+    if relative_error is not None:
+        cmd.append(str(relative_error))
+    return cmd
+
+
+def _preserve_inputs(t1_name, t2_name, e):
+    """Copies the input files of a failed Hera invocation to a new directory
+    in the working directory, for reference"""
+    # Shards fail at the same time, so the directory needs a unique name
+    error_dir = tempfile.mkdtemp(prefix="error-hera-%s-%d-" % (socket.gethostname(), os.getpid()),
+                                 dir='.')
+    with open(os.path.join(error_dir, 'self.txt'), 'wt') as f:
+        f.write(open(t1_name, 'rt').read())
+    with open(os.path.join(error_dir, 'other.txt'), 'wt') as f:
+        f.write(open(t2_name, 'rt').read())
+    logging.error("Failure in invocation of Hera, input files copied to %s for reference",
+                  error_dir, exc_info=e)
 
 # note we use a constant instead of inf because of a bug in bottleneck_dist.
 
@@ -121,26 +381,8 @@ def array_bottleneck_distance(lefts,
     with tempfile.TemporaryDirectory() as temp:
         t1_name = os.path.join(temp, 'self.txt')
         t2_name = os.path.join(temp, 'other.txt')
-        with open(t1_name, 'wt') as t1:
-            for code in range(lefts.shape[0]):
-                for bar in range(lefts.shape[1]):
-                    one_bar = lefts[code, bar, :]
-                    if np.isnan(one_bar[2]) or one_bar[0] == one_bar[1]:
-                        continue
-                    t1.writelines(["%s %s\n" %
-                                   (one_bar[0], min(inf, one_bar[1]))] *
-                                  int(one_bar[2]))
-                t1.write("--\n")
-        with open(t2_name, 'wt') as t2:
-            for code in range(rights.shape[0]):
-                for bar in range(rights.shape[1]):
-                    one_bar = rights[code, bar, :]
-                    if np.isnan(one_bar[2]) or one_bar[0] == one_bar[1]:
-                        continue
-                    t2.writelines(["%s %s\n" %
-                                   (one_bar[0], min(inf, one_bar[1]))] *
-                                  int(one_bar[2]))
-                t2.write("--\n")
+        _write_multi_arrays(t1_name, lefts, inf)
+        _write_multi_arrays(t2_name, rights, inf)
         if relative_error is None:
             dists = subprocess.check_output(["bottleneck_dist", t1_name, t2_name])
         else:
@@ -156,36 +398,24 @@ def wasserstein_distance(left,
                          cap=10,
                          # Needed to keep hera from crashing, which it does on
                          # some inputs with
-                         relative_error=1e-10
+                         relative_error=1e-10,
                          # default relative_error. This default value is high
                          # enough to prevent it.
+                         backend=None
                          ):
+    """
+    :param backend: str
+        'hera' or 'python', `default_backend` if None. The python backend
+        computes the exact distance, ignoring `relative_error`.
+    """
     # Hera crashes when one or both barcodes are empty
-    if len(left.bars) == 0 or len(right.bars) == 0:
-        if len(left.bars) == 0 and len(right.bars) == 0:
+    if len(left) == 0 or len(right) == 0:
+        if len(left) == 0 and len(right) == 0:
             return 0
         return cap
     else:
-        with tempfile.TemporaryDirectory() as temp:
-            t1_name = os.path.join(temp, 'self.txt')
-            t2_name = os.path.join(temp, 'other.txt')
-            with open(t1_name, 'wt') as t1:
-                for bar in left.bars:
-                    t1.writelines(["%s %s\n" %
-                                   (bar.start, min(inf, bar.end))
-                                   for _ in range(bar.multiplicity)])
-            with open(t2_name, 'wt') as t2:
-                for bar in right.bars:
-                    t2.writelines(["%s %s\n" %
-                                   (bar.start, min(inf, bar.end))
-                                   for _ in range(bar.multiplicity)])
-            if relative_error is None:
-                dist = subprocess.check_output(
-                    ["wasserstein_dist", t1_name, t2_name, str(degree)])
-            else:
-                dist = subprocess.check_output(
-                    ["wasserstein_dist", t1_name, t2_name, str(degree), str(relative_error)])
-            return min(cap, float(dist))
+        return min(cap, _cached_distance("wasserstein_dist", left, right, inf, relative_error,
+                                         degree, backend=backend))
 
 # note we use a constant instead of inf because of a bug in wasserstein_dist.
 
@@ -213,29 +443,354 @@ def array_wasserstein_distance(lefts,
     with tempfile.TemporaryDirectory() as temp:
         t1_name = os.path.join(temp, 'self.txt')
         t2_name = os.path.join(temp, 'other.txt')
-        with open(t1_name, 'wt') as t1:
-            for code in range(lefts.shape[0]):
-                for bar in range(lefts.shape[1]):
-                    one_bar = lefts[code, bar, :]
-                    if np.isnan(one_bar[2]) or one_bar[0] == one_bar[1]:
-                        continue
-                    t1.writelines(["%s %s\n" %
-                                   (one_bar[0], min(inf, one_bar[1]))] *
-                                  int(one_bar[2]))
-                t1.write("--\n")
-        with open(t2_name, 'wt') as t2:
-            for code in range(rights.shape[0]):
-                for bar in range(rights.shape[1]):
-                    one_bar = rights[code, bar, :]
-                    if np.isnan(one_bar[2]) or one_bar[0] == one_bar[1]:
-                        continue
-                    t2.writelines(["%s %s\n" %
-                                   (one_bar[0], min(inf, one_bar[1]))] *
-                                  int(one_bar[2]))
-                t2.write("--\n")
+        _write_multi_arrays(t1_name, lefts, inf)
+        _write_multi_arrays(t2_name, rights, inf)
         if relative_error is None:
             dists = subprocess.check_output(["wasserstein_dist", t1_name, t2_name, str(degree)])
         else:
             dists = subprocess.check_output(
                 ["wasserstein_dist", t1_name, t2_name, str(degree), str(relative_error)])
         return np.array([min(cap, float(d)) for d in dists.splitlines()])
+
+
+def pairwise_bottleneck(barcodes, inf=1e10, cap=10, relative_error=1e-10, out=None,
+                        resume=False, workers=None, chunk_size=4096, backend=None):
+    """
+    Computes the matrix of bottleneck distances between every pair of
+    barcodes in a collection, using Hera's multi-diagram mode.
+
+    Each barcode is formatted once, only pairs (i, j) with i < j are
+    computed, and the pairs are split into chunks that run in up to `workers`
+    bottleneck_dist processes at a time. Pairs found in `distance_cache` are
+    not computed again.
+
+    :param barcodes: list of Barcode
+    :param out: str
+        if given, the name of a .npy file to write the matrix to as it is
+        computed, which is returned memory-mapped. Otherwise an in-memory
+        array is returned.
+    :param resume: bool
+        if true and `out` was partly written by an earlier call with the same
+        barcodes and chunk_size, only the chunks not yet finished are
+        computed. Finished chunks are recorded in a file next to `out`.
+    :param workers: int
+        the number of Hera processes to run at once. Defaults to the number
+        of CPUs.
+    :param chunk_size: int
+        the number of pairs compared by each Hera process
+    :param backend: str
+        'hera' or 'python', `default_backend` if None. The python backend
+        computes each chunk in this process, on one of `workers` threads.
+    :return: 2D array of float, symmetric, with zeros on the diagonal
+    """
+    return _pairwise(_PairwiseChunks(barcodes, "bottleneck_dist", (), inf, cap, relative_error,
+                                     chunk_size, backend),
+                     out, resume, workers)
+
+
+def pairwise_wasserstein(barcodes, degree, inf=1e10, cap=10, relative_error=1e-10,
+                         out=None, resume=False, workers=None, chunk_size=4096, backend=None):
+    """
+    Like `pairwise_bottleneck`, for the Wasserstein distance of the given
+    degree, using wasserstein_dist.
+    """
+    return _pairwise(_PairwiseChunks(barcodes, "wasserstein_dist", (degree,), inf, cap,
+                                     relative_error, chunk_size, backend),
+                     out, resume, workers)
+
+
+def _pairwise(chunks, out, resume, workers):
+    """Fills in the distance matrix of `chunks`, running the chunks not yet
+    done on up to `workers` threads"""
+    matrix, done = _pairwise_storage(out, resume, chunks.n, chunks.count)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(chunks.distances, chunk): chunk
+                   for chunk in np.flatnonzero(done == 0).tolist()}
+        for future in concurrent.futures.as_completed(futures):
+            rows, columns, dists = future.result()
+            matrix[rows, columns] = dists
+            matrix[columns, rows] = dists
+            if out is not None:
+                # The distances must be on disk before the chunk is marked done
+                matrix.flush()
+                done[futures[future]] = 1
+                done.flush()
+    return matrix
+
+
+def _pairwise_storage(out, resume, n, chunk_count):
+    """The distance matrix for `_pairwise`, and an array marking the chunks
+    already computed, both memory-mapped if `out` is given.
+
+    :return: (matrix, done)
+    """
+    if out is None:
+        return np.zeros((n, n)), np.zeros(chunk_count, dtype=np.uint8)
+    done_name = out + '.done.npy'
+    if resume and os.path.exists(out) and os.path.exists(done_name):
+        matrix = np.lib.format.open_memmap(out, mode='r+')
+        done = np.lib.format.open_memmap(done_name, mode='r+')
+        if matrix.shape != (n, n) or done.shape != (chunk_count,):
+            raise ValueError("%s was not written for these barcodes and chunk_size" % out)
+        return matrix, done
+    matrix = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=(n, n))
+    done = np.lib.format.open_memmap(done_name, mode='w+', dtype=np.uint8,
+                                     shape=(chunk_count,))
+    return matrix, done
+
+
+class _PairwiseChunks:
+    """The pairs (i, j) with i < j of a collection of barcodes, in row-major
+    order, split into chunks of `chunk_size` whose distances are computed
+    together"""
+
+    def __init__(self, barcodes, executable, args, inf, cap, relative_error, chunk_size,
+                 backend):
+        self.executable = executable
+        self.args = args
+        self.inf = inf
+        self.cap = cap
+        self.relative_error = relative_error
+        self.chunk_size = chunk_size
+        self.backend = _backend(backend)
+        self.cache = distance_cache
+        self.n = len(barcodes)
+        self.pair_count = self.n * (self.n - 1) // 2
+        self.count = -(-self.pair_count // chunk_size)
+        self.diagrams = [_hera_bars(code) for code in barcodes]
+        self.digests = None
+        if self.cache is not None:
+            self.digests = [_diagram_digest(diagram) for diagram in self.diagrams]
+        # The text of each diagram, ready to be concatenated into input files
+        self.texts = None
+        if self.backend == 'hera':
+            self.texts = []
+            for diagram in self.diagrams:
+                text = io.StringIO()
+                _write_bars(text, *diagram, inf)
+                text.write("--\n")
+                self.texts.append(text.getvalue())
+        # Pair p is in row i when row_starts[i] <= p < row_starts[i + 1]
+        self.row_starts = np.zeros(self.n + 1, dtype=np.int64)
+        np.cumsum(np.arange(self.n - 1, -1, -1), out=self.row_starts[1:])
+
+    def distances(self, chunk):
+        """The capped distances between the pairs in a chunk
+
+        :return: (rows, columns, distances) as arrays
+        """
+        pairs = np.arange(chunk * self.chunk_size,
+                          min(self.pair_count, (chunk + 1) * self.chunk_size))
+        rows = np.searchsorted(self.row_starts, pairs, side='right') - 1
+        columns = pairs - self.row_starts[rows] + rows + 1
+        rows, columns = rows.tolist(), columns.tolist()
+        keys = [None] * len(pairs)
+        if self.cache is not None:
+            name = _cache_name(self.executable, self.backend)
+            keys = [self.cache.key(name, self.digests[i], self.digests[j], self.inf,
+                                   self.relative_error, *self.args)
+                    for i, j in zip(rows, columns)]
+        keys, distances, missing = _cache_plan(self.cache, keys)
+        computed = self._compute([rows[k] for k in missing], [columns[k] for k in missing])
+        return rows, columns, _multi_results(self.cache, keys, distances, missing, computed,
+                                             self.cap)
+
+    def _compute(self, rows, columns):
+        """The uncapped distances between barcodes rows[k] and columns[k]"""
+        if not rows:
+            return []
+        if self.backend == 'python':
+            return _python_distances(self.executable, [self.diagrams[i] for i in rows],
+                                     [self.diagrams[j] for j in columns], self.inf,
+                                     self.relative_error, *self.args)
+        with tempfile.TemporaryDirectory() as temp:
+            t1_name = os.path.join(temp, 'self.txt')
+            t2_name = os.path.join(temp, 'other.txt')
+            with open(t1_name, 'wt') as t1:
+                t1.write(''.join([self.texts[i] for i in rows]))
+            with open(t2_name, 'wt') as t2:
+                t2.write(''.join([self.texts[j] for j in columns]))
+            try:
+                dists = subprocess.check_output(_hera_command(
+                    self.executable, t1_name, t2_name, self.relative_error, *self.args))
+                dists = [float(d) for d in dists.splitlines()]
+                if len(dists) != len(rows):
+                    raise RuntimeError("%s returned %d distances for %d pairs" %
+                                       (self.executable, len(dists), len(rows)))
+            except Exception as e:
+                _preserve_inputs(t1_name, t2_name, e)
+                raise
+        return dists
+
+
+def bottleneck_bounds(left, right, inf=1e10):
+    """
+    Cheap certified bounds on the bottleneck distance between two barcodes,
+    computed without running Hera. See `BottleneckBounds`.
+
+    :return: (lower, upper) tuple of float
+    """
+    lower, upper = BottleneckBounds([right], inf=inf).bounds(left)
+    return float(lower[0]), float(upper[0])
+
+
+class BottleneckBounds:
+    """Summaries of a collection of barcodes, from which lower and upper
+    bounds on the bottleneck distance from any barcode to each of them are
+    computed at once. Threshold and nearest-neighbor queries use the bounds
+    to decide most candidates, and compute exact distances only for the rest.
+
+    The bounds are on the distance multi_bottleneck_distance computes, in
+    which infinite ends are replaced by `inf`, so every bar is finite. If
+    p_k and q_k are the k-th longest bars of each barcode (0 if there are
+    fewer than k), the distance is at least |p_k - q_k| / 2 for every k, and
+    at most half the longest bar, by matching every bar to the diagonal.
+
+    Bars ending at `inf` are best matched to each other, in sorted order of
+    their starts, if each barcode has as many. The largest difference of
+    sorted starts then adds to the upper bound for the other bars, and is a
+    lower bound unless a matching that leaves one of them unpaired costs
+    less, which takes at least half its length, or `inf` less the latest end
+    of the other bars."""
+
+    def __init__(self, barcodes, depth=64, distance=None, inf=1e10):
+        """
+        :param barcodes: list of Barcode
+        :param depth: int
+            the number of longest bars of each barcode used for the lower
+            bound. Any number gives a valid bound; more give tighter bounds.
+        :param distance: callable
+            computes exact distances for lists of left and right barcodes, as
+            multi_bottleneck_distance does. Defaults to
+            multi_bottleneck_distance with no cap.
+        :param inf: float
+            the value infinite ends are replaced by, which must be the one
+            `distance` uses
+        """
+        if not np.isfinite(inf):
+            raise ValueError("inf must be finite, as it is for multi_bottleneck_distance")
+        self.barcodes = list(barcodes)
+        self.depth = depth
+        self.inf = inf
+        self.distance = distance or functools.partial(_uncapped_bottleneck, inf=inf)
+        # The number of exact distances computed by queries so far
+        self.exact_computations = 0
+        summaries = [self._summarize(code) for code in self.barcodes]
+        self.persistence = np.array([s[0] for s in summaries]).reshape(len(summaries), depth)
+        self.longest, self.longest_finite, self.last_death, self.last_essential = \
+            np.array([s[1:5] for s in summaries], dtype=np.float64).reshape(len(summaries), 4).T
+        self.essential_counts = np.array([len(s[5]) for s in summaries], dtype=np.int64)
+        self.essential = np.full((len(summaries), max(self.essential_counts, default=0)), np.nan)
+        for i, summary in enumerate(summaries):
+            self.essential[i, :len(summary[5])] = summary[5]
+
+    def _summarize(self, code):
+        """The `depth` longest bar lengths of a barcode, from
+        `bottleneck.longest_persistence`, the longest length, the longest
+        length and latest end of the bars that end before `inf`, the latest
+        start of those that don't, and the sorted starts of those"""
+        counts = np.maximum(np.round(code.multiplicities), 0).astype(np.int64)
+        ends = np.minimum(code.ends, self.inf)
+        keep = (counts > 0) & (code.starts != ends)
+        starts, ends, counts = code.starts[keep], ends[keep], counts[keep]
+        essential = ends == self.inf
+        lengths = ends - starts
+        order = np.argsort(lengths)[::-1]
+        # Only the longest bars can be among the `depth` longest copies
+        persistence = bottleneck.longest_persistence(
+            np.repeat(lengths[order[:self.depth]], counts[order[:self.depth]])[:self.depth],
+            self.depth)
+        return (persistence,
+                np.max(lengths, initial=0),
+                np.max(lengths[~essential], initial=0),
+                np.max(ends[~essential], initial=-np.inf),
+                np.max(starts[essential], initial=-np.inf),
+                np.sort(np.repeat(starts[essential], counts[essential])))
+
+    def bounds(self, code):
+        """
+        :param code: Barcode
+        :return: (lower, upper) arrays of float, bounds on the bottleneck
+            distance from `code` to each barcode in the collection
+        """
+        (persistence, longest, longest_finite, last_death, last_essential,
+         essential) = self._summarize(code)
+        lower = bottleneck.sorted_lower_bound(self.persistence, persistence)
+        upper = np.maximum(self.longest, longest) / 2
+
+        matching = np.flatnonzero(self.essential_counts == len(essential))
+        shift = np.zeros(len(matching))
+        if len(essential) and len(matching):
+            shift = np.max(np.abs(self.essential[matching, :len(essential)] - essential),
+                           axis=1)
+        # The least cost of a matching that leaves a bar ending at `inf` unpaired
+        detour = np.minimum.reduce([
+            (self.inf - np.maximum(self.last_essential[matching], last_essential)) / 2,
+            self.inf - self.last_death[matching],
+            np.full(len(matching), self.inf - last_death)])
+        lower[matching] = np.maximum(lower[matching], np.minimum(shift, detour))
+        upper[matching] = np.minimum(
+            upper[matching],
+            np.maximum(shift, np.maximum(self.longest_finite[matching], longest_finite) / 2))
+        return lower, upper
+
+    def within(self, code, threshold):
+        """
+        Finds the barcodes within `threshold` of `code`.
+
+        :return: (indices, distances) arrays, where distances are exact
+            except for barcodes whose upper bound alone decided the answer,
+            whose distances are reported as that upper bound
+        """
+        lower, upper = self.bounds(code)
+        accepted = np.flatnonzero(upper <= threshold)
+        undecided = np.flatnonzero((lower <= threshold) & (upper > threshold))
+        exact = self._exact(code, undecided)
+        found = undecided[exact <= threshold]
+        indices = np.concatenate([accepted, found])
+        distances = np.concatenate([upper[accepted], exact[exact <= threshold]])
+        order = np.argsort(indices)
+        return indices[order], distances[order]
+
+    def nearest(self, code, k=1, batch_size=64):
+        """
+        Finds the k barcodes nearest to `code`.
+
+        Candidates are taken in increasing order of their lower bounds, in
+        batches of `batch_size`, and exact distances are computed until no
+        remaining lower bound beats the k-th best distance found.
+
+        :return: (indices, distances) arrays, nearest first
+        """
+        lower, upper = self.bounds(code)
+        k = min(k, len(self.barcodes))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        # No candidate with a lower bound above the k-th smallest upper bound
+        # can be among the nearest
+        cutoff = np.partition(upper, k - 1)[k - 1]
+        candidates = np.flatnonzero(lower <= cutoff)
+        candidates = candidates[np.argsort(lower[candidates], kind='stable')]
+        found = np.zeros(0, dtype=np.int64)
+        distances = np.zeros(0)
+        for start in range(0, len(candidates), batch_size):
+            if len(found) >= k and lower[candidates[start]] > distances[k - 1]:
+                break
+            batch = candidates[start:start + batch_size]
+            found = np.concatenate([found, batch])
+            distances = np.concatenate([distances, self._exact(code, batch)])
+            order = np.argsort(distances, kind='stable')
+            found, distances = found[order], distances[order]
+        return found[:k], distances[:k]
+
+    def _exact(self, code, indices):
+        if len(indices) == 0:
+            return np.zeros(0)
+        self.exact_computations += len(indices)
+        return np.array(self.distance([code] * len(indices),
+                                      [self.barcodes[i] for i in indices.tolist()]),
+                        dtype=np.float64)
+
+
+def _uncapped_bottleneck(lefts, rights, inf):
+    return multi_bottleneck_distance(lefts, rights, inf=inf, cap=np.inf)
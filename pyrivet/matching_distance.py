@@ -1,3 +1,10 @@
+import concurrent.futures
+import functools
+import math
+import numbers
+import os
+import time
+
 import numpy as np
 from pyrivet import rivet, barcode, hera
 
@@ -49,13 +56,14 @@ def find_offsets(slopes, points):
     return dist
 
 
-def matching_distance(module1, module2, grid_size, normalize, fixed_bounds=None):
+def matching_distance(module1, module2, grid_size, normalize, fixed_bounds=None, cap=10,
+                      chunk_size=None):
     """Computes the approximate matching distance between two 2-parameter persistence modules using
     RIVET's command-line interface.
 
     Input:
         module1,module2: RIVET "precomputed" representations of two persistence
-        modules, in Bryn's python bytes format
+        modules, in Bryn's python bytes format or as rivet.PrecomputedModule
 
         grid_size: This is a non-negative integer which should be at least 1.
             We will choose grid_size values of slope and also choose
@@ -70,7 +78,21 @@ def matching_distance(module1, module2, grid_size, normalize, fixed_bounds=None)
             The purpose of this latter option is to allow the user to compute
             matching distances with uniform precision over a large collection of 2-D
             persistence modules, which may exhibit features at different scales.
+
+        cap: the largest bottleneck distance along a line, as for
+            hera.multi_bottleneck_distance.
+
+        chunk_size: None, or a number of lines. If given, the lines are
+            computed in chunks of this size, in decreasing order of their
+            weight. Since no line can contribute more than its weight times
+            cap, the remaining lines are skipped, with their barcodes and
+            bottleneck distances, once the largest weighted distance found is
+            at least that much. The result is the same.
     """
+    if chunk_size is not None and (isinstance(chunk_size, bool) or
+                                   not isinstance(chunk_size, numbers.Integral) or
+                                   chunk_size < 1):
+        raise ValueError("chunk_size must be a positive integer, not %r" % (chunk_size,))
     # First, use fixed_bounds to set the upper right corner and lower-left
     # corner to be considered.
     if fixed_bounds is None:
@@ -87,6 +109,9 @@ def matching_distance(module1, module2, grid_size, normalize, fixed_bounds=None)
     # Now we build up a list of the lines we consider in computing the matching distance.
     # Each line is given as a (slope,offset) pair.
     lines = generate_lines(grid_size, UL, LR)
+    weights = line_weights(lines, normalize, fixed_bounds)
+    if chunk_size is not None:
+        return _early_matching_distance(module1, module2, lines, weights, cap, chunk_size)
 
     # next, for each of the two 2-D persistence modules, get the barcode
     # associated to the list of lines.
@@ -96,12 +121,49 @@ def matching_distance(module1, module2, grid_size, normalize, fixed_bounds=None)
     # first compute the unweighted distance between the pairs
     raw_distances = hera.multi_bottleneck_distance(
         [bars for (_, bars) in multi_bars1],
-        [bars for (_, bars) in multi_bars2]
+        [bars for (_, bars) in multi_bars2],
+        cap=cap
     )
 
+    m_dist = np.max(weights * raw_distances)
+    return m_dist
+
+
+def _early_matching_distance(module1, module2, lines, weights, cap, chunk_size):
+    """The largest weighted bottleneck distance along the lines, computing
+    them in chunks, heaviest first, until the rest can't contribute more"""
+    order = np.argsort(-weights, kind='stable')
+    m_dist = 0.0
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        if m_dist >= weights[chunk[0]] * cap:
+            break
+        chunk_lines = [lines[i] for i in chunk]
+        multi_bars1 = rivet.barcodes(module1, chunk_lines)
+        multi_bars2 = rivet.barcodes(module2, chunk_lines)
+        raw_distances = hera.multi_bottleneck_distance(
+            [bars for (_, bars) in multi_bars1],
+            [bars for (_, bars) in multi_bars2],
+            cap=cap
+        )
+        m_dist = max(m_dist, np.max(weights[chunk] * raw_distances))
+    return m_dist
+
+
+def line_weights(lines, normalize, bounds):
+    """The factor by which the bottleneck distance along each line is
+    multiplied in the matching distance, combining the weight of the line's
+    slope with the stretch due to normalization.
+
+    :param lines: list of (slope, offset) pairs, as from generate_lines
+    :param normalize: bool, as for matching_distance
+    :param bounds: rivet.Bounds, the bounds the lines were generated for
+    :return: 1D array of float
+    """
+    LL = bounds.lower_left
+    UR = bounds.upper_right
     delta_x = UR[0] - LL[0]
     delta_y = UR[1] - LL[1]
-    # now compute matching distance
 
     # to determine the weight of a line with the given slope,
     # we need to take into account both the weight coming from slope of
@@ -120,11 +182,374 @@ def matching_distance(module1, module2, grid_size, normalize, fixed_bounds=None)
     else:
         bottleneck_stretch = 1
 
-    m_dist = np.max(w * raw_distances * bottleneck_stretch)
-    return m_dist
+    return w * bottleneck_stretch
+
+
+def pairwise_matching_distance(modules, grid_size, normalize, fixed_bounds=None,
+                               workers=None, chunk_size=4096):
+    """Computes the matrix of approximate matching distances between every
+    pair of modules in a collection.
+
+    The same lines are used for every pair, so the bounds are computed once
+    per module (unless fixed_bounds is given), the barcodes are queried once
+    per module, and only the bottleneck distances are computed per pair.
+
+    Input:
+        modules: list of RIVET precomputed modules, as for matching_distance
+
+        grid_size, normalize: as for matching_distance
+
+        fixed_bounds is a rivet.Bounds, or None. If None, the common bounds
+            of all the modules are used, so that every pair is compared with
+            the same precision.
+
+        workers: the number of RIVET or Hera processes to run at once.
+            Defaults to the number of CPUs.
+
+        chunk_size: the number of barcode pairs to compare in each Hera
+            process. Several module pairs share a process when there are
+            fewer lines than this.
+
+    Returns a symmetric 2D array with zeros on the diagonal.
+    """
+    n = len(modules)
+    workers = workers or os.cpu_count()
+    matrix = np.zeros((n, n))
+    if n < 2:
+        return matrix
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        if fixed_bounds is None:
+            fixed_bounds = functools.reduce(rivet.Bounds.common_bounds,
+                                            executor.map(rivet.bounds, modules))
+        LL = fixed_bounds.lower_left
+        UR = fixed_bounds.upper_right
+        lines = generate_lines(grid_size, (LL[0], UR[1]), (UR[0], LL[1]))
+        weights = line_weights(lines, normalize, fixed_bounds)
+        codes = [[bars for (_, bars) in multi_bars]
+                 for multi_bars in executor.map(lambda m: rivet.barcodes(m, lines), modules)]
+
+        pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+        pairs_per_call = max(1, chunk_size // len(lines))
+
+        def compare(batch):
+            # The batches already run in parallel
+            raw = hera.multi_bottleneck_distance(
+                [bars for i, _ in batch for bars in codes[i]],
+                [bars for _, j in batch for bars in codes[j]],
+                processes=1)
+            raw = np.reshape(raw, (len(batch), len(lines)))
+            return batch, np.max(weights * raw, axis=1)
+
+        batches = [pairs[k:k + pairs_per_call] for k in range(0, len(pairs), pairs_per_call)]
+        for batch, distances in executor.map(compare, batches):
+            for (i, j), distance in zip(batch, distances):
+                matrix[i, j] = matrix[j, i] = distance
+    return matrix
+
+
+def adaptive_matching_distance(module1, module2, normalize, abs_error=0, rel_error=0.01,
+                               fixed_bounds=None, initial_grid=4, max_lines=None):
+    """Computes the matching distance between two 2-parameter persistence modules to
+    within a guaranteed error, by branch and bound over the lines through the bounds
+    rather than a uniform grid of lines.
+
+    The lines are split into cells of nearby lines, and the weighted bottleneck
+    distance is computed along the center line of each. Along any two lines, the
+    weighted barcodes of a module are those of one complex filtered in two ways, so
+    by stability they differ by at most the largest change, over the bounds, in
+    the weighted position a grade is pushed to on the line. This bounds the distance
+    along every line of a cell by the distance along its center, plus twice a
+    bound on that change found from the corners of the cell. Cells that can't
+    beat the largest distance found so far by more than the error are dropped,
+    and the rest are split in four, until no cells remain. The work needed grows with the share
+    of lines along which the distance is close to the matching distance.
+
+    Input:
+        module1,module2: RIVET precomputed modules, as for matching_distance
+
+        normalize: as for matching_distance
+
+        abs_error, rel_error: the error to certify. The search stops once the
+            matching distance is known to within the larger of abs_error and
+            rel_error times the distance found. At least one must be positive.
+
+        fixed_bounds is a rivet.Bounds, or None, as for matching_distance. The
+            guarantee holds only if the bounds contain all the grades of both
+            modules, as the bounds of the modules themselves do. If normalize
+            is True, the bounds must have positive width and height.
+
+        initial_grid: the number of cells to start with along each side of the
+            slope and offset ranges, on each side of the slope of greatest weight.
+
+        max_lines: the number of lines after which to stop searching, even if
+            the error has not been certified. None for no limit.
+
+    Returns (lower, upper): the largest weighted bottleneck distance found along a
+        line, which is at most the matching distance, and an upper bound on the
+        matching distance. Unless max_lines was reached,
+        upper - lower <= max(abs_error, rel_error * lower).
+    """
+    if abs_error <= 0 and rel_error <= 0:
+        raise ValueError("One of abs_error and rel_error must be positive")
+    if fixed_bounds is None:
+        bounds1 = rivet.bounds(module1)
+        bounds2 = rivet.bounds(module2)
+        fixed_bounds = bounds1.common_bounds(bounds2)
+    if normalize and (fixed_bounds.upper_right[0] <= fixed_bounds.lower_left[0] or
+                      fixed_bounds.upper_right[1] <= fixed_bounds.lower_left[1]):
+        # The normalized weights and bounds divide by the width and height
+        raise ValueError("Can't normalize bounds of zero width or height: %s" % fixed_bounds)
+    regions = _line_regions(fixed_bounds, normalize)
+    edges = np.linspace(0, 1, initial_grid + 1)
+    cells = [_grid_cells(edges * region.p_max, edges) for region in regions]
+    best = 0.0
+    # The largest upper bound of any dropped cell
+    dropped = 0.0
+    lines_evaluated = 0
+    while True:
+        centers = [region.centers(c) for region, c in zip(regions, cells)]
+        lines = [line for region, (p, q) in zip(regions, centers)
+                 for line in region.lines(p, q)]
+        distances = _line_distances(module1, module2, lines, normalize, fixed_bounds)
+        lines_evaluated += len(lines)
+        best = max(best, float(np.max(distances)))
+        if math.isinf(best):
+            return best, best
+        tolerance = max(abs_error, rel_error * best)
+
+        upper = best
+        remaining = []
+        start = 0
+        for region, c, (p, q) in zip(regions, cells, centers):
+            bounds = distances[start:start + len(c)] + 2 * region.variation(c, p, q)
+            start += len(c)
+            keep = bounds > best + tolerance
+            dropped = max(dropped, float(np.max(bounds[~keep], initial=0)))
+            upper = max(upper, dropped, float(np.max(bounds[keep], initial=0)))
+            remaining.append(c[keep])
+        if not any(len(c) for c in remaining) or (
+                max_lines is not None and lines_evaluated >= max_lines):
+            return best, upper
+        cells = [_split_cells(c) for c in remaining]
+
+
+def progressive_matching_distance(module1, module2, normalize, fixed_bounds=None,
+                                  initial_grid_size=3, max_lines=None, time_budget=None):
+    """Estimates the matching distance between two 2-parameter persistence modules
+    from grids of lines of increasing density, yielding the estimate after each
+    grid, so that it can be stopped whenever the estimate is good enough.
+
+    Each grid is generate_lines(slopes, UL, LR, offsets), starting with
+    initial_grid_size slopes and offsets, and refined from n to 2n + 1 slopes
+    and from k to 2k - 1 offsets. Each grid contains the previous one, and only
+    its new lines are computed.
+
+    Input:
+        module1,module2: RIVET precomputed modules, as for matching_distance
+
+        normalize, fixed_bounds: as for matching_distance
+
+        initial_grid_size: the number of slopes and of offsets in the first
+            grid, at least 2
+
+        max_lines: stop before a grid that would take the number of lines
+            computed past this. None for no limit.
+
+        time_budget: stop before starting a grid once this many seconds have
+            passed. None for no limit. A grid already started is finished.
+
+    Yields (lower_bound, estimate, lines_evaluated) after each grid:
+        lower_bound: the largest weighted bottleneck distance along any line so
+            far, which is at most the matching distance
+
+        estimate: lower_bound extrapolated by the change since the previous
+            grid, since the shortfall of a grid's maximum roughly halves with
+            each refinement. This is not a bound.
+
+        lines_evaluated: the number of lines computed so far
+
+    Without a budget, the grids are refined for as long as the generator is
+    consumed.
+    """
+    if initial_grid_size < 2:
+        raise ValueError("initial_grid_size must be at least 2")
+    started = time.monotonic()
+    if fixed_bounds is None:
+        bounds1 = rivet.bounds(module1)
+        bounds2 = rivet.bounds(module2)
+        fixed_bounds = bounds1.common_bounds(bounds2)
+    LL = fixed_bounds.lower_left
+    UR = fixed_bounds.upper_right
+    UL = (LL[0], UR[1])
+    LR = (UR[0], LL[1])
 
+    # The lines of each grid are computed exactly as those of the previous
+    # grid, so the lines found before can be recognized by value
+    distances = {}
+    slope_count = offset_count = initial_grid_size
+    lower_bound = previous = None
+    while True:
+        if max_lines is not None and slope_count * offset_count > max_lines:
+            return
+        lines = [line for line in generate_lines(slope_count, UL, LR, offset_count)
+                 if line not in distances]
+        distances.update(zip(lines, _line_distances(module1, module2, lines, normalize,
+                                                    fixed_bounds).tolist()))
+        previous, lower_bound = lower_bound, max(distances.values())
+        estimate = lower_bound
+        if previous is not None:
+            estimate += lower_bound - previous
+        yield lower_bound, estimate, len(distances)
+
+        slope_count = 2 * slope_count + 1
+        offset_count = 2 * offset_count - 1
+        if time_budget is not None and time.monotonic() - started >= time_budget:
+            return
+
+
+def _line_distances(module1, module2, lines, normalize, bounds):
+    """The weighted bottleneck distance along each line, uncapped"""
+    multi_bars1 = rivet.barcodes(module1, lines)
+    multi_bars2 = rivet.barcodes(module2, lines)
+    raw_distances = hera.multi_bottleneck_distance(
+        [bars for (_, bars) in multi_bars1],
+        [bars for (_, bars) in multi_bars2],
+        cap=np.inf
+    )
+    return line_weights(lines, normalize, bounds) * np.asarray(raw_distances, dtype=np.float64)
 
-def generate_lines(grid_size, upper_left, lower_right):
+
+def _grid_cells(p_edges, u_edges):
+    """The cells of a grid, as rows (p0, p1, u0, u1)"""
+    p0, u0 = np.meshgrid(p_edges[:-1], u_edges[:-1], indexing='ij')
+    p1, u1 = np.meshgrid(p_edges[1:], u_edges[1:], indexing='ij')
+    return np.column_stack([p0.ravel(), p1.ravel(), u0.ravel(), u1.ravel()])
+
+
+def _split_cells(cells):
+    """Splits each cell into four"""
+    p0, p1, u0, u1 = cells.T
+    p = (p0 + p1) / 2
+    u = (u0 + u1) / 2
+    return np.concatenate([np.column_stack([p0, p, u0, u]),
+                           np.column_stack([p0, p, u, u1]),
+                           np.column_stack([p, p1, u0, u]),
+                           np.column_stack([p, p1, u, u1])])
+
+
+def _line_regions(bounds, normalize):
+    """The lines through the bounds that are shallower, and steeper, than the
+    slope of greatest weight"""
+    LL = bounds.lower_left
+    UR = bounds.upper_right
+    delta_x = UR[0] - LL[0]
+    delta_y = UR[1] - LL[1]
+    # The slope of greatest weight
+    crossover = delta_y / delta_x if normalize else 1
+    shallow = _LineRegion((LL[0], UR[0], LL[1], UR[1]), crossover,
+                          1 / delta_y if normalize else 1, steep=False)
+    steep = _LineRegion((LL[1], UR[1], LL[0], UR[0]), 1 / crossover,
+                        1 / delta_x if normalize else 1, steep=True)
+    return shallow, steep
+
+
+class _LineRegion(object):
+    """Lines Y = pX + q, for 0 <= p <= p_max, that meet the box
+    X0 <= X <= X1, Y0 <= Y <= Y1. For shallow lines, (X, Y) is (x, y); for steep
+    lines, it is (y, x).
+
+    A line of the region is given by p and a fraction u of the way across the
+    offsets of lines of slope p that meet the box, so that the region is the
+    square [0, p_max] x [0, 1]. A cell of it is a quadrilateral in (p, q).
+
+    In these coordinates, the position a grade (X, Y) is pushed to on a line,
+    along the line and multiplied by its weight (and by the stretch due to
+    normalization), is `scale * (max(pX + q, Y) - q)` for shallow lines and
+    `scale * max(pX + q, Y)` for steep ones, up to a shift that is the same
+    for every grade. For a fixed grade, this is a convex function of (p, q)."""
+
+    def __init__(self, box, p_max, scale, steep):
+        self.box = box
+        self.p_max = p_max
+        self.scale = scale
+        self.steep = steep
+
+    def offsets(self, p, u):
+        X0, X1, Y0, Y1 = self.box
+        return Y0 - p * X1 + u * (Y1 - Y0 + p * (X1 - X0))
+
+    def centers(self, cells):
+        p = (cells[:, 0] + cells[:, 1]) / 2
+        return p, self.offsets(p, (cells[:, 2] + cells[:, 3]) / 2)
+
+    def lines(self, p, q):
+        """The (slope, offset) of each line, as RIVET takes them"""
+        hypotenuse = np.sqrt(1 + p ** 2)
+        if self.steep:
+            # x = py + q, so y = x / p - q / p
+            slopes = np.degrees(np.arctan2(1, p))
+            offsets = -q / hypotenuse
+        else:
+            slopes = np.degrees(np.arctan(p))
+            offsets = q / hypotenuse
+        return list(zip(slopes.tolist(), offsets.tolist()))
+
+    def _positions(self, p, q, X, Y):
+        positions = np.maximum(p * X + q, Y)
+        if not self.steep:
+            positions -= q
+        return self.scale * positions
+
+    def differences(self, p1, q1, p2, q2):
+        """The greatest and least differences, over grades in the box, between
+        the weighted positions of a grade on the lines (p1, q1) and (p2, q2)"""
+        X0, X1, Y0, Y1 = self.box
+        # The difference is linear between the lines, so it is extreme at a
+        # corner of the box, where a line crosses its edge, or where the lines
+        # cross
+        xs = [X0, X0, X1, X1]
+        ys = [Y0, Y1, Y0, Y1]
+        for p, q in ((p1, q1), (p2, q2)):
+            xs += [X0, X1]
+            ys += [p * X0 + q, p * X1 + q]
+            for Y in (Y0, Y1):
+                xs.append(np.divide(Y - q, p, out=np.full_like(p, X0), where=p > 0))
+                ys.append(Y)
+        crossing = np.divide(q2 - q1, p1 - p2, out=np.full_like(p1, X0), where=p1 != p2)
+        xs.append(crossing)
+        ys.append(p1 * crossing + q1)
+        X = np.clip(np.column_stack([np.broadcast_to(x, len(p1)) for x in xs]), X0, X1)
+        Y = np.clip(np.column_stack([np.broadcast_to(y, len(p1)) for y in ys]), Y0, Y1)
+        difference = (self._positions(p2[:, None], q2[:, None], X, Y) -
+                      self._positions(p1[:, None], q1[:, None], X, Y))
+        return np.max(difference, axis=1), np.min(difference, axis=1)
+
+    def variation(self, cells, p, q):
+        """An upper bound, for each cell, on how far the weighted barcodes of a
+        module along any line in the cell are from those along its center line
+        (p, q), in the bottleneck distance.
+
+        Shifting all the bars along a line doesn't change bottleneck distances
+        between them, so this is half the range of the difference in weighted
+        positions, rather than its largest absolute value."""
+        p0, p1, u0, u1 = cells.T
+        corners = [(p0, self.offsets(p0, u0)), (p0, self.offsets(p0, u1)),
+                   (p1, self.offsets(p1, u0)), (p1, self.offsets(p1, u1))]
+        # Positions are convex in (p, q), so they are at most their largest
+        # value at a corner. They are at least the max of the least values of
+        # the two terms of the max; for steep lines that is the least value at
+        # a corner, but for shallow lines it combines the p of one corner with
+        # the q of another.
+        if not self.steep:
+            corners = [(cp, cq) for cp in (p0, p1) for _, cq in corners]
+        greatest, least = zip(*(self.differences(p, q, cp, cq) for cp, cq in corners))
+        return (np.max(greatest, axis=0) - np.min(least, axis=0)) / 2
+
+
+def generate_lines(grid_size, upper_left, lower_right, offset_count=None):
+    # offset_count is the number of offsets for each slope, grid_size if None
+    if offset_count is None:
+        offset_count = grid_size
     lines = []
     for i in range(grid_size):
         # We will choose `grid_parameter` slopes between 0 and 90;
@@ -138,14 +563,14 @@ def generate_lines(grid_size, upper_left, lower_right):
         LR_offset = find_offset(slope, lower_right)
 
         # Choose the values of offset for this particular choice of slope.
-        if grid_size == 1:
+        if offset_count == 1:
             lines.append((slope, UL_offset - LR_offset))
         # largest and smallest offsets specify lines that touch
         # the upper left and lower right corners of the rectangular region of
         # interest.
         else:
-            for j in range(grid_size):
-                offset = LR_offset + j * (UL_offset - LR_offset) / (grid_size - 1)
+            for j in range(offset_count):
+                offset = LR_offset + j * (UL_offset - LR_offset) / (offset_count - 1)
                 lines.append((slope, float(offset)))
     assert lines
     return lines
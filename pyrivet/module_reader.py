@@ -0,0 +1,190 @@
+import fractions
+import io
+import os
+
+import msgpack
+import numpy as np
+
+from . import rivet
+
+"""A reader for RIVET's msgpack module files (the output of
+`rivet_console ... -f msgpack`), so that bounds, dimensions and Betti numbers
+can be had without starting rivet_console.
+
+The file starts with the line `RIVET_msgpack`, followed by three msgpack
+objects: the input parameters, the template points message (axis labels,
+template points with their Betti numbers, the exact x and y grades, and the
+dimensions of the homology at each grade) and the augmented arrangement."""
+
+HEADER = b'RIVET_msgpack'
+
+# Columns of ModuleData.template_points
+X, Y, BETTI_0, BETTI_1, BETTI_2 = range(5)
+
+
+class FormatError(ValueError):
+    """Raised when a file is not a RIVET msgpack module we can decode"""
+
+
+class ModuleData:
+    """The decoded contents of a RIVET msgpack module file"""
+
+    def __init__(self, parameters, x_label, y_label, template_points,
+                 x_exact, y_exact, homology_dimensions, arrangement_message=None):
+        """
+        :param parameters: the input parameters RIVET recorded, undecoded
+        :param x_label: str
+        :param y_label: str
+        :param template_points: int array of shape (# of points, 5)
+            the x index, y index, and 0th, 1st and 2nd Betti numbers of each
+            template point
+        :param x_exact: list of Fraction, the x grades
+        :param y_exact: list of Fraction, the y grades
+        :param homology_dimensions: int array indexed by [x, y]
+        :param arrangement_message: the augmented arrangement, undecoded, or
+            None if it was not read
+        """
+        self.parameters = parameters
+        self.x_label = x_label
+        self.y_label = y_label
+        self.template_points = template_points
+        self.x_exact = x_exact
+        self.y_exact = y_exact
+        self.x_grades = np.array([float(g) for g in x_exact], dtype=np.float64)
+        self.y_grades = np.array([float(g) for g in y_exact], dtype=np.float64)
+        self.homology_dimensions = homology_dimensions
+        self.arrangement_message = arrangement_message
+
+    def __repr__(self):
+        return "ModuleData(x_label=%r, y_label=%r, %d template points, %d x grades, %d y grades)" % \
+               (self.x_label, self.y_label, len(self.template_points),
+                len(self.x_exact), len(self.y_exact))
+
+    def bounds(self):
+        """The Bounds of the module: the smallest rectangle containing the
+        template points, or all the grades if there are no template points"""
+        if len(self.template_points):
+            xs = self.x_grades[self.template_points[:, X]]
+            ys = self.y_grades[self.template_points[:, Y]]
+        else:
+            xs, ys = self.x_grades, self.y_grades
+        if len(xs) == 0 or len(ys) == 0:
+            return rivet.Bounds((0, 0), (0, 0))
+        return rivet.Bounds((float(xs.min()), float(ys.min())),
+                            (float(xs.max()), float(ys.max())))
+
+    def dimensions(self):
+        return rivet.Dimensions(list(self.x_exact), list(self.y_exact))
+
+    def betti(self):
+        """The MultiBetti for the module, with graded_rank indexed [y, x]
+        as in `rivet.betti`"""
+        xi = []
+        for column in (BETTI_0, BETTI_1, BETTI_2):
+            support = self.template_points[self.template_points[:, column] > 0]
+            xi.append([tuple(int(v) for v in row)
+                       for row in support[:, [X, Y, column]]])
+        return rivet.MultiBetti(self.dimensions(),
+                                self.homology_dimensions.T.astype(np.float64),
+                                *xi)
+
+
+def is_module_file(source):
+    """True if `source` (a file name, PrecomputedModule, or bytes) starts with
+    the RIVET msgpack header"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:len(HEADER)]) == HEADER
+    with open(os.fspath(source), 'rb') as f:
+        return f.read(len(HEADER)) == HEADER
+
+
+def read(source, arrangement=False):
+    """Decodes a RIVET msgpack module.
+
+    :param source: file name, PrecomputedModule, or byte array
+    :param arrangement: bool
+        if true, also read the augmented arrangement, which is by far the
+        largest part of the file and not needed for bounds or Betti numbers
+    :return: ModuleData
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return _read_stream(io.BytesIO(source), arrangement)
+    with open(os.fspath(source), 'rb') as f:
+        return _read_stream(f, arrangement)
+
+
+def _read_stream(stream, arrangement):
+    header = stream.readline().strip()
+    if header != HEADER:
+        raise FormatError("Not a RIVET msgpack module (header was %r)" % header[:40])
+    unpacker = msgpack.Unpacker(stream, raw=False, strict_map_key=False,
+                                unicode_errors='replace', max_buffer_size=0)
+    try:
+        parameters = next(unpacker)
+        message = next(unpacker)
+        arrangement_message = next(unpacker) if arrangement else None
+    except (StopIteration, ValueError) as e:
+        raise FormatError("Truncated or corrupt RIVET msgpack module") from e
+    return _decode_template_points_message(parameters, message, arrangement_message)
+
+
+def _decode_template_points_message(parameters, message, arrangement_message):
+    """Decodes RIVET's TemplatePointsMessage, which is packed as the array
+    [x_label, y_label, template_points, x_exact, y_exact,
+    homology_dimensions], with each template point an array of its x and y
+    indexes and 0th, 1st and 2nd Betti numbers"""
+    if not isinstance(message, list) or len(message) != 6:
+        raise FormatError("Unexpected template points message layout")
+    x_label, y_label, points, x_exact, y_exact, dims = message
+    if not isinstance(x_label, str) or not isinstance(y_label, str):
+        raise FormatError("Unexpected axis labels %r, %r" % (x_label, y_label))
+    if not isinstance(points, list) or \
+            not all(isinstance(p, list) and len(p) == 5 and all(_is_int(v) for v in p)
+                    for p in points):
+        raise FormatError("Unexpected template points")
+    if not isinstance(x_exact, list) or not isinstance(y_exact, list):
+        raise FormatError("Unexpected grades")
+    template_points = np.array(points, dtype=np.int64).reshape(-1, 5)
+    x_exact = [to_fraction(v) for v in x_exact]
+    y_exact = [to_fraction(v) for v in y_exact]
+    if len(template_points) and (
+            np.any(template_points < 0) or
+            np.any(template_points[:, X] >= len(x_exact)) or
+            np.any(template_points[:, Y] >= len(y_exact))):
+        raise FormatError("Template point grade index out of range")
+    return ModuleData(parameters, x_label, y_label, template_points, x_exact, y_exact,
+                      to_matrix(dims, len(x_exact), len(y_exact)), arrangement_message)
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def to_fraction(value):
+    """Converts an exact rational as stored by RIVET to a Fraction.
+
+    RIVET's rationals are arbitrary precision, so each is packed as a
+    [numerator, denominator] pair of decimal strings."""
+    if not isinstance(value, list) or len(value) != 2 or \
+            not all(isinstance(v, str) for v in value):
+        raise FormatError("Unexpected rational %r" % (value,))
+    try:
+        return fractions.Fraction(int(value[0]), int(value[1]))
+    except (ValueError, ZeroDivisionError) as e:
+        raise FormatError("Unexpected rational %r" % (value,)) from e
+
+
+def to_matrix(value, rows, cols):
+    """Converts a matrix as stored by RIVET to a 2D int array.
+
+    RIVET packs a boost::multi_array as [shape, values], with the values in
+    row-major order; the shape must be (rows, cols)."""
+    if not isinstance(value, list) or len(value) != 2 or \
+            not isinstance(value[0], list) or not isinstance(value[1], list):
+        raise FormatError("Unexpected matrix layout")
+    shape, values = value
+    if shape != [rows, cols] or len(values) != rows * cols or \
+            not all(_is_int(v) for v in values):
+        raise FormatError("Cannot interpret matrix of shape %r with %d values as %d x %d" %
+                          (shape, len(values), rows, cols))
+    return np.array(values, dtype=np.int64).reshape((rows, cols))
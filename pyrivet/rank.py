@@ -132,7 +132,8 @@ def rank_norm(module1, module2=None, grid_size=20, fixed_bounds=None,
 
     Input: 
         module1,module2: RIVET "precomputed" representations of
-        a persistence module, in Bryn's python bytes format
+        a persistence module, in Bryn's python bytes format or as
+        rivet.PrecomputedModule
 
         grid_size: This is a non-negative integer which should be at least 2.
         We will compute the norm approximately using a grid_size x grid_size
@@ -1,15 +1,24 @@
-import time
 
 from . import barcode
+from . import module_reader
+from . import arrangement
+from . import arrays
+from . import transport
+from .transport import TempDir
+from .cache import ModuleCache
 import subprocess
 import shlex
 import fractions
 import tempfile
 import os
-import shutil
+import math
+import mmap
+import weakref
 import numpy as np
+import scipy.spatial
 import scipy.spatial.distance as distance
 import json
+import itertools
 from typing import List, Tuple
 
 """An interface for rivet_console, using the command line
@@ -21,15 +30,25 @@ rivet_client = 'rivet-client'
 """If set, use the rivet-client to run jobs on a remote server"""
 server_url = os.getenv("RIVET_SERVER")
 
+"""If set, a ModuleCache used to avoid recomputing the same inputs. Configured
+from the RIVET_CACHE_DIR and RIVET_CACHE_MAX_BYTES environment variables by
+default, but can be replaced or set to None at any time."""
+cache = ModuleCache.from_environment()
+
+
+# Number of values formatted at a time when writing input files
+save_chunk_values = 1 << 20
+
 
 class PointCloud:
     """
     Input format for RIVET point cloud data
     """
     def __init__(self, points, appearance=None, second_param_name=None,
-                 comments=None, max_dist=None):
+                 comments=None, max_dist=None, approximate_max_dist=False):
         """
-        :param points: list of tuples, or 2D numpy array of float or int
+        :param points: list of tuples, 2D numpy array of float or int, or the
+            name of a .npy file, which is memory-mapped rather than loaded
         :param appearance: list or 1D array of float or int
         :param second_param_name: str
         :param comments: str
@@ -37,27 +56,34 @@ class PointCloud:
         :param max_dist:
             a cutoff distance beyond which no calculations will be done. If not
             provided, a maximal distance will be calculated
+        :param approximate_max_dist: bool
+            if true and max_dist is not given, use a fast upper bound on the
+            diameter of the points (see `diameter`) instead of the exact value
         """
         if second_param_name:
             self.second_param_name = second_param_name
         else:
             self.second_param_name = None
-        self.points = np.array(points)
+        if isinstance(points, (str, os.PathLike)):
+            self.points = np.load(points, mmap_mode='r')
+        else:
+            # Memory-mapped arrays stay on disk; anything else is copied, so
+            # later changes to the caller's array don't change the cloud
+            self.points = points if isinstance(points, np.memmap) else np.array(points)
         self._appearance_has_len = hasattr(appearance, '__len__')
         if self._appearance_has_len:
             self.appearance = np.array(appearance)
-            if len(appearance) != len(points):
+            if len(appearance) != len(self.points):
                 raise ValueError('appearance must either be None, a scalar, '
                                  'or a sequence of the same length as the points')
         else:
             self.appearance = appearance
         self.comments = comments
         self.dimension = self.points.shape[1]
-        self.max_dist = max_dist or self._calc_max_dist()
+        self.max_dist = max_dist or self._calc_max_dist(approximate_max_dist)
 
-    def _calc_max_dist(self):
-        # Simplest possible max distance measure
-        return distance.squareform(distance.pdist(self.points)).max()
+    def _calc_max_dist(self, approximate=False):
+        return diameter(self.points, approximate=approximate)
 
     def save(self, out):
         """
@@ -74,30 +100,166 @@ class PointCloud:
             out.write(self.second_param_name + "\n")
         else:
             out.write("no function\n")
-        for i, p in enumerate(self.points):
-            for c in p:
-                out.write('{:f}'.format(c))
-                out.write(" ")
+        columns = self.dimension
+        if self.second_param_name is not None:
+            columns += 1
+        row_format = '%f ' * columns + '\n'
+        # Whole rows, as many as fit in save_chunk_values values
+        block_rows = max(1, save_chunk_values // max(1, columns))
+        for start in range(0, len(self.points), block_rows):
+            block = np.asarray(self.points[start:start + block_rows])
             if self.second_param_name is not None:
                 if self._appearance_has_len:
-                    out.write('{:f} '.format(self.appearance[i]))
+                    appearance = self.appearance[start:start + len(block)]
                 else:
-                    out.write('{:f} '.format(self.appearance or 0))
-            out.write("\n")
+                    appearance = np.full(len(block), self.appearance or 0)
+                block = np.column_stack([block, appearance])
+            # One formatting call per block; '%f' matches '{:f}' exactly
+            out.write((row_format * len(block)) % tuple(block.ravel().tolist()))
         out.write("\n")
 
 
+def diameter(points, approximate=False, chunk_size=2048):
+    """
+    Computes the largest Euclidean distance between any two points, using
+    O(n * chunk_size) memory rather than a full distance matrix.
+
+    :param points: 2D array (possibly memory-mapped) of shape (n, dimension)
+    :param approximate: bool
+        if true, return an upper bound D' on the diameter D in O(n) time,
+        with D <= D' <= min(2, sqrt(dimension)) * D
+    :param chunk_size: int
+        the number of points compared against each other at a time
+    :return: float
+    """
+    n = len(points)
+    if n < 2:
+        return 0.0
+    if approximate:
+        return _diameter_upper_bound(points, chunk_size)
+    dimension = points.shape[1]
+    if dimension == 1:
+        return float(np.max(points) - np.min(points))
+    if dimension <= 3 and n > chunk_size:
+        # The diameter is realized by two vertices of the convex hull
+        try:
+            hull = scipy.spatial.ConvexHull(np.asarray(points, dtype=np.float64))
+            points = hull.points[hull.vertices]
+        except scipy.spatial.QhullError:
+            # Degenerate (e.g. coplanar) inputs, so use every point
+            pass
+    return _blockwise_diameter(points, chunk_size)
+
+
+def _blockwise_diameter(points, chunk_size):
+    result = 0.0
+    n = len(points)
+    for i in range(0, n, chunk_size):
+        left = np.asarray(points[i:i + chunk_size], dtype=np.float64)
+        for j in range(i, n, chunk_size):
+            right = np.asarray(points[j:j + chunk_size], dtype=np.float64)
+            result = max(result, distance.cdist(left, right).max())
+    return float(result)
+
+
+def _diameter_upper_bound(points, chunk_size):
+    # Every point is within r of the first point, so D <= 2r, and the
+    # bounding box diagonal is between D and sqrt(dimension) * D
+    first = np.asarray(points[0], dtype=np.float64)
+    radius = 0.0
+    low = high = first
+    for i in range(0, len(points), chunk_size):
+        block = np.asarray(points[i:i + chunk_size], dtype=np.float64)
+        radius = max(radius, np.sqrt(np.max(np.sum((block - first) ** 2, axis=1))))
+        low = np.minimum(low, block.min(axis=0))
+        high = np.maximum(high, block.max(axis=0))
+    return float(min(2 * radius, np.linalg.norm(high - low)))
+
+
 class Bifiltration:
     def __init__(self, x_label, y_label, simplices, appearances, xreverse=False, yreverse = False):
+        """
+        :param simplices: list of lists of vertex ids
+        :param appearances: for each simplex, a list of the (x, y) grades at
+            which it appears
+        """
+        if len(simplices) != len(appearances):
+            raise ValueError("Appearances and simplices must be the same length")
+        vertices, simplex_offsets = _flatten(simplices, np.int64)
+        grades, appearance_offsets = _flatten(appearances, np.float64)
+        self._init_arrays(x_label, y_label, vertices, simplex_offsets,
+                          grades.reshape(-1, 2), appearance_offsets, xreverse, yreverse)
+
+    @staticmethod
+    def from_arrays(x_label, y_label, vertices, simplex_offsets, grades,
+                    appearance_offsets, xreverse=False, yreverse=False):
+        """
+        Builds a Bifiltration from flat arrays, without any per-simplex
+        Python objects.
+
+        :param vertices: int array, the vertex ids of all simplices, in order
+        :param simplex_offsets: int array of length (# of simplices + 1), so
+            that simplex i is vertices[simplex_offsets[i]:simplex_offsets[i + 1]]
+        :param grades: float array of shape (# of grades, 2)
+        :param appearance_offsets: int array of length (# of simplices + 1),
+            so that simplex i appears at
+            grades[appearance_offsets[i]:appearance_offsets[i + 1]]
+        """
+        if len(simplex_offsets) != len(appearance_offsets):
+            raise ValueError("Appearances and simplices must be the same length")
+        bifiltration = Bifiltration.__new__(Bifiltration)
+        bifiltration._init_arrays(x_label, y_label,
+                                  np.asarray(vertices, dtype=np.int64),
+                                  np.asarray(simplex_offsets, dtype=np.int64),
+                                  np.asarray(grades, dtype=np.float64).reshape(-1, 2),
+                                  np.asarray(appearance_offsets, dtype=np.int64),
+                                  xreverse, yreverse)
+        return bifiltration
+
+    def _init_arrays(self, x_label, y_label, vertices, simplex_offsets, grades,
+                     appearance_offsets, xreverse, yreverse):
         self.x_label = x_label
         self.y_label = y_label
-        self.simplices = simplices
-        self.appearances = appearances
+        self.vertices = vertices
+        self.simplex_offsets = simplex_offsets
+        self.grades = grades
+        self.appearance_offsets = appearance_offsets
         self.xreverse=xreverse
         self.yreverse = yreverse
 
-        if len(simplices) != len(appearances):
+    def __len__(self):
+        return len(self.simplex_offsets) - 1
+
+    @property
+    def simplices(self):
+        """The simplices as a list of lists of vertex ids.
+
+        The bifiltration is kept in flat arrays, so this list is built anew
+        on each access, and changing it in place doesn't change the
+        bifiltration. Assign a new list instead, or use `from_arrays`."""
+        return [self.vertices[self.simplex_offsets[i]:self.simplex_offsets[i + 1]].tolist()
+                for i in range(len(self))]
+
+    @simplices.setter
+    def simplices(self, simplices):
+        if len(simplices) != len(self):
+            raise ValueError("Appearances and simplices must be the same length")
+        self.vertices, self.simplex_offsets = _flatten(simplices, np.int64)
+
+    @property
+    def appearances(self):
+        """The appearances as a list of lists of (x, y) grades, built anew on
+        each access like `simplices`"""
+        return [[tuple(g) for g in
+                 self.grades[self.appearance_offsets[i]:self.appearance_offsets[i + 1]].tolist()]
+                for i in range(len(self))]
+
+    @appearances.setter
+    def appearances(self, appearances):
+        if len(appearances) != len(self):
             raise ValueError("Appearances and simplices must be the same length")
+        grades, self.appearance_offsets = _flatten(appearances, np.float64)
+        self.grades = grades.reshape(-1, 2)
 
     def save(self, out):
         out.write('--datatype bifiltration\n')
@@ -107,29 +269,89 @@ class Bifiltration:
             out.write("--xreverse\n")
         if self.yreverse:
             out.write("--yreverse\n")
-        for i, (simplex, appears) in enumerate(zip(self.simplices, self.appearances)):
-            for v in simplex:
-                out.write('{:d} '.format(v))
-                out.write(" ")
-            out.write('; ')
-            for a in appears:
-                for g in a:
-                    out.write('{:f} '.format(g))
-                    out.write(" ")
-            out.write("\n")
+        vertex_counts = np.diff(self.simplex_offsets)
+        grade_counts = 2 * np.diff(self.appearance_offsets)
+        # Each line is the simplex's vertices, then its grades, so a block's
+        # values are interleaved into one array and formatted at once
+        line_lengths = vertex_counts + grade_counts
+        line_ends = np.cumsum(line_lengths)
+        formats = {}
+        start = 0
+        while start < len(self):
+            done = line_ends[start - 1] if start else 0
+            stop = max(start + 1, int(np.searchsorted(line_ends, done + save_chunk_values,
+                                                      side='right')))
+            counts = list(zip(vertex_counts[start:stop].tolist(),
+                              grade_counts[start:stop].tolist()))
+            for key in counts:
+                if key not in formats:
+                    formats[key] = '%d  ' * key[0] + '; ' + '%f  ' * key[1] + '\n'
+            block_format = ''.join(formats[key] for key in counts)
+
+            lengths = line_lengths[start:stop]
+            line_starts = np.cumsum(lengths) - lengths
+            # Vertex ids stay Python ints, so large ids are written exactly
+            values = np.empty(int(np.sum(lengths)), dtype=object)
+            vc, gc = vertex_counts[start:stop], grade_counts[start:stop]
+            values[np.repeat(line_starts, vc) + arrays.ranges(vc)] = \
+                self.vertices[self.simplex_offsets[start]:self.simplex_offsets[stop]].tolist()
+            values[np.repeat(line_starts + vc, gc) + arrays.ranges(gc)] = \
+                self.grades[self.appearance_offsets[start]:self.appearance_offsets[stop]].ravel().tolist()
+            out.write(block_format % tuple(values.tolist()))
+            start = stop
         out.write("\n")
 
 
+def _flatten(nested, dtype):
+    """Returns the concatenation of the sequences in `nested` as an array,
+    and the offsets of each sequence in it"""
+    lengths = np.fromiter((len(s) for s in nested), dtype=np.int64, count=len(nested))
+    offsets = np.zeros(len(nested) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.array(list(itertools.chain.from_iterable(nested)), dtype=dtype)
+    return flat.ravel(), offsets
+
+
 # To make multi_critical (with no appearance_values), initialize with appearance_values=None
 # TODO: set appearance_values to None by default
 class MetricSpace:
     def __init__(self, appearance_label, distance_label, appearance_values, distance_matrix, comment=None):
-        """distance_matrix must be upper triangular"""
+        """
+        :param distance_matrix: the distances between points, as either a
+            square matrix whose upper triangle is used (nested lists, a 2D
+            numpy array or np.memmap), or a condensed 1D vector of the upper
+            triangle such as `scipy.spatial.distance.pdist` returns
+        """
         self.comment = comment
         self.appearance_label = appearance_label
         self.distance_label = distance_label
         self.appearance_values = appearance_values
         self.distance_matrix = distance_matrix
+        if isinstance(distance_matrix, np.ndarray):
+            self._distances = distance_matrix
+        else:
+            self._distances = np.asarray(distance_matrix, dtype=np.float64)
+        if self._distances.ndim == 1:
+            size = (1 + math.sqrt(1 + 8 * len(self._distances))) / 2
+            if size != int(size):
+                raise ValueError("A condensed distance vector must have n * (n - 1) / 2 entries")
+            self.size = int(size)
+        elif self._distances.ndim == 2 and self._distances.shape[0] == self._distances.shape[1]:
+            self.size = self._distances.shape[0]
+        else:
+            raise ValueError("distance_matrix must be a square matrix or a condensed vector")
+
+    def max_distance(self):
+        if self._distances.size == 0:
+            return 0.0
+        return float(np.max(self._distances))
+
+    def _row(self, row):
+        """The distances from point `row` to the points after it"""
+        if self._distances.ndim == 1:
+            start = row * self.size - row * (row + 1) // 2
+            return self._distances[start:start + self.size - row - 1]
+        return self._distances[row, row + 1:]
 
     def save(self, out):
         out.seek(0)
@@ -141,19 +363,25 @@ class MetricSpace:
             out.write('\n')
         if self.appearance_values is not None:
             out.write(self.appearance_label + '\n')
-            out.write(" ".join(['{:f} '.format(s) for s in self.appearance_values]) + "\n")
+            values = np.asarray(self.appearance_values).tolist()
+            out.write(('%f  ' * len(values))[:-1] % tuple(values) + "\n")
         else:
             out.write("no function\n")
-            out.write(str(len(self.distance_matrix)) + "\n")
+            out.write(str(self.size) + "\n")
         out.write(self.distance_label + '\n')
-        dim = len(self.distance_matrix)
-        max_dist = max(*[self.distance_matrix[i][j] for i in range(dim) for j in range(dim)])
-        out.write('{:f}'.format(max_dist) + '\n')
-        for row in range(dim):
-            for col in range(row + 1, dim):
-                # This line determines the precise representation of the output format.
-                out.write('{:f} '.format(self.distance_matrix[row][col]))
-            out.write('\n')
+        out.write('{:f}'.format(self.max_distance()) + '\n')
+        # Rows get shorter as we go, so blocks hold a bounded number of values
+        row = 0
+        while row < self.size:
+            rows = []
+            count = 0
+            while row < self.size and (not rows or count < save_chunk_values):
+                rows.append(np.asarray(self._row(row), dtype=np.float64))
+                count += len(rows[-1])
+                row += 1
+            # This line determines the precise representation of the output format.
+            row_format = ''.join('%f ' * len(r) + '\n' for r in rows)
+            out.write(row_format % tuple(np.concatenate(rows).tolist()))
 
 
 def compute_point_cloud(cloud, homology=0, x=0, y=0, verify=False):
@@ -186,26 +414,50 @@ def compute_metric_space(metric_space, homology=0, x=0, y=0, verify=False):
     return _compute_bytes(metric_space, homology, x, y, verify)
 
 
+def _save_input(saveable, staging, name='rivet_input_data.txt'):
+    """Stages `saveable` as an input file, returning its path"""
+    return staging.input(name, saveable.save)
+
+
 def _compute_bytes(saveable, homology, x, y, verify):
-    with TempDir() as dir:
-        saveable_name = os.path.join(dir, 'rivet_input_data.txt')
-        with open(saveable_name, 'w+t') as saveable_file:
-            saveable.save(saveable_file)
-        output_name = compute_file(saveable_name,
-                                   homology=homology,
-                                   x=x,
-                                   y=y)
-        with open(output_name, 'rb') as output_file:
-            output = output_file.read()
+    with transport.staging() as staging:
+        saveable_name = _save_input(saveable, staging)
+        output_name = staging.output('rivet_output.rivet')
+        _compute_file(saveable_name, output_name, homology, x, y, 1, staging.pass_fds)
+        output = staging.read(output_name)
         if verify:
             assert bounds(output)
         return output
 
 
-def barcodes(bytes, slices):
+def compute_module(saveable, homology=0, x=0, y=0, directory=None):
+    """
+    Like the compute_* functions, but returns a PrecomputedModule that refers
+    to the file RIVET produced, rather than reading it into memory.
+
+    :param saveable: PointCloud, MetricSpace, or Bifiltration
+    :param directory: str
+        where to keep the module file. Defaults to the system temp directory.
+        The file is removed when the PrecomputedModule is closed or collected.
+    :return: PrecomputedModule
+    """
+    fd, output_name = tempfile.mkstemp(prefix='rivet-module-', suffix='.rivet',
+                                       dir=directory)
+    os.close(fd)
+    try:
+        with transport.staging() as staging:
+            saveable_name = _save_input(saveable, staging)
+            _compute_file(saveable_name, output_name, homology, x, y, 1, staging.pass_fds)
+    except BaseException:
+        os.remove(output_name)
+        raise
+    return PrecomputedModule(output_name, owned=True)
+
+
+def barcodes(module, slices):
     """Returns a Barcode for each (angle, offset) tuple in `slices`.
 
-    :param bytes: byte array
+    :param module: byte array or PrecomputedModule
         RIVET data from one of the compute_* functions in this module
     :param slices: list of (angle in degrees, offset) tuples
         These are the angles and offsets of the lines to draw through the
@@ -216,13 +468,37 @@ def barcodes(bytes, slices):
         instance to each (angle, offset) in the input
     """
 
-    with TempDir() as dir:
-        with open(os.path.join(dir, 'precomputed.rivet'), 'wb') as precomp:
-            precomp.write(bytes)
-        with open(os.path.join(dir, 'slices.txt'), 'wt') as slice_temp:
-            for angle, offset in slices:
-                slice_temp.write("%s %s\n" % (angle, offset))
-        return barcodes_file(precomp.name, slice_temp.name)
+    with transport.staging() as staging:
+        precomp_name = _module_path(module, staging)
+        slice_name = _write_slices(slices, staging)
+        return _parse_barcode_arrays(
+            _check_output(_barcodes_command(precomp_name, slice_name), staging)).pairs()
+
+
+def barcode_arrays(module, slices):
+    """Like `barcodes`, but returns all the barcodes in one
+    barcode.BarcodeArrays, without creating a Barcode per slice.
+
+    :param module: byte array or PrecomputedModule
+    :param slices: list of (angle in degrees, offset) tuples
+    :return: barcode.BarcodeArrays"""
+    with transport.staging() as staging:
+        precomp_name = _module_path(module, staging)
+        slice_name = _write_slices(slices, staging)
+        return _parse_barcode_arrays(
+            _check_output(_barcodes_command(precomp_name, slice_name), staging))
+
+
+def _write_slices(slices, staging):
+    def write(slice_temp):
+        for angle, offset in slices:
+            slice_temp.write("%s %s\n" % (angle, offset))
+    return staging.input('slices.txt', write)
+
+
+def _check_output(cmd, staging):
+    """Runs `cmd`, letting it open the files in `staging`"""
+    return subprocess.check_output(cmd, pass_fds=staging.pass_fds)
 
 
 def _rivet_name(base, homology, x, y):
@@ -230,43 +506,77 @@ def _rivet_name(base, homology, x, y):
     return output_name
 
 
+def _cache_key(input_name, homology, x, y):
+    # The remote client and rivet_console may not produce identical files,
+    # so they are cached separately.
+    kind = 'client' if server_url else 'msgpack'
+    return cache.key(input_name, homology, x, y, kind)
+
+
 def compute_file(input_name, output_name=None, homology=0, x=0, y=0, threads=1):
     if not output_name:
         output_name = _rivet_name(input_name, homology, x, y)
+    return _compute_file(input_name, output_name, homology, x, y, threads)
+
+
+def _compute_file(input_name, output_name, homology, x, y, threads, pass_fds=()):
+    if cache is not None:
+        key = _cache_key(input_name, homology, x, y)
+        if cache.get(key, output_name):
+            return output_name
+    subprocess.check_output(_compute_command(input_name, output_name, homology, x, y, threads),
+                            pass_fds=pass_fds)
+    if cache is not None:
+        cache.put(key, output_name)
+    return output_name
+
+
+def _compute_command(input_name, output_name, homology, x, y, threads):
     if server_url:
         cmd = "%s %s %s -H %d -x %d -y %d --redis %s --threads %d" % \
               (rivet_client, input_name, output_name, homology, x, y, server_url, threads)
     else:
         cmd = "%s %s %s -H %d -x %d -y %d -f msgpack" % \
               (rivet_executable, input_name, output_name, homology, x, y)
-    subprocess.check_output(shlex.split(cmd))
-    return output_name
+    return shlex.split(cmd)
 
 
 def barcodes_file(input_name, slice_name):
-    cmd = "%s %s --barcodes %s" % (rivet_executable, input_name, slice_name)
     return _parse_slices(
         subprocess.check_output(
-            shlex.split(cmd)).split(b'\n'))
+            _barcodes_command(input_name, slice_name)).split(b'\n'))
+
+
+def _barcodes_command(input_name, slice_name):
+    cmd = "%s %s --barcodes %s" % (rivet_executable, input_name, slice_name)
+    return shlex.split(cmd)
 
 
 def betti(saveable, homology=0, x=0, y=0):
     # print("betti")
-    with TempDir() as dir:
-        name = os.path.join(dir, 'rivet-input.txt')
-        with open(name, 'wt') as betti_temp:
-            saveable.save(betti_temp)
-        return betti_file(name, homology=homology, x=x, y=y)
+    with transport.staging() as staging:
+        name = _save_input(saveable, staging, 'rivet-input.txt')
+        return _parse_betti(_check_output(_betti_command(name, homology, x, y),
+                                          staging).split(b'\n'))
 
 
 def betti_file(name, homology=0, x=0, y=0):
+    return _parse_betti(subprocess.check_output(
+        _betti_command(name, homology, x, y)).split(b'\n'))
+
+
+def _betti_command(name, homology, x, y):
     cmd = "%s %s --betti -H %d -x %d -y %d" % (rivet_executable, name, homology, x, y)
-    return _parse_betti(subprocess.check_output(shlex.split(cmd)).split(b'\n'))
+    return shlex.split(cmd)
 
 
 def bounds_file(name):
+    return parse_bounds(subprocess.check_output(_bounds_command(name)).split(b'\n'))
+
+
+def _bounds_command(name):
     cmd = "%s %s --bounds" % (rivet_executable, name)
-    return parse_bounds(subprocess.check_output(shlex.split(cmd)).split(b'\n'))
+    return shlex.split(cmd)
 
 
 class Summary:
@@ -292,6 +602,10 @@ def summarize(saveable, homology=0, x=0, y=0, slices=None, bounds=False, structu
         barcodes_path = output_path + '.barcodes.json'
         with open(input_path, 'wt') as input:
             saveable.save(input)
+        key, invariants = _cached_invariants(input_path, homology, x, y, return_invariants,
+                                             not (slices or bounds or structure))
+        if invariants is not None:
+            return Summary(invariants, None, slices, [], None)
         cmd = "%s %s %s -H %d -x %d -y %d --redis %s --threads %d" % \
               (rivet_client, input_path, output_path, homology, x, y, server_url, threads)
         if slices:
@@ -311,10 +625,7 @@ def summarize(saveable, homology=0, x=0, y=0, slices=None, bounds=False, structu
         if any(output):
             for line in output:
                 print(f"RIVET: {line}")
-        if return_invariants:
-            invariants = open(output_path, 'rb').read()
-        else:
-            invariants = None
+        invariants = _read_invariants(output_path, key) if return_invariants else None
         if bounds:
             bounds = json.load(open(bounds_path))
             bounds = Bounds((bounds['x_low'], bounds['y_low']), (bounds['x_high'], bounds['y_high']))
@@ -327,8 +638,9 @@ def summarize(saveable, homology=0, x=0, y=0, slices=None, bounds=False, structu
                 angle = bc['angle']
                 offset = bc['offset']
                 bars_array = np.array(bc['bars']['data']).reshape(bc['bars']['dim'])
-                bars = [barcode.Bar(row[0], row[1], row[2]) for row in bars_array]
-                barcodes.append(((angle, offset), barcode.Barcode(bars)))
+                code = barcode.Barcode.from_arrays(bars_array[:, 0], bars_array[:, 1],
+                                                   bars_array[:, 2])
+                barcodes.append(((angle, offset), code))
         else:
             barcodes = []
         if structure:
@@ -348,35 +660,187 @@ def summarize(saveable, homology=0, x=0, y=0, slices=None, bounds=False, structu
         return Summary(invariants, structure, slices, barcodes, bounds)
 
 
-class TempDir(os.PathLike):
-    def __enter__(self):
-        self.dirname = os.path.join(tempfile.gettempdir(),
-                                    'rivet-' + str(os.getpid()) + '-' + str(time.time()))
-        os.mkdir(self.dirname)
+def _cached_invariants(input_path, homology, x, y, return_invariants, invariants_only):
+    """The cache key for the invariants `summarize` computes, or None if they
+    aren't cached, and the cached invariants if nothing else was asked for
+    and they are in the cache
 
-        return self
+    :return: (key, invariants)
+    """
+    if cache is None or not return_invariants:
+        return None, None
+    key = _cache_key(input_path, homology, x, y)
+    return key, cache.get_bytes(key) if invariants_only else None
+
+
+def _read_invariants(output_path, key):
+    """Reads the invariants `summarize` computed, caching them under `key`
+    unless it is None"""
+    invariants = open(output_path, 'rb').read()
+    if key is not None:
+        cache.put_bytes(key, invariants)
+    return invariants
+
+
+def bounds(module):
+    """Returns the Bounds of a module, given as a byte array or
+    a PrecomputedModule"""
+    if isinstance(module, PrecomputedModule):
+        return module.bounds()
+    assert len(module) > 0
+    data = _read_module(module)
+    if data is not None:
+        return data.bounds()
+    with transport.staging() as staging:
+        return parse_bounds(_check_output(_bounds_command(_module_path(module, staging)),
+                                          staging).split(b'\n'))
+
+
+def _read_module(source):
+    """Decodes a msgpack module in-process, or returns None if it is in a
+    format only rivet_console can read"""
+    try:
+        if module_reader.is_module_file(source):
+            return module_reader.read(source)
+    except module_reader.FormatError:
+        pass
+    return None
+
+
+def _module_path(module, staging):
+    """Returns the name of a file containing `module`, staging a copy
+    unless it is already a PrecomputedModule"""
+    if isinstance(module, PrecomputedModule):
+        return module.path
+    return staging.input('precomp.rivet', lambda precomp: precomp.write(module), binary=True)
+
+
+class PrecomputedModule(os.PathLike):
+    """A RIVET precomputed module kept in a file on disk.
+
+    Can be used anywhere a module byte array is accepted. The file is handed
+    to rivet_console directly, so queries don't copy the module through
+    memory and a fresh temp file each time, and the bounds and Betti numbers
+    are computed at most once per module."""
+
+    def __init__(self, path, owned=False):
+        """
+        :param path: str
+            the name of a file produced by compute_file
+        :param owned: bool
+            if true, the file is removed when this object is closed or
+            garbage collected
+        """
+        self.path = os.path.abspath(os.fspath(path))
+        self._bounds = None
+        self._betti = None
+        self._data = None
+        self._arrangement = None
+        self._mmap = None
+        self._maps = []
+        self._finalizer = weakref.finalize(self, _close_module, self.path, owned, self._maps)
+
+    @staticmethod
+    def from_bytes(data, directory=None):
+        """Writes a module byte array to a file once, and returns a
+        PrecomputedModule that owns that file"""
+        fd, name = tempfile.mkstemp(prefix='rivet-module-', suffix='.rivet',
+                                    dir=directory)
+        with os.fdopen(fd, 'wb') as module_file:
+            module_file.write(data)
+        return PrecomputedModule(name, owned=True)
+
+    @property
+    def data(self):
+        """A read-only memory map of the module file"""
+        if self._mmap is None:
+            with open(self.path, 'rb') as module_file:
+                self._mmap = mmap.mmap(module_file.fileno(), 0, access=mmap.ACCESS_READ)
+            # The finalizer closes the map before removing the file
+            self._maps.append(self._mmap)
+        return self._mmap
+
+    def __bytes__(self):
+        return bytes(self.data)
+
+    def __len__(self):
+        return os.path.getsize(self.path)
 
-    def __exit__(self, etype, eval, etb):
-        if etype is None:
-            shutil.rmtree(self.dirname, ignore_errors=True)
-        else:
-            print("Error occurred, leaving RIVET working directory intact: " + self.dirname)
+    def __fspath__(self):
+        return self.path
 
-    def __str__(self):
-        return self.dirname
+    def __repr__(self):
+        return "PrecomputedModule(%r)" % self.path
 
-    def __fspath__(self):
-        return self.dirname
+    def __reduce__(self):
+        # Other processes only borrow the file, they never remove it
+        return PrecomputedModule, (self.path,)
 
+    def module_data(self):
+        """The decoded module_reader.ModuleData for this module, or None if
+        the file can't be decoded in-process"""
+        if self._data is None:
+            self._data = _read_module(self.path) or False
+        return self._data or None
 
-def bounds(bytes):
-    # print("bounds", len(bytes), "bytes")
-    assert len(bytes) > 0
-    with TempDir() as dir:
-        precomp_name = os.path.join(dir, 'precomp.rivet')
-        with open(precomp_name, 'wb') as precomp:
-            precomp.write(bytes)
-        return bounds_file(precomp_name)
+    def bounds(self):
+        """The Bounds of this module, computed on first use"""
+        if self._bounds is None:
+            data = self.module_data()
+            self._bounds = data.bounds() if data else bounds_file(self.path)
+        return self._bounds
+
+    def known_bounds(self):
+        """The Bounds of the module if they have been computed or recorded
+        already, otherwise None. Never starts rivet_console."""
+        return self._bounds
+
+    def memoize_bounds(self, bounds):
+        """Records the Bounds of the module, computed elsewhere, for `bounds`
+        to return from now on, as aio.bounds does; returns them"""
+        self._bounds = bounds
+        return bounds
+
+    def betti(self):
+        """The MultiBetti for this module, computed on first use"""
+        if self._betti is None:
+            data = self.module_data()
+            self._betti = data.betti() if data else betti_file(self.path)
+        return self._betti
+
+    @property
+    def dimensions(self):
+        """The Dimensions (x and y grades) of this module"""
+        return self.betti().dimensions
+
+    def arrangement(self):
+        """The augmented arrangement of this module, as an
+        arrangement.Arrangement that answers fibered barcode queries
+        in-process. Decoded on first use."""
+        if self._arrangement is None:
+            self._arrangement = arrangement.Arrangement.from_module(self.path)
+        return self._arrangement
+
+    def close(self):
+        """Releases the memory map, and removes the file if it is owned"""
+        self._mmap = None
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, eval, etb):
+        self.close()
+
+
+def _close_module(path, owned, maps):
+    for m in maps:
+        m.close()
+    if owned:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
 class Bounds:
@@ -513,21 +977,32 @@ def _parse_betti(text):
 
 
 def _parse_slices(text):
-    slices = []
-    for line in text:
-        line = line.strip()
-        if not line:
-            continue
-        header, body = line.split(b':')
-        angle, offset = header.split(b' ')
-        bars = []
-        for part in body.split(b','):
-            part = part.strip()
-            if not part:
-                continue
-            birth, death, mult = part.split(b' ')
-            bars.append(barcode.Bar(float(birth), float(death), int(mult[1:])))
-
-        code = barcode.Barcode(bars)
-        slices.append(((float(angle), float(offset)), code))
-    return slices
+    return _parse_barcode_arrays(b'\n'.join(text)).pairs()
+
+
+# Separators in rivet_console's barcode output, which are all turned into
+# spaces so the whole output can be read as one list of numbers
+_barcode_separators = bytes.maketrans(b':,x', b'   ')
+
+
+def _parse_barcode_arrays(output):
+    """Parses the output of rivet_console --barcodes, which has one line
+    per slice of the form `angle offset: birth death xmult, ...`, in one pass.
+
+    :return: barcode.BarcodeArrays"""
+    lines = [line for line in output.split(b'\n') if line.strip()]
+    # Each bar has exactly one 'x', before its multiplicity
+    counts = np.fromiter((line.count(b'x') for line in lines), dtype=np.int64,
+                         count=len(lines))
+    values = np.fromstring(b' '.join(lines).translate(_barcode_separators).decode('ascii'),
+                           sep=' ')
+    line_sizes = 2 + 3 * counts
+    if len(values) != int(np.sum(line_sizes)):
+        raise ValueError("Could not parse rivet_console barcode output")
+    line_starts = np.cumsum(line_sizes) - line_sizes
+    slices = np.column_stack([values[line_starts], values[line_starts + 1]])
+    indptr = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    bar_starts = np.repeat(line_starts + 2, counts) + 3 * arrays.ranges(counts)
+    return barcode.BarcodeArrays(indptr, values[bar_starts], values[bar_starts + 1],
+                                 values[bar_starts + 2], slices)
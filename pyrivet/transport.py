@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import time
+
+"""How data is handed to and from rivet_console.
+
+On Linux, inputs and outputs are anonymous in-memory files (memfd), which
+the child process opens through /dev/fd paths, so a query never touches the
+file system. rivet_console may open its input more than once (it first
+sniffs the file type), so named pipes, which can only be read once, are not
+used. Elsewhere, or if memfd is disabled, files are staged in `temp_dir`."""
+
+
+"""The directory for staged files and RIVET working directories, from the
+RIVET_TMPDIR environment variable. None means the system temp directory.
+A tmpfs such as /dev/shm is faster than a network /tmp, but holds its files
+in memory, so it is only used if asked for."""
+temp_dir = os.getenv("RIVET_TMPDIR") or None
+
+"""If true, use memfd for staged files where the platform supports it"""
+use_memfd = (hasattr(os, 'memfd_create') and os.path.isdir('/dev/fd')
+             and os.getenv("RIVET_TRANSPORT", "memfd") == "memfd")
+
+
+def staging():
+    """Returns a context manager for staging the files of one RIVET
+    invocation: a MemfdStaging if possible, otherwise a DirectoryStaging"""
+    if use_memfd:
+        return MemfdStaging()
+    return DirectoryStaging()
+
+
+class MemfdStaging:
+    """Stages files as memfds, visible to child processes as /dev/fd paths.
+    Pass `pass_fds` to subprocess so the child inherits them."""
+
+    def __enter__(self):
+        self._fds = {}
+        return self
+
+    def __exit__(self, etype, eval, etb):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+    @property
+    def pass_fds(self):
+        return tuple(self._fds.values())
+
+    def _create(self, name):
+        fd = os.memfd_create(name, 0)
+        path = '/dev/fd/%d' % fd
+        self._fds[path] = fd
+        return path
+
+    def input(self, name, write, binary=False):
+        """Creates a file by calling `write` with a file object, and returns
+        the path the child process should read it from"""
+        path = self._create(name)
+        with open(self._fds[path], 'wb' if binary else 'wt', closefd=False) as f:
+            write(f)
+        return path
+
+    def output(self, name):
+        """Returns a path the child process can write a file to"""
+        return self._create(name)
+
+    def read(self, path):
+        """Returns the contents of a staged file"""
+        fd = self._fds[path]
+        size = os.fstat(fd).st_size
+        return os.pread(fd, size, 0)
+
+
+class DirectoryStaging:
+    """Stages files in a fresh RIVET working directory under `temp_dir`"""
+
+    pass_fds = ()
+
+    def __enter__(self):
+        self._dir = TempDir()
+        self._dir.__enter__()
+        return self
+
+    def __exit__(self, etype, eval, etb):
+        self._dir.__exit__(etype, eval, etb)
+
+    def input(self, name, write, binary=False):
+        path = os.path.join(self._dir.dirname, name)
+        with open(path, 'wb' if binary else 'wt') as f:
+            write(f)
+        return path
+
+    def output(self, name):
+        return os.path.join(self._dir.dirname, name)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def make_temp_dir(prefix):
+    """Creates a fresh directory under `temp_dir`"""
+    return tempfile.mkdtemp(prefix=prefix, dir=temp_dir)
+
+
+class TempDir(os.PathLike):
+    def __enter__(self):
+        # mkdtemp guarantees a fresh name, even for concurrent callers in
+        # one process (threads or coroutines)
+        self.dirname = make_temp_dir('rivet-%d-%s-' % (os.getpid(), time.time()))
+
+        return self
+
+    def __exit__(self, etype, eval, etb):
+        if etype is None:
+            shutil.rmtree(self.dirname, ignore_errors=True)
+        else:
+            print("Error occurred, leaving RIVET working directory intact: " + self.dirname)
+
+    def __str__(self):
+        return self.dirname
+
+    def __fspath__(self):
+        return self.dirname
@@ -0,0 +1,265 @@
+import heapq
+import math
+import random
+
+import numpy as np
+
+from . import barcode
+
+"""A vantage-point tree: an index for nearest-neighbor and range queries
+over items compared by any metric, such as `bottleneck.bottleneck_distance`,
+`wasserstein.wasserstein_distance`, `hilbert_distance.distance`, or the
+matching distance between modules.
+
+Each internal node holds a vantage item and splits the items below it into
+those nearer to it than its radius and those not. Each side also records
+the least and greatest distance of its items from the vantage item, so by
+the triangle inequality a query can skip any side that can't contain a
+close enough item. Items can be added at any time; leaves are split when
+they grow past `leaf_size`."""
+
+
+def encode_barcode(code):
+    """Encodes a Barcode as a 2D float array, for `VPTree.save`"""
+    return code.to_array()
+
+
+def decode_barcode(array):
+    """Decodes a Barcode encoded by `encode_barcode`"""
+    return barcode.Barcode.from_arrays(array[:, 0], array[:, 1], array[:, 2])
+
+
+class VPTree:
+    def __init__(self, metric, items=(), leaf_size=8, seed=None):
+        """
+        :param metric: callable
+            metric(a, b) returns the distance between two items, and must
+            satisfy the triangle inequality for query results to be exact
+        :param items: iterable of items to add
+        :param leaf_size: int
+            the number of items a leaf holds before it is split
+        :param seed: the seed for choosing vantage items
+        """
+        self.metric = metric
+        self.leaf_size = leaf_size
+        self.items = []
+        # The number of calls to the metric so far
+        self.distance_evaluations = 0
+        self._random = random.Random(seed)
+        # Nodes are kept in parallel lists, which are saved as arrays. A leaf
+        # has vantage -1 and a bucket of item indices.
+        self._vantage = []
+        self._radius = []
+        self._children = []
+        self._bounds = []
+        self._buckets = []
+        self._split_at = []
+        self._new_leaf([])
+        self.extend(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _new_leaf(self, bucket):
+        self._vantage.append(-1)
+        self._radius.append(0.0)
+        self._children.append([-1, -1])
+        self._bounds.append([math.inf, -math.inf, math.inf, -math.inf])
+        self._buckets.append(bucket)
+        self._split_at.append(self.leaf_size)
+        return len(self._vantage) - 1
+
+    def _distance(self, a, b):
+        self.distance_evaluations += 1
+        return self.metric(a, b)
+
+    def add(self, item):
+        """Adds an item, returning its index"""
+        index = len(self.items)
+        self.items.append(item)
+        node = 0
+        while self._vantage[node] >= 0:
+            d = self._distance(item, self.items[self._vantage[node]])
+            side = 0 if d < self._radius[node] else 1
+            bounds = self._bounds[node]
+            bounds[2 * side] = min(bounds[2 * side], d)
+            bounds[2 * side + 1] = max(bounds[2 * side + 1], d)
+            node = self._children[node][side]
+        self._buckets[node].append(index)
+        if len(self._buckets[node]) > self._split_at[node]:
+            self._split(node)
+        return index
+
+    def extend(self, items):
+        """Adds several items"""
+        for item in items:
+            self.add(item)
+
+    def _split(self, node):
+        bucket = self._buckets[node]
+        vantage = bucket.pop(self._random.randrange(len(bucket)))
+        distances = np.array([self._distance(self.items[i], self.items[vantage])
+                              for i in bucket])
+        radius = float(np.median(distances))
+        inner = distances < radius
+        if not inner.any():
+            inner = distances <= radius
+        if inner.all():
+            # Every item is the same distance from the vantage item, so
+            # splitting can't help until the leaf has grown
+            bucket.append(vantage)
+            self._split_at[node] = 2 * len(bucket)
+            return
+        bucket = np.array(bucket)
+        self._vantage[node] = vantage
+        self._radius[node] = radius
+        self._bounds[node] = [float(np.min(distances[inner])), float(np.max(distances[inner])),
+                              float(np.min(distances[~inner])), float(np.max(distances[~inner]))]
+        self._buckets[node] = []
+        self._children[node] = [self._new_leaf(bucket[inner].tolist()),
+                                self._new_leaf(bucket[~inner].tolist())]
+
+    def _sides(self, node, d):
+        """The children of an internal node with the least distance from the
+        query to any item in each, given the query's distance d from the
+        vantage item, nearer side first"""
+        bounds = self._bounds[node]
+        sides = []
+        for side in (0, 1):
+            low, high = bounds[2 * side], bounds[2 * side + 1]
+            if low <= high:
+                sides.append((max(low - d, d - high, 0.0), self._children[node][side]))
+        sides.sort(key=lambda s: s[0])
+        return sides
+
+    def within(self, query, radius):
+        """
+        Finds the items within `radius` of `query`.
+
+        :return: (indices, distances) arrays, ordered by index
+        """
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._vantage[node] < 0:
+                for i in self._buckets[node]:
+                    d = self._distance(query, self.items[i])
+                    if d <= radius:
+                        found.append((i, d))
+                continue
+            d = self._distance(query, self.items[self._vantage[node]])
+            if d <= radius:
+                found.append((self._vantage[node], d))
+            stack.extend(child for bound, child in self._sides(node, d) if bound <= radius)
+        found.sort()
+        return (np.array([i for i, _ in found], dtype=np.int64),
+                np.array([d for _, d in found], dtype=np.float64))
+
+    def nearest(self, query, k=1):
+        """
+        Finds the k items nearest to `query`.
+
+        :return: (indices, distances) arrays, nearest first
+        """
+        best = _Nearest(k)
+        # Nodes to visit, with a lower bound on their distance from the query
+        pending = [(0.0, 0)]
+        while pending:
+            bound, node = heapq.heappop(pending)
+            if bound > best.cutoff():
+                break
+            if self._vantage[node] < 0:
+                for i in self._buckets[node]:
+                    best.consider(i, self._distance(query, self.items[i]))
+                continue
+            d = self._distance(query, self.items[self._vantage[node]])
+            best.consider(self._vantage[node], d)
+            self._push_sides(pending, node, bound, d, best.cutoff())
+        found = best.found()
+        return (np.array([i for _, i in found], dtype=np.int64),
+                np.array([d for d, _ in found], dtype=np.float64))
+
+    def _push_sides(self, pending, node, bound, d, cutoff):
+        """Adds the children of an internal node that may hold items within
+        `cutoff` of the query to the heap `pending`, given the query's
+        distance d from the vantage item and the node's own bound"""
+        for side_bound, child in self._sides(node, d):
+            if side_bound <= cutoff:
+                heapq.heappush(pending, (max(bound, side_bound), child))
+
+    def save(self, path, encode=encode_barcode):
+        """
+        Saves the tree and its items to a .npz file, without pickling.
+
+        :param encode: callable
+            turns an item into a 2D float array. Defaults to encode_barcode.
+        """
+        encoded = [np.asarray(encode(item), dtype=np.float64) for item in self.items]
+        shapes = np.array([e.shape for e in encoded], dtype=np.int64).reshape(-1, 2)
+        data = np.concatenate([e.ravel() for e in encoded]) if encoded else np.zeros(0)
+        bucket_offsets = np.zeros(len(self._buckets) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in self._buckets], out=bucket_offsets[1:])
+        np.savez(path,
+                 leaf_size=self.leaf_size,
+                 vantage=np.array(self._vantage, dtype=np.int64),
+                 radius=np.array(self._radius, dtype=np.float64),
+                 children=np.array(self._children, dtype=np.int64).reshape(-1, 2),
+                 bounds=np.array(self._bounds, dtype=np.float64).reshape(-1, 4),
+                 split_at=np.array(self._split_at, dtype=np.int64),
+                 bucket_offsets=bucket_offsets,
+                 buckets=np.array([i for b in self._buckets for i in b], dtype=np.int64),
+                 item_shapes=shapes,
+                 item_data=data)
+
+    @staticmethod
+    def load(path, metric, decode=decode_barcode, seed=None):
+        """
+        Loads a tree saved by `save`.
+
+        :param metric: callable, the metric the tree was built with
+        :param decode: callable
+            turns a 2D float array back into an item. Defaults to
+            decode_barcode.
+        """
+        with np.load(path, allow_pickle=False) as saved:
+            tree = VPTree(metric, leaf_size=int(saved['leaf_size']), seed=seed)
+            sizes = np.prod(saved['item_shapes'], axis=1)
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            data = saved['item_data']
+            tree.items = [decode(data[offsets[i]:offsets[i + 1]].reshape(shape))
+                          for i, shape in enumerate(saved['item_shapes'].tolist())]
+            tree._vantage = saved['vantage'].tolist()
+            tree._radius = saved['radius'].tolist()
+            tree._children = saved['children'].tolist()
+            tree._bounds = saved['bounds'].tolist()
+            tree._split_at = saved['split_at'].tolist()
+            buckets = saved['buckets'].tolist()
+            bucket_offsets = saved['bucket_offsets'].tolist()
+            tree._buckets = [buckets[bucket_offsets[i]:bucket_offsets[i + 1]]
+                             for i in range(len(tree._vantage))]
+        return tree
+
+
+class _Nearest:
+    """The k nearest items found so far by `VPTree.nearest`, in a max-heap of
+    (-distance, -index)"""
+
+    def __init__(self, k):
+        self.k = k
+        self._heap = []
+
+    def consider(self, i, d):
+        """Keeps item i at distance d if it is among the k nearest so far"""
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, (-d, -i))
+        elif d < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, (-d, -i))
+
+    def cutoff(self):
+        """The distance an item must beat to be kept"""
+        return -self._heap[0][0] if len(self._heap) == self.k else math.inf
+
+    def found(self):
+        """The items kept, as (distance, index) pairs, nearest first"""
+        return sorted((-d, -i) for d, i in self._heap)
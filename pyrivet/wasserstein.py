@@ -0,0 +1,125 @@
+import math
+
+import numpy as np
+import scipy.optimize
+import scipy.sparse
+
+"""q-Wasserstein distances between barcodes, computed in-process with SciPy
+rather than by running Hera's wasserstein_dist. As in Hera, bars are points
+in the plane with the L-infinity distance, and any bar may be matched to the
+diagonal at the cost of its distance from it.
+
+Barcodes whose bars all have multiplicity one are matched with
+`scipy.optimize.linear_sum_assignment`, after each side is augmented with
+the diagonal projections of the other. Otherwise, the multiplicities are kept
+as weights in a transportation problem with a single diagonal node, solved as
+a linear program, so that the problem grows with the number of distinct bars
+rather than the total multiplicity."""
+
+
+def wasserstein_distance(left, right, degree):
+    """
+    Computes the q-Wasserstein distance between two barcodes.
+
+    :param left: Barcode
+    :param right: Barcode
+    :param degree: float
+        the exponent q, at least 1
+    :return: float
+        inf if the barcodes have different numbers of infinite bars
+    """
+    return _distance(left.starts, left.ends, left.multiplicities,
+                     right.starts, right.ends, right.multiplicities, degree)
+
+
+def wasserstein_distances(lefts, rights, degree):
+    """
+    Computes the q-Wasserstein distance between each pair of barcodes in two
+    barcode.BarcodeArrays, such as `rivet.barcode_arrays` returns, without
+    creating Barcode or Bar objects.
+
+    :param lefts: barcode.BarcodeArrays
+    :param rights: barcode.BarcodeArrays
+        with as many barcodes as `lefts`
+    :param degree: float
+    :return: 1D array of float
+    """
+    if len(lefts) != len(rights):
+        raise ValueError("Lengths of `lefts` and `rights` must match")
+    result = np.empty(len(lefts))
+    for i in range(len(lefts)):
+        left = slice(lefts.indptr[i], lefts.indptr[i + 1])
+        right = slice(rights.indptr[i], rights.indptr[i + 1])
+        result[i] = _distance(lefts.births[left], lefts.deaths[left],
+                              lefts.multiplicities[left],
+                              rights.births[right], rights.deaths[right],
+                              rights.multiplicities[right], degree)
+    return result
+
+
+def _distance(left_starts, left_ends, left_mults, right_starts, right_ends, right_mults,
+              degree):
+    if degree < 1:
+        raise ValueError("degree must be at least 1")
+    left_weights = np.maximum(np.round(left_mults), 0)
+    right_weights = np.maximum(np.round(right_mults), 0)
+    left_essential = np.isposinf(left_ends)
+    right_essential = np.isposinf(right_ends)
+    # Infinite bars can only be matched with each other, best in sorted order
+    left_births = np.sort(np.repeat(left_starts[left_essential],
+                                    left_weights[left_essential].astype(np.int64)))
+    right_births = np.sort(np.repeat(right_starts[right_essential],
+                                     right_weights[right_essential].astype(np.int64)))
+    if len(left_births) != len(right_births):
+        return math.inf
+    cost = float(np.sum(np.abs(left_births - right_births) ** degree))
+
+    left_finite = ~left_essential & (left_starts != left_ends) & (left_weights > 0)
+    right_finite = ~right_essential & (right_starts != right_ends) & (right_weights > 0)
+    cost += _finite_cost(left_starts[left_finite], left_ends[left_finite],
+                         left_weights[left_finite],
+                         right_starts[right_finite], right_ends[right_finite],
+                         right_weights[right_finite], degree)
+    return cost ** (1 / degree)
+
+
+def _finite_cost(left_starts, left_ends, left_weights, right_starts, right_ends,
+                 right_weights, degree):
+    """The least total cost, the sum of the q-th powers of the distances, of
+    a matching of finite bars"""
+    left_diagonal = ((left_ends - left_starts) / 2) ** degree
+    right_diagonal = ((right_ends - right_starts) / 2) ** degree
+    n, m = len(left_starts), len(right_starts)
+    if n == 0 or m == 0:
+        return float(np.dot(left_weights, left_diagonal) + np.dot(right_weights, right_diagonal))
+    pairs = np.maximum(np.abs(left_starts[:, None] - right_starts[None, :]),
+                       np.abs(left_ends[:, None] - right_ends[None, :])) ** degree
+
+    if np.all(left_weights == 1) and np.all(right_weights == 1):
+        # Rows are the left bars and the diagonal projections of the right
+        # bars; columns are the right bars and the projections of the left
+        costs = np.full((n + m, m + n), np.inf)
+        costs[:n, :m] = pairs
+        costs[np.arange(n), m + np.arange(n)] = left_diagonal
+        costs[n + np.arange(m), np.arange(m)] = right_diagonal
+        costs[n:, m:] = 0
+        rows, columns = scipy.optimize.linear_sum_assignment(costs)
+        return float(np.sum(costs[rows, columns]))
+
+    # A transportation problem from the left bars and the diagonal, to the
+    # right bars and the diagonal
+    costs = np.zeros((n + 1, m + 1))
+    costs[:n, :m] = pairs
+    costs[:n, m] = left_diagonal
+    costs[n, :m] = right_diagonal
+    supply = np.append(left_weights, np.sum(right_weights))
+    demand = np.append(right_weights, np.sum(left_weights))
+    constraints = scipy.sparse.vstack([
+        scipy.sparse.kron(scipy.sparse.identity(n + 1), np.ones((1, m + 1))),
+        scipy.sparse.kron(np.ones((1, n + 1)), scipy.sparse.identity(m + 1))]).tocsr()
+    result = scipy.optimize.linprog(costs.ravel(), A_eq=constraints,
+                                    b_eq=np.concatenate([supply, demand]),
+                                    bounds=(0, None), method='highs')
+    if result.status != 0:
+        raise RuntimeError("Wasserstein transportation problem failed: " + result.message)
+    return float(result.fun)
@@ -26,6 +26,7 @@ setup(
         'setuptools_scm',
     ],
     install_requires=[
+        'msgpack',
         'numpy',
     ],
     author='The RIVET developers',
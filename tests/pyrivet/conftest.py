@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def fake_hera(tmp_path, monkeypatch):
+    """A stand-in for bottleneck_dist whose distance between two diagrams is
+    the difference in their numbers of lines, and which logs its calls to the
+    returned path"""
+    script = tmp_path / 'bottleneck_dist'
+    script.write_text(
+        '#!/bin/sh\n'
+        'echo call >> "%s"\n'
+        'awk \'FNR == NR { if ($0 == "--") n++; else a[n]++; next }\n'
+        '     { if ($0 == "--") { d = a[m] - b; print (d < 0 ? -d : d); m++; b = 0 } else b++ }\' '
+        '"$1" "$2"\n' % (tmp_path / 'calls'))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    return tmp_path / 'calls'
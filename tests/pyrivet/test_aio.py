@@ -0,0 +1,105 @@
+import asyncio
+import os
+import stat
+
+import pytest
+
+from pyrivet import aio, rivet
+
+
+def fake_rivet_console(tmp_path):
+    """A stand-in for rivet_console that only knows --bounds"""
+    script = tmp_path / 'fake_rivet_console'
+    script.write_text('#!/bin/sh\necho "low: 0,0"\necho "high: 1,2"\n')
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return str(script)
+
+
+def test_async_bounds(tmp_path, monkeypatch):
+    monkeypatch.setattr(rivet, 'rivet_executable', fake_rivet_console(tmp_path))
+
+    async def main():
+        semaphore = asyncio.Semaphore(2)
+        modules = [b'not msgpack'] * 5
+        return await asyncio.gather(*[aio.bounds(m, semaphore=semaphore) for m in modules])
+
+    results = asyncio.run(main())
+    assert results == [rivet.Bounds((0., 0.), (1., 2.))] * 5
+
+    # A PrecomputedModule remembers bounds found asynchronously
+    with rivet.PrecomputedModule.from_bytes(b'not msgpack') as module:
+        assert module.known_bounds() is None
+        assert asyncio.run(aio.bounds(module)) == rivet.Bounds((0., 0.), (1., 2.))
+        monkeypatch.setattr(rivet, 'rivet_executable', 'false')
+        assert module.known_bounds() == rivet.Bounds((0., 0.), (1., 2.))
+        assert module.bounds() == rivet.Bounds((0., 0.), (1., 2.))
+        assert asyncio.run(aio.bounds(module)) == rivet.Bounds((0., 0.), (1., 2.))
+
+
+def test_async_check_output_failure():
+    async def main():
+        try:
+            await aio._check_output(['false'])
+        except Exception as e:
+            return e
+
+    assert asyncio.run(main()).returncode != 0
+    assert os.cpu_count() is None or aio.concurrency == os.cpu_count()
+
+
+def test_async_multi_bottleneck_distance(monkeypatch, fake_hera):
+    from pyrivet import barcode, hera
+    from pyrivet.cache import DistanceCache
+    calls = fake_hera
+    monkeypatch.setattr(hera, 'shard_min_bars', 1)
+    monkeypatch.setattr(hera, 'max_processes', 3)
+    one = barcode.Barcode([barcode.Bar(0, 1, 1)])
+    three = barcode.Barcode([barcode.Bar(0, 1, 1), barcode.Bar(2, 3, 2)])
+
+    async def main(**kwargs):
+        return await aio.multi_bottleneck_distance([one, three, three], [three, one, three],
+                                                   cap=1.5, **kwargs)
+
+    # Sharded by bar count like hera.multi_bottleneck_distance, which puts
+    # the first two pairs together
+    assert asyncio.run(main()) == [1.5, 1.5, 0]
+    assert len(calls.read_text().split()) == 2
+    assert asyncio.run(main(processes=1)) == [1.5, 1.5, 0]
+    assert len(calls.read_text().split()) == 3
+    assert asyncio.run(main(backend='python')) == pytest.approx([0.5, 0.5, 0])
+    assert len(calls.read_text().split()) == 3
+
+    with DistanceCache() as cache:
+        monkeypatch.setattr(hera, 'distance_cache', cache)
+        assert asyncio.run(main()) == [1.5, 1.5, 0]
+        assert asyncio.run(main()) == [1.5, 1.5, 0]
+        # The swapped pair is computed once, and then all come from the cache
+        assert len(calls.read_text().split()) == 3 + 2
+
+
+def test_async_compute_file_cache(tmp_path, monkeypatch):
+    import threading
+    from pyrivet.cache import ModuleCache
+    script = tmp_path / 'fake_rivet_console'
+    script.write_text('#!/bin/sh\necho call >> "%s"\ncp "$1" "$2"\n' % (tmp_path / 'calls'))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(rivet, 'rivet_executable', str(script))
+    cache = ModuleCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(rivet, 'cache', cache)
+    # The cache is used off the event loop's thread
+    threads = []
+    get = cache.get
+
+    def recording_get(*args):
+        threads.append(threading.current_thread())
+        return get(*args)
+
+    monkeypatch.setattr(cache, 'get', recording_get)
+    input_name = tmp_path / 'input.txt'
+    input_name.write_bytes(b'RIVET_msgpack\ninput')
+
+    for output in ('first.rivet', 'second.rivet'):
+        asyncio.run(aio.compute_file(str(input_name), str(tmp_path / output)))
+        assert (tmp_path / output).read_bytes() == b'RIVET_msgpack\ninput'
+    assert len((tmp_path / 'calls').read_text().split()) == 1
+    assert len(threads) == 2 and threading.main_thread() not in threads
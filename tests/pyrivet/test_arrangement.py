@@ -0,0 +1,137 @@
+import math
+import shutil
+
+import msgpack
+import numpy as np
+import pytest
+
+from pyrivet import module_reader, rivet
+from pyrivet.arrangement import Arrangement
+
+inf = float('inf')
+# The end of an infinite bar in a barcode template
+NONE = 4294967295
+
+
+def ids(*values):
+    """Ids as RIVET packs them, each a struct of one integer"""
+    return [[v] for v in values]
+
+
+def make_module():
+    """Two H_0 generators, at (1, 0) and (0, 1), merging at (2, 2).
+
+    The anchor (1, 1) splits the arrangement into two faces: lines passing
+    below the anchor (face 0), where the generator at (1, 0) is the elder,
+    and lines passing above it (face 1), where the one at (0, 1) is."""
+    template_points_message = [
+        "x", "y",
+        [[1, 0, 1, 0, 0],
+         [0, 1, 1, 0, 0],
+         [2, 2, 0, 1, 0]],
+        [["0", "1"], ["1", "1"], ["2", "1"]],
+        [["0", "1"], ["1", "1"], ["2", "1"]],
+        [[3, 3], [0, 1, 1, 1, 2, 1, 1, 1, 1]],
+    ]
+    vertices = [[[3], 0., inf], [[2], inf, inf], [[4], inf, -inf], [[7], 0., -inf],
+                [[0], 0., -1.], [[1], inf, 1.]]
+    # origin, twin, next, prev, face, anchor
+    half_edges = [
+        ids(4, 6, 1, 3, 0, 0),      # 0: anchor line, left to right
+        ids(5, 8, 2, 0, 0, -1),     # 1: right edge, up
+        ids(1, 9, 3, 1, 0, -1),     # 2: top, right to left
+        ids(0, 10, 0, 2, 0, -1),    # 3: left edge, down
+        ids(3, 11, 5, 7, 1, -1),    # 4: bottom, left to right
+        ids(2, 12, 6, 4, 1, -1),    # 5: right edge, up
+        ids(5, 0, 7, 5, 1, 0),      # 6: anchor line, right to left
+        ids(4, 13, 4, 6, 1, -1),    # 7: left edge, down
+        ids(1, 1, -1, -1, -1, -1),
+        ids(0, 2, -1, -1, -1, -1),
+        ids(4, 3, -1, -1, -1, -1),
+        ids(2, 4, -1, -1, -1, -1),
+        ids(5, 5, -1, -1, -1, -1),
+        ids(3, 7, -1, -1, -1, -1),
+    ]
+    faces = [[[0], [[[0, NONE, 1], [1, 2, 1]]], False],
+             [[4], [[[1, NONE, 1], [0, 2, 1]]], False]]
+    arrangement_message = [
+        [["0", "1"], ["1", "1"], ["2", "1"]], [["0", "1"], ["1", "1"], ["2", "1"]],
+        [0., 1., 2.], [0., 1., 2.],
+        half_edges, vertices, [[1, 1, [0], 0, False, 1]], faces,
+        [2], [1], [4], [5], [],
+    ]
+    return (module_reader.HEADER + b'\n' +
+            msgpack.packb([]) +
+            msgpack.packb(template_points_message) +
+            msgpack.packb(arrangement_message))
+
+
+def test_locate_faces():
+    arrangement = Arrangement.from_module(make_module())
+    root_half = math.sqrt(.5)
+    faces = arrangement.locate([45, 45, 0, 90, 90],
+                               [-.5 * root_half, .5 * root_half, .5, -.5, -2])
+    assert faces.tolist() == [0, 1, 0, 1, 0]
+
+
+def test_fibered_barcodes():
+    arrangement = Arrangement.from_module(make_module())
+    root_half = math.sqrt(.5)
+    slices = [(45, -.5 * root_half), (45, .5 * root_half), (0, .5), (90, -.5), (90, -2)]
+    indptr, births, deaths, mults = arrangement.barcode_arrays(slices)
+    # The younger generator's bar is empty on lines that miss (2, 2)
+    assert indptr.tolist() == [0, 2, 4, 5, 6, 8]
+    assert np.allclose(births, [root_half, math.sqrt(2), root_half, math.sqrt(2), 1, 1, 0, 1])
+    assert np.allclose(deaths, [inf, math.sqrt(8), inf, math.sqrt(8), inf, inf, inf, 2])
+    assert mults.tolist() == [1] * 8
+
+    codes = arrangement.barcodes(slices)
+    assert codes[2][0] == (0, .5)
+    assert len(codes[2][1]) == 1
+
+
+def test_rejects_other_layouts():
+    module = make_module()
+    header = len(module_reader.HEADER) + 1
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(module[header:])
+    parameters, points, message = list(unpacker)
+
+    def decode(message):
+        return Arrangement.from_module(module[:header] + msgpack.packb(parameters) +
+                                       msgpack.packb(points) + msgpack.packb(message))
+
+    decode(message)
+    # Plain integer ids, a template not wrapped in its own struct, an end
+    # that is neither a template point nor NONE, and a missing field
+    for field, change in [(4, lambda edges: edges[0].__setitem__(0, 4)),
+                          (7, lambda faces: faces[0].__setitem__(1, [[0, NONE, 1]])),
+                          (7, lambda faces: faces[0][1][0].__setitem__(0, [0, 3, 1])),
+                          (6, lambda anchors: anchors[0].__setitem__(2, 0))]:
+        changed = msgpack.unpackb(msgpack.packb(message), raw=False)
+        change(changed[field])
+        with pytest.raises(module_reader.FormatError):
+            decode(changed)
+    with pytest.raises(module_reader.FormatError):
+        decode(message[:-1])
+
+
+@pytest.mark.skipif(shutil.which(rivet.rivet_executable) is None,
+                    reason="rivet_console is not available")
+def test_matches_rivet_console(tmp_path):
+    """Fibered barcodes from the arrangement of a module rivet_console wrote,
+    including finite bars, agree with rivet_console's --barcodes output"""
+    cloud = rivet.PointCloud([(0, 0), (1, 0), (0, 1), (3, 3), (3, 4)],
+                             appearance=[0, 1, 2, 0, 3], second_param_name="birth",
+                             max_dist=6)
+    slices = [(angle, offset) for angle in (0, 20, 45, 70, 90) for offset in (-1, 0, 0.5, 2)]
+    with rivet.compute_module(cloud, homology=0, directory=str(tmp_path)) as module:
+        expected = rivet.barcodes(module, slices)
+        actual = Arrangement.from_module(module).barcodes(slices)
+    assert any(np.isfinite(code.ends).any() for _, code in expected)
+    for (line, code), (expected_line, expected_code) in zip(actual, expected):
+        code, expected_code = code.collapse(), expected_code.collapse()
+        assert line == expected_line
+        assert np.allclose(code.starts, expected_code.starts)
+        assert np.allclose(code.ends, expected_code.ends)
+        assert np.array_equal(code.multiplicities, expected_code.multiplicities)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from pyrivet import barcode
+
+
+def test_columnar_barcode():
+    code = barcode.Barcode([barcode.Bar(0, 1, 3), barcode.Bar(0.5, np.inf, 1)])
+    assert len(code) == 2
+    arr = code.to_array()
+    assert arr.shape == (2, 3)
+    assert np.shares_memory(arr, code.to_array())
+    assert not arr.flags.writeable
+    assert [(b.start, b.end, b.multiplicity) for b in code] == [(0, 1, 3), (0.5, np.inf, 1)]
+    assert repr(code) == "Barcode([Bar(0.0, 1.0, 3), Bar(0.5, inf, 1)])"
+    assert code == barcode.Barcode.from_arrays([0, 0.5], [1, np.inf], [3, 1])
+    assert hash(code) == hash(barcode.Barcode.from_arrays([0, 0.5], [1, np.inf], [3, 1]))
+    assert hash(barcode.Barcode.from_arrays([-0.0], [1], [1])) == \
+        hash(barcode.Barcode.from_arrays([0.0], [1], [1]))
+    assert len({code, barcode.Barcode.from_arrays([0, 0.5], [1, np.inf], [3, 1])}) == 1
+    # bars can't be changed in place
+    with pytest.raises(AttributeError):
+        code.bars.append(barcode.Bar(2, 3, 1))
+    assert len(code.bars) == 2
+
+    expanded = code.expand()
+    assert len(expanded) == 4
+    assert expanded.multiplicities.tolist() == [1, 1, 1, 1]
+    assert expanded.ends.tolist() == [1, 1, 1, np.inf]
+
+    empty = barcode.Barcode()
+    assert len(empty) == 0 and empty.to_array().shape == (0, 3)
+    assert not hasattr(barcode.Bar(0, 1, 1), '__dict__')
+
+
+def test_parse_barcode_arrays():
+    from pyrivet import rivet
+    output = b'45 0: 0 inf x1, 1.5 3 x2\n30 -1.25:\n60 2: 0.5 1 x3\n\n'
+    arrays = rivet._parse_barcode_arrays(output)
+    assert len(arrays) == 3
+    assert arrays.indptr.tolist() == [0, 2, 2, 3]
+    assert arrays.slices.tolist() == [[45, 0], [30, -1.25], [60, 2]]
+    assert arrays.births.tolist() == [0, 1.5, 0.5]
+    assert arrays.deaths.tolist() == [np.inf, 3, 1]
+    assert arrays.multiplicities.tolist() == [1, 2, 3]
+
+    pairs = rivet._parse_slices(output.split(b'\n'))
+    assert [p[0] for p in pairs] == [(45, 0), (30, -1.25), (60, 2)]
+    assert pairs[0][1] == barcode.Barcode([barcode.Bar(0, np.inf, 1), barcode.Bar(1.5, 3, 2)])
+    assert len(pairs[1][1]) == 0
+    assert len(rivet._parse_barcode_arrays(b'')) == 0
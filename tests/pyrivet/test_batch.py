@@ -0,0 +1,50 @@
+import multiprocessing
+import stat
+
+from pyrivet import batch, rivet
+from pyrivet.cache import ModuleCache
+
+
+class Broken:
+    def save(self, out):
+        raise RuntimeError("cannot save")
+
+
+def test_compute_batch(tmp_path, monkeypatch):
+    # A stand-in for rivet_console that copies its input to its output, and
+    # logs when it starts and ends work on each max_dist
+    log = tmp_path / 'log'
+    script = tmp_path / 'fake_rivet_console'
+    script.write_text('#!/bin/sh\n'
+                      'echo "start $(sed -n 3p "$1")" >> "%s"\n'
+                      'sleep 0.3\n'
+                      'echo "end $(sed -n 3p "$1")" >> "%s"\n'
+                      'cp "$1" "$2"\n' % (log, log))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(rivet, 'rivet_executable', str(script))
+    cache = ModuleCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(rivet, 'cache', cache)
+
+    clouds = [rivet.PointCloud([(0, 0), (i, 0)], max_dist=i) for i in range(1, 5)]
+    items = clouds[:2] + [batch.BatchItem(Broken(), key='broken')] + \
+        [batch.BatchItem(c, homology=1, memory=10 ** 6) for c in clouds[2:]]
+    # Spawned workers don't inherit the monkeypatched executable and cache
+    results = list(batch.compute_batch(items, workers=2, memory_limit=1500000,
+                                       mp_context=multiprocessing.get_context('spawn')))
+
+    assert sorted(r.index for r in results) == [0, 1, 2, 3, 4]
+    by_index = {r.index: r for r in results}
+    assert not by_index[2].ok
+    assert by_index[2].key == 'broken'
+    assert isinstance(by_index[2].error, RuntimeError)
+    for index in (0, 1, 3, 4):
+        assert by_index[index].ok
+        assert by_index[index].output.startswith(b'points\n2\n')
+    assert by_index[4].output.splitlines()[2] == b'4.000000'
+
+    # The two large items fit in the memory limit only one at a time, so the
+    # second doesn't start until the first ends, though a worker is free
+    events = log.read_text().splitlines()
+    assert events.index('end 3.000000') < events.index('start 4.000000')
+    # Each item that was computed is in the parent's cache
+    assert len(list((tmp_path / 'cache').iterdir())) == 4
@@ -0,0 +1,54 @@
+import itertools
+import math
+
+import numpy as np
+
+from pyrivet import barcode, bottleneck
+
+
+def brute_force(left, right):
+    """The bottleneck distance between small sets of finite bars, by trying
+    every matching of the bars and their diagonal projections"""
+    points = [('bar', b) for b in left] + [('diagonal', b) for b in right]
+    targets = [('bar', b) for b in right] + [('diagonal', b) for b in left]
+
+    def cost(p, q):
+        if p[0] == 'bar' and q[0] == 'bar':
+            return max(abs(p[1][0] - q[1][0]), abs(p[1][1] - q[1][1]))
+        if p[0] == 'diagonal' and q[0] == 'diagonal':
+            return 0
+        bar = p[1] if p[0] == 'bar' else q[1]
+        # A bar matched to a diagonal point other than its own projection
+        if (p[0] == 'bar' and p[1] is not q[1]) or (q[0] == 'bar' and q[1] is not p[1]):
+            return math.inf
+        return (bar[1] - bar[0]) / 2
+
+    return min(max([cost(p, targets[k]) for p, k in zip(points, order)], default=0)
+               for order in itertools.permutations(range(len(targets))))
+
+
+def code(bars):
+    return barcode.Barcode([barcode.Bar(s, e, 1) for s, e in bars])
+
+
+def test_matches_brute_force():
+    random = np.random.RandomState(0)
+    for _ in range(40):
+        left = [tuple(sorted(random.randint(0, 8, size=2) / 2)) for _ in range(random.randint(0, 4))]
+        right = [tuple(sorted(random.randint(0, 8, size=2) / 2)) for _ in range(random.randint(0, 4))]
+        left = [b for b in left if b[0] != b[1]]
+        right = [b for b in right if b[0] != b[1]]
+        expected = brute_force(left, right)
+        assert bottleneck.bottleneck_distance(code(left), code(right)) == expected
+        approximate = bottleneck.bottleneck_distance(code(left), code(right), relative_error=0.1)
+        assert expected <= approximate <= 1.1 * expected + 1e-12
+
+
+def test_infinite_bars_and_multiplicity():
+    left = barcode.Barcode([barcode.Bar(0, np.inf, 1), barcode.Bar(1, 3, 2)])
+    right = barcode.Barcode([barcode.Bar(0.5, np.inf, 1), barcode.Bar(1, 3, 1),
+                             barcode.Bar(1.25, 3, 1)])
+    assert bottleneck.bottleneck_distance(left, right) == 0.5
+    assert bottleneck.bottleneck_distance(left, barcode.Barcode()) == math.inf
+    assert bottleneck.bottleneck_distance(barcode.Barcode(), barcode.Barcode()) == 0
+    assert bottleneck.bottleneck_distance(code([(0, 4)]), barcode.Barcode()) == 2
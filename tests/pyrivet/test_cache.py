@@ -0,0 +1,50 @@
+import os
+import time
+
+from pyrivet.cache import ModuleCache
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_cache_round_trip(tmp_path):
+    cache = ModuleCache(str(tmp_path / 'cache'))
+    input_name = str(tmp_path / 'input.txt')
+    _write(input_name, b'points\n2\n1.0\nno function\n0 0\n1 1\n')
+
+    key = cache.key(input_name, 0, 10, 10, 'msgpack')
+    assert key == cache.key(input_name, 0, 10, 10, 'msgpack')
+    assert key != cache.key(input_name, 1, 10, 10, 'msgpack')
+
+    output_name = str(tmp_path / 'output.rivet')
+    assert not cache.get(key, output_name)
+    _write(output_name, b'RIVET_msgpack\nfake module')
+    cache.put(key, output_name)
+    os.remove(output_name)
+
+    assert cache.get(key, output_name)
+    with open(output_name, 'rb') as f:
+        assert f.read() == b'RIVET_msgpack\nfake module'
+    assert cache.get_bytes(key) == b'RIVET_msgpack\nfake module'
+    assert cache.stats.hits == 2
+    assert cache.stats.misses == 1
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ModuleCache(str(tmp_path), max_bytes=250)
+    cache.put_bytes('a', b'a' * 100)
+    cache.put_bytes('b', b'b' * 100)
+    # Make 'a' the oldest entry, then use it so 'b' becomes the oldest
+    old = time.time() - 100
+    os.utime(os.path.join(str(tmp_path), 'a.rivet'), (old, old))
+    os.utime(os.path.join(str(tmp_path), 'b.rivet'), (old + 1, old + 1))
+    assert cache.get_bytes('a') is not None
+
+    cache.put_bytes('c', b'c' * 100)
+    assert cache.get_bytes('b') is None
+    assert cache.get_bytes('a') is not None
+    assert cache.get_bytes('c') is not None
+    assert cache.size() <= 250
+    assert cache.stats.evictions == 1
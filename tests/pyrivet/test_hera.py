@@ -0,0 +1,220 @@
+import subprocess
+
+import numpy as np
+import pytest
+
+from pyrivet import barcode, hera
+
+
+def test_write_multi_barcodes(tmp_path):
+    codes = [barcode.Barcode([barcode.Bar(0, 1.5, 3), barcode.Bar(2, np.inf, 1),
+                              barcode.Bar(0, 1.5, 2), barcode.Bar(1, 1, 4)]),
+             barcode.Barcode()]
+    name = str(tmp_path / 'diagrams.txt')
+    hera._write_multi_barcodes(name, codes, 1e10)
+    with open(name) as f:
+        assert f.read() == "0.0 1.5\n" * 5 + "2.0 10000000000.0\n--\n--\n"
+
+
+def test_collapse():
+    code = barcode.Barcode([barcode.Bar(1, 2, 1), barcode.Bar(0, 1, 2),
+                            barcode.Bar(1, 2, 3), barcode.Bar(4, 5, 0)])
+    assert code.collapse() == barcode.Barcode([barcode.Bar(0, 1, 2), barcode.Bar(1, 2, 4)])
+    assert len(barcode.Barcode().collapse()) == 0
+
+    diagonal = barcode.Barcode([barcode.Bar(1, 1, 2)])
+    starts, ends, mults = hera._hera_bars(diagonal, keep_one=True)
+    assert starts.tolist() == [1] and mults.tolist() == [2]
+    assert len(hera._hera_bars(diagonal)[0]) == 0
+
+
+def test_pairwise_bottleneck(tmp_path, fake_hera):
+    calls = fake_hera
+    codes = [barcode.Barcode([barcode.Bar(0, 1, k)]) for k in (1, 4, 2, 7, 3)]
+    sizes = np.array([1, 4, 2, 7, 3])
+    expected = np.abs(sizes[:, None] - sizes[None, :])
+
+    matrix = hera.pairwise_bottleneck(codes, workers=2, chunk_size=3)
+    assert np.array_equal(matrix, expected)
+    assert len(calls.read_text().split()) == 4
+
+    out = str(tmp_path / 'matrix.npy')
+    matrix = hera.pairwise_bottleneck(codes, out=out, chunk_size=3)
+    assert np.array_equal(np.load(out), expected)
+    # Resuming only recomputes the chunks that aren't marked done
+    done = np.load(out + '.done.npy')
+    done[1] = 0
+    np.save(out + '.done.npy', done)
+    calls.write_text('')
+    matrix = hera.pairwise_bottleneck(codes, out=out, resume=True, chunk_size=3)
+    assert np.array_equal(matrix, expected)
+    assert len(calls.read_text().split()) == 1
+
+
+def test_pairwise_backend_and_cache(monkeypatch, fake_hera):
+    from pyrivet.cache import DistanceCache
+    calls = fake_hera
+    codes = [barcode.Barcode([barcode.Bar(0, 1, k)]) for k in (1, 4, 2, 1)]
+    sizes = np.array([1, 4, 2, 1])
+
+    # Extra copies of the bar are matched to the diagonal
+    matrix = hera.pairwise_bottleneck(codes, chunk_size=2, backend='python')
+    assert matrix == pytest.approx(np.where(sizes[:, None] == sizes[None, :], 0, 0.5))
+    assert not calls.exists()
+
+    with DistanceCache() as cache:
+        monkeypatch.setattr(hera, 'distance_cache', cache)
+        expected = np.abs(sizes[:, None] - sizes[None, :])
+        # The last chunk pairs the copy of codes[0] with codes[1] and codes[2],
+        # which the first chunk computed
+        assert np.array_equal(hera.pairwise_bottleneck(codes, workers=1, chunk_size=2),
+                              expected)
+        assert len(calls.read_text().split()) == 2
+        # Every pair is now cached, for pairwise and multi-diagram calls alike
+        assert np.array_equal(hera.pairwise_bottleneck(codes, chunk_size=4), expected)
+        assert hera.multi_bottleneck_distance(codes[:2], codes[2:]) == [1, 3]
+        assert len(calls.read_text().split()) == 2
+
+
+def test_bottleneck_bounds_queries():
+    def exact(lefts, rights):
+        return hera.multi_bottleneck_distance(lefts, rights, inf=100, cap=np.inf,
+                                              relative_error=0, backend='python')
+
+    random = np.random.RandomState(2)
+    codes = []
+    for _ in range(60):
+        starts = random.uniform(0, 5, size=random.randint(1, 6))
+        ends = starts + random.uniform(0, 3, size=len(starts)) * random.randint(1, 4)
+        ends[0] = np.inf
+        codes.append(barcode.Barcode.from_arrays(starts, ends, random.randint(1, 3, size=len(starts))))
+    codes.append(barcode.Barcode.from_arrays([0, 1], [np.inf, np.inf], [2, 1]))
+    codes.append(barcode.Barcode.from_arrays([0.5, 3], [99.5, 4], [1, 1]))
+    codes.append(barcode.Barcode())
+    with pytest.raises(ValueError):
+        hera.BottleneckBounds(codes, inf=np.inf)
+    index = hera.BottleneckBounds(codes, depth=4, distance=exact, inf=100)
+    query = codes[0]
+    truth = np.array(exact([query] * len(codes), codes))
+
+    lower, upper = index.bounds(query)
+    assert np.all(lower <= truth + 1e-9) and np.all(truth <= upper + 1e-9)
+    # Different numbers of infinite bars give large but finite distances,
+    # as they do for the metric
+    assert np.isfinite(upper).all() and lower[-3] > 40
+    assert hera.bottleneck_bounds(query, codes[3], inf=100) == (lower[3], upper[3])
+    for other in codes:
+        lower, upper = hera.bottleneck_bounds(other, query, inf=100)
+        assert lower <= exact([other], [query])[0] + 1e-9 <= upper + 2e-9
+
+    lower, upper = index.bounds(query)
+    threshold = np.median(truth)
+    indices, distances = index.within(query, threshold)
+    assert indices.tolist() == np.flatnonzero(truth <= threshold).tolist()
+    assert np.all(distances <= threshold)
+
+    index.exact_computations = 0
+    indices, distances = index.nearest(query, k=3, batch_size=4)
+    assert np.allclose(distances, np.sort(truth)[:3])
+    assert index.exact_computations < len(codes)
+
+
+def test_distance_cache(tmp_path, monkeypatch, fake_hera):
+    from pyrivet.cache import DistanceCache
+    calls = fake_hera
+    one = barcode.Barcode([barcode.Bar(0, 1, 1)])
+    three = barcode.Barcode([barcode.Bar(0, 1, 1), barcode.Bar(2, 3, 2)])
+    reordered = barcode.Barcode([barcode.Bar(2, 3, 1), barcode.Bar(0, 1, 1), barcode.Bar(2, 3, 1)])
+
+    # Without a cache, each barcode is collapsed once and nothing is hashed
+    collapse = barcode.Barcode.collapse
+    collapsed = []
+    with monkeypatch.context() as patch:
+        patch.setattr(barcode.Barcode, 'collapse',
+                      lambda code: collapsed.append(code) or collapse(code))
+        patch.setattr(hera, '_diagram_digest', None)
+        assert hera.multi_bottleneck_distance([one, three, reordered, one],
+                                              [three, one, one, one]) == [2, 2, 2, 0]
+    assert len(calls.read_text().split()) == 1
+    assert len(collapsed) == 8
+
+    cache = DistanceCache(max_entries=1, path=str(tmp_path / 'distances'))
+    monkeypatch.setattr(hera, 'distance_cache', cache)
+    assert hera.multi_bottleneck_distance([one, three], [three, one]) == [2, 2]
+    assert hera.multi_bottleneck_distance([reordered], [one]) == [2]
+    assert len(calls.read_text().split()) == 2
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    cache.close()
+
+    # The database outlives the in-memory entries
+    with DistanceCache(path=str(tmp_path / 'distances')) as cache:
+        monkeypatch.setattr(hera, 'distance_cache', cache)
+        assert hera.bottleneck_distance(one, three) == 2
+        assert cache.stats.hit_rate == 1.0
+    assert len(calls.read_text().split()) == 2
+
+
+def test_sharded_multi_bottleneck(tmp_path, monkeypatch, fake_hera):
+    calls = fake_hera
+    # Fail on any diagram with a bar starting at 666
+    script = tmp_path / 'bottleneck_dist'
+    lines = script.read_text().split('\n', 1)
+    script.write_text(lines[0] + '\ngrep -q "^666.0 " "$1" && exit 1\n' + lines[1])
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(hera, 'max_processes', 3)
+    monkeypatch.setattr(hera, 'shard_min_bars', 1)
+
+    def code(starts):
+        return barcode.Barcode([barcode.Bar(s, s + 1, 1) for s in starts])
+
+    lefts = [code(range(k)) for k in (5, 1, 1, 1, 1, 1, 4, 2, 3)]
+    rights = [code([10 + k]) for k in range(len(lefts))]
+    assert hera.multi_bottleneck_distance(lefts, rights) == [4, 0, 0, 0, 0, 0, 3, 1, 2]
+    assert len(calls.read_text().split()) == 3
+    assert hera.multi_bottleneck_distance(lefts, rights, processes=1) == \
+        [4, 0, 0, 0, 0, 0, 3, 1, 2]
+    assert len(calls.read_text().split()) == 4
+
+    lefts[-1] = code([666])
+    with pytest.raises(subprocess.CalledProcessError):
+        hera.multi_bottleneck_distance(lefts, rights)
+    error_dirs = list(tmp_path.glob('error-hera-*'))
+    assert len(error_dirs) == 1
+    # Only the failing shard's diagrams were kept
+    assert (error_dirs[0] / 'self.txt').read_text().split('--\n')[-2] == '666.0 667.0\n'
+    assert (error_dirs[0] / 'self.txt').read_text().count('--') < len(lefts)
+
+    # Shards failing together keep their inputs in separate directories
+    lefts[0] = code([666, 667])
+    with pytest.raises(subprocess.CalledProcessError):
+        hera.multi_bottleneck_distance(lefts, rights)
+    assert len(list(tmp_path.glob('error-hera-*'))) == 3
+
+
+def test_python_backend(monkeypatch):
+    from pyrivet import bottleneck, wasserstein
+    monkeypatch.setattr(hera, 'distance_cache', None)
+    left = barcode.Barcode([barcode.Bar(0, np.inf, 1), barcode.Bar(1, 3, 2)])
+    right = barcode.Barcode([barcode.Bar(0.5, np.inf, 1), barcode.Bar(1, 3, 1),
+                             barcode.Bar(1.25, 3, 1)])
+    assert hera.bottleneck_distance(left, right, backend='python') == pytest.approx(0.5)
+    assert hera.wasserstein_distance(left, right, 2, backend='python') == \
+        wasserstein.wasserstein_distance(left, right, 2)
+    # As in Hera, an unmatched infinite bar ends at `inf`, and the result is
+    # capped
+    essential = barcode.Barcode([barcode.Bar(0, np.inf, 1)])
+    other = barcode.Barcode([barcode.Bar(0, 4, 1)])
+    assert bottleneck.bottleneck_distance(essential, other) == np.inf
+    assert hera.bottleneck_distance(essential, other, backend='python') == 10
+    assert hera.bottleneck_distance(essential, other, inf=100, cap=np.inf,
+                                    backend='python') == pytest.approx(50)
+    assert hera.bottleneck_distance(essential, barcode.Barcode(), backend='python') == 10
+    assert hera.wasserstein_distance(essential, other, 1, inf=100, cap=np.inf,
+                                     backend='python') == 50 + 2
+
+    monkeypatch.setattr(hera, 'default_backend', 'python')
+    monkeypatch.setenv('PATH', '')
+    assert hera.multi_bottleneck_distance([left, essential], [right, other],
+                                          inf=100, cap=20) == pytest.approx([0.5, 20])
+    with pytest.raises(ValueError):
+        hera.bottleneck_distance(left, right, backend='nope')
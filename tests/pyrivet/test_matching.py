@@ -3,7 +3,9 @@ import math
 
 import sys
 
-from pyrivet import rivet, matching_distance
+import pytest
+
+from pyrivet import barcode, rivet, matching_distance
 
 inf = float('inf')
 
@@ -280,3 +282,131 @@ def test_find_offset():
     # assert math.isclose(val, 1, abs_tol=1e-8)
 
 
+@pytest.fixture
+def stand_ins(monkeypatch):
+    """Replaces RIVET and Hera with stand-ins. Calling the fixture with
+    barcodes(module, lines) and bounds(module) functions installs them as
+    rivet.barcodes and rivet.bounds, with bottleneck distances computed
+    in-process, and returns the list of (module, lines) rivet.barcodes is
+    called with."""
+    from pyrivet import bottleneck, hera
+    calls = []
+
+    def multi_bottleneck_distance(lefts, rights, cap=10, processes=None):
+        return [min(cap, bottleneck.bottleneck_distance(a, b)) for a, b in zip(lefts, rights)]
+
+    def install(barcodes, bounds):
+        monkeypatch.setattr(rivet, 'bounds', bounds)
+        monkeypatch.setattr(rivet, 'barcodes',
+                            lambda m, lines: calls.append((m, list(lines))) or barcodes(m, lines))
+        monkeypatch.setattr(hera, 'multi_bottleneck_distance', multi_bottleneck_distance)
+        return calls
+
+    return install
+
+
+def test_pairwise_matching_distance(stand_ins):
+    # Module k has one bar whose length depends on k and the line
+    def barcodes(module, lines):
+        return [((slope, offset), barcode.Barcode([barcode.Bar(0, 1 + module * slope / 90, 1)]))
+                for slope, offset in lines]
+
+    calls = stand_ins(barcodes, lambda m: rivet.Bounds((0, 0), (1 + m, 2)))
+
+    modules = [0, 1, 2, 3]
+    matrix = matching_distance.pairwise_matching_distance(modules, 4, True, workers=2,
+                                                          chunk_size=20)
+    assert sorted(m for m, _ in calls) == modules
+    common = rivet.Bounds((0, 0), (4, 2))
+    for i in modules:
+        assert matrix[i, i] == 0
+        for j in modules[i + 1:]:
+            expected = matching_distance.matching_distance(i, j, 4, True, fixed_bounds=common)
+            assert math.isclose(matrix[i, j], expected) and matrix[j, i] == matrix[i, j]
+
+
+def test_adaptive_matching_distance(stand_ins):
+    # A module is a sum of interval modules supported on rectangles
+    # (lower x, lower y, upper x, upper y)
+    modules = [[(0, 0, 2, 1), (1, 0.5, 3, 2)],
+               [(0, 0.2, 2.5, 1), (1.5, 0.5, 3, 1.8)]]
+
+    def barcodes(module, lines):
+        result = []
+        for slope, offset in lines:
+            m = math.tan(math.radians(slope))
+            c = offset / math.cos(math.radians(slope))
+            bars = []
+            for x0, y0, x1, y1 in modules[module]:
+                # Where the line enters and leaves the rectangle, as
+                # distances along the line
+                start = max(x0, (y0 - c) / m) / math.cos(math.radians(slope))
+                end = min(x1, (y1 - c) / m) / math.cos(math.radians(slope))
+                if start < end:
+                    bars.append(barcode.Bar(start, end, 1))
+            result.append(((slope, offset), barcode.Barcode(bars)))
+        return result
+
+    stand_ins(barcodes, lambda m: rivet.Bounds((0, 0), (3, 3)))
+
+    grid = matching_distance.matching_distance(0, 1, 30, True)
+    lower, upper = matching_distance.adaptive_matching_distance(0, 1, True, rel_error=0.25)
+    assert lower <= upper <= lower * 1.25
+    # The grid's lines are among those the bound covers
+    assert grid <= upper + 1e-9
+
+    lower, upper = matching_distance.adaptive_matching_distance(0, 1, False, abs_error=0.01,
+                                                                max_lines=100)
+    assert lower <= upper
+
+    # Normalizing divides by the width and height of the bounds
+    with pytest.raises(ValueError):
+        matching_distance.adaptive_matching_distance(0, 1, True,
+                                                     fixed_bounds=rivet.Bounds((0, 1), (3, 1)))
+
+
+def test_progressive_matching_distance(stand_ins):
+    # Module k has one bar whose length depends on k, the slope and the offset
+    def barcodes(module, lines):
+        return [((slope, offset),
+                 barcode.Barcode([barcode.Bar(0, 1 + module * (slope + abs(offset)) / 90, 1)]))
+                for slope, offset in lines]
+
+    calls = stand_ins(barcodes, lambda m: rivet.Bounds((0, 0), (1 + m, 2)))
+
+    steps = list(matching_distance.progressive_matching_distance(0, 2, False, max_lines=200))
+    # Grids of 3 x 3, 7 x 5 and 15 x 9 lines; the next would be too many
+    assert [n for _, _, n in steps] == [9, 35, 135]
+    # Each line is computed once, for each module
+    computed = [line for _, lines in calls for line in lines]
+    assert len(computed) == 2 * 135 and len(set(computed)) == 135
+    lower_bounds = [lower for lower, _, _ in steps]
+    assert lower_bounds == sorted(lower_bounds)
+    assert math.isclose(lower_bounds[0], matching_distance.matching_distance(0, 2, 3, False))
+    assert steps[0][1] == lower_bounds[0]
+    assert math.isclose(steps[1][1], 2 * lower_bounds[1] - lower_bounds[0])
+
+    assert len(list(matching_distance.progressive_matching_distance(0, 2, False,
+                                                                     time_budget=0))) == 1
+
+
+def test_matching_distance_early_termination(stand_ins):
+    # Module 1 has an extra infinite bar, so that the distance along every
+    # line is the cap
+    def barcodes(module, lines):
+        bars = [barcode.Bar(0, 1, 1)] + [barcode.Bar(0, inf, 1)] * module
+        return [((slope, offset), barcode.Barcode(bars)) for slope, offset in lines]
+
+    calls = stand_ins(barcodes, lambda m: rivet.Bounds((0, 0), (1, 2)))
+
+    for normalize in (False, True):
+        expected = matching_distance.matching_distance(0, 1, 10, normalize)
+        del calls[:]
+        dist = matching_distance.matching_distance(0, 1, 10, normalize, chunk_size=20)
+        assert dist == expected
+        # Lines with the greatest weight give the whole answer
+        assert sum(len(lines) for _, lines in calls) == 2 * 20
+
+    for chunk_size in (0, -1, 2.5):
+        with pytest.raises(ValueError):
+            matching_distance.matching_distance(0, 1, 10, False, chunk_size=chunk_size)
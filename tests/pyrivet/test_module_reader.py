@@ -0,0 +1,97 @@
+import fractions
+import shutil
+
+import msgpack
+import numpy as np
+import pytest
+
+from pyrivet import rivet, module_reader
+
+
+def template_points_message():
+    """A small module's TemplatePointsMessage, as RIVET packs it: grades
+    x = 0, 1/2, 2 and y = 0, 1, with a generator at (0, 0) killed at (2, 1)"""
+    return [
+        "x_label", "y_label",
+        [[0, 0, 1, 0, 0],
+         [2, 1, 0, 1, 0]],
+        [["0", "1"], ["1", "2"], ["2", "1"]],
+        [["0", "1"], ["1", "1"]],
+        [[3, 2], [1, 1, 1, 1, 0, 0]],
+    ]
+
+
+def make_module(arrangement=None, message=None):
+    """A module file with the given template points message, by default
+    `template_points_message()`"""
+    return (module_reader.HEADER + b'\n' +
+            msgpack.packb({"dim": 1}) +
+            msgpack.packb(message or template_points_message()) +
+            msgpack.packb(arrangement or []))
+
+
+def test_read_module():
+    data = module_reader.read(make_module())
+    assert data.x_label == "x_label"
+    assert data.x_exact == [0, fractions.Fraction(1, 2), 2]
+    assert np.array_equal(data.y_grades, [0., 1.])
+    assert data.bounds() == rivet.Bounds((0., 0.), (2., 1.))
+
+    betti = data.betti()
+    assert betti.dimensions == rivet.Dimensions([0, fractions.Fraction(1, 2), 2], [0, 1])
+    assert betti.xi_0 == [(0, 0, 1)]
+    assert betti.xi_1 == [(2, 1, 1)]
+    assert betti.xi_2 == []
+    assert betti.graded_rank.shape == (2, 3)
+    assert betti.graded_rank[1, 0] == 1
+
+
+def test_bounds_without_rivet_console(tmp_path):
+    module = make_module()
+    assert module_reader.is_module_file(module)
+    assert rivet.bounds(module) == rivet.Bounds((0., 0.), (2., 1.))
+
+    path = tmp_path / 'module.rivet'
+    path.write_bytes(module)
+    precomputed = rivet.PrecomputedModule(str(path))
+    assert precomputed.bounds() == rivet.Bounds((0., 0.), (2., 1.))
+    assert precomputed.dimensions.x_grades[1] == fractions.Fraction(1, 2)
+
+
+@pytest.mark.parametrize('field, value', [
+    # Rationals are [numerator, denominator] pairs of decimal strings
+    (3, [[0, 1], [1, 2], [2, 1]]),
+    (3, ["0", "1/2", "2"]),
+    # The homology dimensions are [shape, values], with the shape of the grades
+    (5, [1, 1, 1, 1, 0, 0]),
+    (5, [[2, 3], [1, 1, 1, 1, 0, 0]]),
+    (2, [0, 0, 1, 0, 0, 2, 1, 0, 1, 0]),
+    (2, [[0, 5, 1, 0, 0]]),
+])
+def test_rejects_other_layouts(field, value):
+    message = template_points_message()
+    message[field] = value
+    with pytest.raises(module_reader.FormatError):
+        module_reader.read(make_module(message=message))
+    with pytest.raises(module_reader.FormatError):
+        module_reader.read(make_module(message=template_points_message() + [[]]))
+
+
+@pytest.mark.skipif(shutil.which(rivet.rivet_executable) is None,
+                    reason="rivet_console is not available")
+def test_matches_rivet_console(tmp_path):
+    """Decodes a module rivet_console wrote, and checks the results against
+    rivet_console's own answers for the same file"""
+    cloud = rivet.PointCloud([(0, 0), (1, 0), (0, 1), (2, 2)], appearance=[2, 1, 0, 3],
+                             second_param_name="birth", max_dist=3)
+    with rivet.compute_module(cloud, homology=0, directory=str(tmp_path)) as module:
+        assert module_reader.is_module_file(module)
+        data = module_reader.read(module)
+        assert data.bounds() == rivet.bounds_file(module.path)
+        expected = rivet.betti_file(module.path)
+        betti = data.betti()
+        assert betti.dimensions == expected.dimensions
+        assert sorted(betti.xi_0) == sorted(expected.xi_0)
+        assert sorted(betti.xi_1) == sorted(expected.xi_1)
+        assert sorted(betti.xi_2) == sorted(expected.xi_2)
+        assert np.array_equal(betti.graded_rank, expected.graded_rank)
@@ -1,4 +1,8 @@
 # Borrowed from https://github.com/IntelPNI/brainiak-extras
+import io
+
+import numpy as np
+
 from pyrivet import rivet, hera, barcode
 
 inf = float('inf')
@@ -28,3 +32,162 @@ def assert_barcodes(cloud, dim, buckets, angle, offset, barcodes):
 #     ])
 #     assert_barcodes(cloud_1, 0, 0, 0, 0, barcodes=barcodes)
 
+
+def reference_save(cloud, out):
+    """The original, one value at a time, PointCloud.save"""
+    out.write("points\n")
+    out.write(str(cloud.dimension) + "\n")
+    out.write('{:f}'.format(cloud.max_dist) + "\n")
+    if cloud.second_param_name is not None:
+        out.write(cloud.second_param_name + "\n")
+    else:
+        out.write("no function\n")
+    for i, p in enumerate(cloud.points):
+        for c in p:
+            out.write('{:f}'.format(c))
+            out.write(" ")
+        if cloud.second_param_name is not None:
+            if cloud._appearance_has_len:
+                out.write('{:f} '.format(cloud.appearance[i]))
+            else:
+                out.write('{:f} '.format(cloud.appearance or 0))
+        out.write("\n")
+    out.write("\n")
+
+
+def test_point_cloud_save_matches_reference(tmp_path, monkeypatch):
+    monkeypatch.setattr(rivet, 'save_chunk_values', 20)
+    points = np.random.RandomState(0).normal(size=(50, 3)) * 1e3
+    points[0, 0] = -0.0
+    np.save(str(tmp_path / 'points.npy'), points)
+    clouds = [
+        rivet.PointCloud(points, max_dist=2.5),
+        rivet.PointCloud(points.astype(np.float32), appearance=np.arange(50) / 3,
+                         second_param_name='codensity', max_dist=2.5),
+        rivet.PointCloud(np.arange(30).reshape(10, 3), appearance=2,
+                         second_param_name='irrelevant', max_dist=1),
+        rivet.PointCloud(str(tmp_path / 'points.npy'), second_param_name='zero',
+                         max_dist=3),
+    ]
+    assert isinstance(clouds[-1].points, np.memmap)
+    # Memory-mapped points are used in place, and other arrays are copied
+    mapped = np.load(str(tmp_path / 'points.npy'), mmap_mode='r')
+    assert rivet.PointCloud(mapped, max_dist=3).points is mapped
+    assert not np.shares_memory(clouds[0].points, points)
+    for cloud in clouds:
+        expected, actual = io.StringIO(), io.StringIO()
+        reference_save(cloud, expected)
+        cloud.save(actual)
+        assert actual.getvalue() == expected.getvalue()
+
+
+def test_diameter():
+    from scipy.spatial.distance import pdist
+    rng = np.random.RandomState(1)
+    for dimension in (1, 2, 3, 5):
+        points = rng.normal(size=(300, dimension))
+        expected = pdist(points).max()
+        assert np.isclose(rivet.diameter(points, chunk_size=64), expected)
+        approx = rivet.diameter(points, approximate=True, chunk_size=64)
+        assert expected <= approx + 1e-9
+        assert approx <= min(2, np.sqrt(dimension)) * expected + 1e-9
+    # Coplanar points can't use a 3D convex hull
+    flat = np.c_[rng.normal(size=(300, 2)), np.zeros(300)]
+    assert np.isclose(rivet.diameter(flat, chunk_size=64), pdist(flat).max())
+    assert rivet.diameter(np.zeros((1, 3))) == 0
+
+
+def reference_metric_save(space, out):
+    """The original, one value at a time, MetricSpace.save"""
+    out.write('metric\n')
+    if space.appearance_values is not None:
+        out.write(space.appearance_label + '\n')
+        out.write(" ".join(['{:f} '.format(s) for s in space.appearance_values]) + "\n")
+    else:
+        out.write("no function\n")
+        out.write(str(len(space.distance_matrix)) + "\n")
+    out.write(space.distance_label + '\n')
+    dim = len(space.distance_matrix)
+    max_dist = max(*[space.distance_matrix[i][j] for i in range(dim) for j in range(dim)])
+    out.write('{:f}'.format(max_dist) + '\n')
+    for row in range(dim):
+        for col in range(row + 1, dim):
+            out.write('{:f} '.format(space.distance_matrix[row][col]))
+        out.write('\n')
+
+
+def test_metric_space_save(tmp_path, monkeypatch):
+    from scipy.spatial.distance import pdist, squareform
+    monkeypatch.setattr(rivet, 'save_chunk_values', 10)
+    condensed = pdist(np.random.RandomState(2).normal(size=(12, 2)))
+    dense = squareform(condensed)
+    memmapped = np.memmap(str(tmp_path / 'dist.dat'), dtype=np.float64,
+                          mode='w+', shape=dense.shape)
+    memmapped[:] = dense
+    appearance = np.arange(12) * 0.25
+
+    expected = io.StringIO()
+    reference_metric_save(rivet.MetricSpace('app', 'dist', appearance, dense.tolist()), expected)
+    for matrix in (dense.tolist(), dense, memmapped, condensed):
+        actual = io.StringIO()
+        rivet.MetricSpace('app', 'dist', appearance, matrix).save(actual)
+        assert actual.getvalue() == expected.getvalue()
+
+    expected = io.StringIO()
+    reference_metric_save(rivet.MetricSpace(None, 'dist', None, dense), expected)
+    actual = io.StringIO()
+    rivet.MetricSpace(None, 'dist', None, condensed).save(actual)
+    assert actual.getvalue() == expected.getvalue()
+
+
+def reference_bifiltration_save(bifiltration, out):
+    """The original, one value at a time, Bifiltration.save"""
+    out.write('--datatype bifiltration\n')
+    out.write('--xlabel ' + bifiltration.x_label + '\n')
+    out.write('--ylabel ' + bifiltration.y_label + '\n')
+    for simplex, appears in zip(bifiltration.simplices, bifiltration.appearances):
+        for v in simplex:
+            out.write('{:d} '.format(v))
+            out.write(" ")
+        out.write('; ')
+        for a in appears:
+            for g in a:
+                out.write('{:f} '.format(g))
+                out.write(" ")
+        out.write("\n")
+    out.write("\n")
+
+
+def test_bifiltration_save(monkeypatch):
+    monkeypatch.setattr(rivet, 'save_chunk_values', 7)
+    simplices = [[0], [1], [0, 1], [2], [0, 1, 2]]
+    appearances = [[(0, 0)], [(1, 0.5)], [(1, 1), (0.25, 2)], [(3, 0)], [(4, 4)]]
+    bifiltration = rivet.Bifiltration("x", "y", simplices, appearances)
+    assert bifiltration.simplices == simplices
+    assert bifiltration.appearances == appearances
+
+    expected, actual = io.StringIO(), io.StringIO()
+    reference_bifiltration_save(bifiltration, expected)
+    bifiltration.save(actual)
+    assert actual.getvalue() == expected.getvalue()
+
+    from_arrays = rivet.Bifiltration.from_arrays(
+        "x", "y", bifiltration.vertices, bifiltration.simplex_offsets,
+        bifiltration.grades, bifiltration.appearance_offsets)
+    actual = io.StringIO()
+    from_arrays.save(actual)
+    assert actual.getvalue() == expected.getvalue()
+
+    # Vertex ids beyond the precision of a double are written exactly
+    large = rivet.Bifiltration("x", "y", [[2 ** 53 + 1]], [[(0, 0)]])
+    actual = io.StringIO()
+    large.save(actual)
+    assert '%d ' % (2 ** 53 + 1) in actual.getvalue()
+
+    # The lists are copies, so changes are made by assigning new ones
+    bifiltration.simplices[0].append(5)
+    assert bifiltration.simplices == simplices
+    bifiltration.simplices = [[0], [1], [0, 1], [2], [1, 2]]
+    bifiltration.appearances = [[(0, 0)]] * 5
+    assert bifiltration.simplices[4] == [1, 2]
+    assert bifiltration.appearances[1] == [(0, 0)]
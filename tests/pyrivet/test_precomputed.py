@@ -0,0 +1,36 @@
+import os
+import pickle
+
+from pyrivet import rivet
+
+
+def test_precomputed_module_from_bytes():
+    module = rivet.PrecomputedModule.from_bytes(b'RIVET_msgpack\nmodule data')
+    path = module.path
+    assert os.path.exists(path)
+    assert len(module) == len(b'RIVET_msgpack\nmodule data')
+    assert bytes(module) == b'RIVET_msgpack\nmodule data'
+    assert module.data[:13] == b'RIVET_msgpack'
+    assert os.fspath(module) == path
+
+    borrowed = pickle.loads(pickle.dumps(module))
+    assert borrowed.path == path
+    borrowed.close()
+    assert os.path.exists(path)
+
+    module.close()
+    assert not os.path.exists(path)
+
+
+def test_precomputed_module_memoizes_bounds(monkeypatch):
+    calls = []
+
+    def fake_bounds_file(name):
+        calls.append(name)
+        return rivet.Bounds((0, 0), (1, 1))
+
+    monkeypatch.setattr(rivet, 'bounds_file', fake_bounds_file)
+    with rivet.PrecomputedModule.from_bytes(b'RIVET_msgpack\n') as module:
+        assert rivet.bounds(module) == rivet.Bounds((0, 0), (1, 1))
+        assert rivet.bounds(module) == rivet.Bounds((0, 0), (1, 1))
+        assert calls == [module.path]
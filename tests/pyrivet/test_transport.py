@@ -0,0 +1,26 @@
+import os
+import stat
+
+import pytest
+
+from pyrivet import rivet, transport
+
+
+@pytest.mark.parametrize('use_memfd', [False, True])
+def test_staging_round_trip(tmp_path, monkeypatch, use_memfd):
+    if use_memfd and not transport.use_memfd:
+        pytest.skip("memfd is not available")
+    # A stand-in for rivet_console that copies its input to its output
+    script = tmp_path / 'fake_rivet_console'
+    script.write_text('#!/bin/sh\ncp "$1" "$2"\n')
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(rivet, 'rivet_executable', str(script))
+    monkeypatch.setattr(rivet, 'cache', None)
+    monkeypatch.setattr(transport, 'use_memfd', use_memfd)
+    monkeypatch.setattr(transport, 'temp_dir', str(tmp_path))
+
+    cloud = rivet.PointCloud([(0, 0), (3, 4)])
+    output = rivet.compute_point_cloud(cloud)
+    assert output.startswith(b'points\n2\n5.000000\n')
+    # Nothing is left behind in the staging directory
+    assert os.listdir(str(tmp_path)) == ['fake_rivet_console']
@@ -0,0 +1,45 @@
+import numpy as np
+
+from pyrivet import barcode, bottleneck, vptree
+
+
+def test_point_queries():
+    random = np.random.RandomState(3)
+    points = random.uniform(size=(500, 2))
+
+    def metric(a, b):
+        return float(np.linalg.norm(a - b))
+
+    tree = vptree.VPTree(metric, points[:300], seed=0)
+    tree.extend(points[300:])
+    assert len(tree) == 500
+    query = np.array([0.5, 0.5])
+    truth = np.linalg.norm(points - query, axis=1)
+
+    tree.distance_evaluations = 0
+    indices, distances = tree.nearest(query, k=5)
+    assert indices.tolist() == np.argsort(truth)[:5].tolist()
+    assert np.allclose(distances, np.sort(truth)[:5])
+    assert tree.distance_evaluations < len(points) / 2
+
+    indices, distances = tree.within(query, 0.1)
+    assert indices.tolist() == np.flatnonzero(truth <= 0.1).tolist()
+
+
+def test_save_and_load(tmp_path):
+    random = np.random.RandomState(4)
+    codes = [barcode.Barcode.from_arrays(s, s + random.uniform(0, 2, size=len(s)),
+                                         np.ones(len(s)))
+             for s in (random.uniform(0, 3, size=random.randint(1, 5)) for _ in range(40))]
+    tree = vptree.VPTree(bottleneck.bottleneck_distance, codes, leaf_size=4, seed=1)
+    path = str(tmp_path / 'tree.npz')
+    tree.save(path)
+    loaded = vptree.VPTree.load(path, bottleneck.bottleneck_distance)
+    assert loaded.items == tree.items
+
+    expected = tree.nearest(codes[7], k=3)
+    found = loaded.nearest(codes[7], k=3)
+    assert found[0].tolist() == expected[0].tolist()
+    assert found[0][0] == 7 and found[1][0] == 0
+    loaded.add(codes[7])
+    assert 40 in loaded.within(codes[7], 0)[0].tolist()
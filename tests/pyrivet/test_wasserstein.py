@@ -0,0 +1,53 @@
+import itertools
+import math
+
+import numpy as np
+
+from pyrivet import barcode, wasserstein
+
+
+def brute_force(left, right, degree):
+    """The Wasserstein distance between small sets of finite bars, by trying
+    every matching of the bars and their diagonal projections"""
+    n, m = len(left), len(right)
+    costs = np.full((n + m, m + n), np.inf)
+    for i, a in enumerate(left):
+        for j, b in enumerate(right):
+            costs[i, j] = max(abs(a[0] - b[0]), abs(a[1] - b[1])) ** degree
+        costs[i, m + i] = ((a[1] - a[0]) / 2) ** degree
+    for j, b in enumerate(right):
+        costs[n + j, j] = ((b[1] - b[0]) / 2) ** degree
+    costs[n:, m:] = 0
+    best = min(sum(costs[i, k] for i, k in enumerate(order))
+               for order in itertools.permutations(range(n + m)))
+    return best ** (1 / degree)
+
+
+def code(bars):
+    return barcode.Barcode([barcode.Bar(s, e, 1) for s, e in bars])
+
+
+def test_matches_brute_force():
+    random = np.random.RandomState(1)
+    for degree in (1, 2):
+        for _ in range(20):
+            left = [(s, s + random.randint(1, 6) / 2) for s in random.randint(0, 6, size=random.randint(0, 4)) / 2]
+            right = [(s, s + random.randint(1, 6) / 2) for s in random.randint(0, 6, size=random.randint(0, 4)) / 2]
+            expected = brute_force(left, right, degree)
+            assert math.isclose(wasserstein.wasserstein_distance(code(left), code(right), degree),
+                                expected, abs_tol=1e-9)
+
+
+def test_multiplicities_and_batches():
+    left = barcode.Barcode([barcode.Bar(0, 2, 3), barcode.Bar(1, 5, 2), barcode.Bar(0, np.inf, 1)])
+    right = barcode.Barcode([barcode.Bar(0, 2.5, 1), barcode.Bar(1, 4, 4), barcode.Bar(1, np.inf, 1)])
+    expanded = wasserstein.wasserstein_distance(left.expand(), right.expand(), 2)
+    assert math.isclose(wasserstein.wasserstein_distance(left, right, 2), expanded)
+    assert wasserstein.wasserstein_distance(left, barcode.Barcode(), 1) == math.inf
+
+    arrays = barcode.BarcodeArrays([0, 3, 3], left.starts, left.ends, left.multiplicities)
+    others = barcode.BarcodeArrays([0, 3, 4], np.append(right.starts, 0),
+                                   np.append(right.ends, 4), np.append(right.multiplicities, 1))
+    distances = wasserstein.wasserstein_distances(arrays, others, 2)
+    assert math.isclose(distances[0], expanded)
+    assert distances[1] == 2